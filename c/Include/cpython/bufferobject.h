@@ -0,0 +1,25 @@
+/* Buffer object interface */
+
+/*
+PyBufferObject is a flat array of numbers in linear memory, which python can write into directly
+(see src/buffers.py). It's how bulk data gets into compiled code without being boxed an item at a time:
+items are only boxed when they're indexed.
+*/
+
+#ifndef Py_BUFFEROBJECT_H
+#define Py_BUFFEROBJECT_H
+
+typedef struct {
+    PyObject_VAR_HEAD  // ob_size is the number of items
+    char format;  // the struct/array.array typecode of the items: one of 'B', 'i', 'q' or 'd'
+    unsigned char* data;
+} PyBufferObject;
+
+extern Type PyBuffer_Type;
+
+#define PyBuffer_CheckExact(op) Py_IS_TYPE(op, &PyBuffer_Type)
+
+PyBufferObject* PyBuffer_New(Py_ssize_t size, char format);
+unsigned char* PyBuffer_Data(PyBufferObject* buffer);
+
+#endif /* !Py_BUFFEROBJECT_H */
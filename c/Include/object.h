@@ -267,6 +267,30 @@ void py_decref(PyObject* a);
 void py_incref(PyObject* a);
 void* py_malloc(int size);
 
+// heap statistics, one set per type. They're indexed by the same codes as get_type (with 0 for anything else),
+// and read from python in one go, via get_heap_stats (see run_wasm.read_heap_stats)
+#define HEAP_STATS_TYPES 6
+
+typedef struct {
+    unsigned int live;
+    unsigned int allocations;
+    unsigned int free_list_hits;
+    unsigned int bytes_in_use;
+} HeapStats;
+
+extern HeapStats heap_stats[HEAP_STATS_TYPES];
+
+void heap_stats_alloc(PyObject* op);
+HeapStats* get_heap_stats(void);
+
+// the compiler lays out each module's constants in here, as objects which are never freed (see
+// CodeGenerator.static_const), so that loading one is just a pointer. Their refcounts start (and get reset to)
+// IMMORTAL_REFCNT. The size has to match generate_code.CONST_POOL_SIZE
+#define CONST_POOL_SIZE 16384
+#define IMMORTAL_REFCNT (1 << 30)
+
+extern unsigned char const_pool[CONST_POOL_SIZE];
+
 
 // and now, a load of macros for compatability purposes
 
@@ -414,6 +438,7 @@ _PyObject_Init(PyObject* op, Type* typeobj)
 //        Py_INCREF(typeobj);
 //    }
     Py_SET_REFCNT(op, 1);  // ie _Py_NewReference(op);
+    heap_stats_alloc(op);
 }
 
 static inline void
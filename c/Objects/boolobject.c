@@ -210,12 +210,13 @@ PyTypeObject PyBool_Type = {
 
 /* The objects representing bool values False and True */
 
+// (immortal too, see _Py_NoneStruct)
 struct _longobject _Py_FalseStruct = {
-    PyVarObject_HEAD_INIT(&PyBool_Type, 0)
+    { { IMMORTAL_REFCNT, &PyBool_Type }, 0 },
     { 0 }
 };
 
 struct _longobject _Py_TrueStruct = {
-    PyVarObject_HEAD_INIT(&PyBool_Type, 1)
+    { { IMMORTAL_REFCNT, &PyBool_Type }, 1 },
     { 1 }
 };
@@ -0,0 +1,97 @@
+#include "object.h"
+#include "glue.h"
+#include "cpython/bufferobject.h"
+#include "cpython/floatobject.h"
+#include "cpython/longintrepr.h"
+#include "cpython/longobject.h"
+
+#include <string.h>
+
+PyObject* native_box_int(int64_t value);
+
+static Py_ssize_t item_size(char format) {
+    switch (format) {
+        case 'B': return 1;
+        case 'i': return 4;
+        case 'q': return 8;
+        case 'd': return 8;
+        default: PANIC("buffer: unknown format!");
+    }
+}
+
+// the object and its data are one allocation (so freeing the object frees the data too).
+// the data is zeroed, and 8 byte aligned
+PyBufferObject* PyBuffer_New(Py_ssize_t size, char format) {
+    if (size < 0) {
+        PyErr_BadInternalCall();
+    }
+    Py_ssize_t header = (sizeof(PyBufferObject) + 7) & ~7;
+    PyBufferObject* op = malloc(header + size * item_size(format));
+    if (op == NULL) {
+        PANIC("PyBuffer_New out of memory!");
+    }
+    op->format = format;
+    op->data = (unsigned char*) op + header;
+    memset(op->data, 0, size * item_size(format));
+    _PyObject_InitVar((PyVarObject*) op, &PyBuffer_Type, size);
+    return op;
+}
+
+unsigned char* PyBuffer_Data(PyBufferObject* buffer) {
+    return buffer->data;
+}
+
+static Py_ssize_t buffer_length(PyBufferObject* self) {
+    return Py_SIZE(self);
+}
+
+static PyObject* buffer_subscript(PyBufferObject* self, PyObject* item) {
+    if (!PyLong_CheckExact(item)) {
+        PANIC("buffer indices must be integers");
+    }
+    Py_ssize_t i = PyLong_AsSsize_t(item);
+    if (i < 0) {
+        i += Py_SIZE(self);
+    }
+    if (i < 0 || i >= Py_SIZE(self)) {
+        PyErr_SetString(PyExc_IndexError, "buffer index out of range");
+    }
+
+    unsigned char* data = self->data;
+    switch (self->format) {
+        case 'B':
+            return PyLong_FromLong(data[i]);
+        case 'i': {
+            int32_t value;
+            memcpy(&value, data + i * 4, 4);
+            return PyLong_FromLong(value);
+        }
+        case 'q': {
+            int64_t value;
+            memcpy(&value, data + i * 8, 8);
+            return native_box_int(value);
+        }
+        default: {
+            double value;
+            memcpy(&value, data + i * 8, 8);
+            return PyFloat_FromDouble(value);
+        }
+    }
+}
+
+PyMappingMethods buffer_as_mapping = {
+    (lenfunc)buffer_length,
+    (binaryfunc)buffer_subscript,
+    (objobjargproc)0
+};
+
+Type PyBuffer_Type = {
+        TYPE_HEAD
+        "buffer",                                   /* tp_name */
+        sizeof(PyBufferObject),                     /* tp_basicsize */
+        0,                                          /* tp_itemsize */
+
+        0,
+        0,
+        &buffer_as_mapping,
+};
@@ -0,0 +1,248 @@
+#include "object.h"
+#include "glue.h"
+#include "cpython/boolobject.h"
+#include "cpython/bufferobject.h"
+#include "cpython/floatobject.h"
+#include "cpython/longintrepr.h"
+#include "cpython/longobject.h"
+#include "cpython/noneobject.h"
+#include "cpython/tupleobject.h"
+
+#include <string.h>
+
+/*
+Serialises PyObjects into a flat buffer, so that python can read a whole structure of them in one go,
+rather than making a call for every value (and every tuple item) -- see src/marshalling.py, which has the format.
+Arguments go the other way, using the same format.
+*/
+
+PyLongObject* _PyLong_New(Py_ssize_t size);
+
+#define MARSHAL_INT 'i'
+#define MARSHAL_TUPLE 't'
+#define MARSHAL_BOOL 'b'
+#define MARSHAL_NONE 'n'
+#define MARSHAL_FLOAT 'f'
+#define MARSHAL_UNKNOWN '?'
+#define MARSHAL_OBJECT 'o'
+
+// nearly everything fits in here, so there's usually nothing to allocate (has to match marshalling.py)
+#define MARSHAL_AREA_SIZE 4096
+unsigned char marshal_area[MARSHAL_AREA_SIZE];
+// for anything that doesn't. It's freed the next time round
+static unsigned char* marshal_overflow = NULL;
+
+unsigned char* get_marshal_area(void) {
+    return marshal_area;
+}
+
+// ints go across as the bytes of their magnitude (least significant first), which python can convert in bulk
+// with int.from_bytes/to_bytes. These convert between that and the runtime's 15 bit digits.
+
+static unsigned int long_byte_length(PyLongObject* v) {
+    Py_ssize_t n = Py_ABS(Py_SIZE(v));
+    if (n == 0) {
+        return 0;
+    }
+    unsigned int bits = (n - 1) * PyLong_SHIFT + (32 - __builtin_clz(v->ob_digit[n - 1]));
+    return (bits + 7) / 8;
+}
+
+static void long_to_bytes(PyLongObject* v, unsigned char* out, unsigned int length) {
+    Py_ssize_t n = Py_ABS(Py_SIZE(v));
+    twodigits accumulator = 0;
+    int bits = 0;
+    unsigned int j = 0;
+    for (Py_ssize_t i = 0; i < n; i++) {
+        accumulator |= (twodigits) v->ob_digit[i] << bits;
+        bits += PyLong_SHIFT;
+        while (bits >= 8 && j < length) {
+            out[j++] = accumulator & 0xff;
+            accumulator >>= 8;
+            bits -= 8;
+        }
+    }
+    while (j < length) {
+        out[j++] = accumulator & 0xff;
+        accumulator >>= 8;
+    }
+}
+
+static PyObject* long_from_bytes(const unsigned char* in, unsigned int length, int negative) {
+    if (length <= 3) {
+        // fits in a long (so small ints come from the cache)
+        long value = 0;
+        for (unsigned int j = length; j > 0; j--) {
+            value = (value << 8) | in[j - 1];
+        }
+        return PyLong_FromLong(negative ? -value : value);
+    }
+
+    Py_ssize_t n = (length * 8 + PyLong_SHIFT - 1) / PyLong_SHIFT;
+    PyLongObject* v = _PyLong_New(n);
+    twodigits accumulator = 0;
+    int bits = 0;
+    Py_ssize_t i = 0;
+    for (unsigned int j = 0; j < length; j++) {
+        accumulator |= (twodigits) in[j] << bits;
+        bits += 8;
+        if (bits >= PyLong_SHIFT) {
+            v->ob_digit[i++] = accumulator & PyLong_MASK;
+            accumulator >>= PyLong_SHIFT;
+            bits -= PyLong_SHIFT;
+        }
+    }
+    if (i < n) {
+        v->ob_digit[i++] = accumulator;
+    }
+    // (normalise: the top byte might not have filled a whole digit)
+    while (n > 0 && v->ob_digit[n - 1] == 0) {
+        n--;
+    }
+    Py_SET_SIZE(v, negative ? -n : n);
+    return (PyObject*) v;
+}
+
+static unsigned int marshalled_size(PyObject* v) {
+    if (Py_TYPE(v) == &PyLong_Type) {
+        return 1 + 4 + long_byte_length((PyLongObject*) v);
+    }
+    if (Py_TYPE(v) == &PyTuple_Type) {
+        unsigned int size = 1 + 4;
+        for (Py_ssize_t i = 0; i < Py_SIZE(v); i++) {
+            size += marshalled_size(PyTuple_GET_ITEM(v, i));
+        }
+        return size;
+    }
+    if (Py_TYPE(v) == &PyBool_Type) return 1 + 1;
+    if (Py_TYPE(v) == &PyFloat_Type) return 1 + sizeof(double);
+    return 1;
+}
+
+static unsigned char* marshal_write(unsigned char* out, PyObject* v) {
+    if (Py_TYPE(v) == &PyLong_Type) {
+        // the length is signed (it's the sign of the whole number), followed by that many bytes
+        unsigned int length = long_byte_length((PyLongObject*) v);
+        int32_t size = Py_SIZE(v) < 0 ? -(int32_t) length : (int32_t) length;
+        *out++ = MARSHAL_INT;
+        memcpy(out, &size, 4);
+        out += 4;
+        long_to_bytes((PyLongObject*) v, out, length);
+        return out + length;
+    }
+    if (Py_TYPE(v) == &PyTuple_Type) {
+        int32_t size = Py_SIZE(v);
+        *out++ = MARSHAL_TUPLE;
+        memcpy(out, &size, 4);
+        out += 4;
+        for (Py_ssize_t i = 0; i < size; i++) {
+            out = marshal_write(out, PyTuple_GET_ITEM(v, i));
+        }
+        return out;
+    }
+    if (Py_TYPE(v) == &PyBool_Type) {
+        *out++ = MARSHAL_BOOL;
+        *out++ = Py_SIZE(v) != 0;
+        return out;
+    }
+    if (Py_TYPE(v) == &PyFloat_Type) {
+        *out++ = MARSHAL_FLOAT;
+        memcpy(out, &((PyFloatObject*) v)->ob_fval, sizeof(double));
+        return out + sizeof(double);
+    }
+    if (Py_TYPE(v) == &PyNone_Type) {
+        *out++ = MARSHAL_NONE;
+        return out;
+    }
+    *out++ = MARSHAL_UNKNOWN;
+    return out;
+}
+
+// returns a buffer starting with the (u32) length of what follows, which is v serialised
+unsigned char* marshal_return(PyObject* v) {
+    unsigned int size = marshalled_size(v);
+    unsigned char* buffer = marshal_area;
+
+    free(marshal_overflow);
+    marshal_overflow = NULL;
+    if (size + 4 > MARSHAL_AREA_SIZE) {
+        buffer = marshal_overflow = malloc(size + 4);
+        if (buffer == NULL) {
+            PANIC("marshal_return out of memory!");
+        }
+    }
+
+    memcpy(buffer, &size, 4);
+    marshal_write(buffer + 4, v);
+    return buffer;
+}
+
+// for arguments too big for the marshal area. Python frees it again once it's done (with marshal_free)
+unsigned char* marshal_alloc(unsigned int size) {
+    unsigned char* buffer = malloc(size);
+    if (buffer == NULL) {
+        PANIC("marshal_alloc out of memory!");
+    }
+    return buffer;
+}
+
+void marshal_free(unsigned char* buffer) {
+    free(buffer);
+}
+
+static unsigned char* unmarshal_read(unsigned char* in, PyObject** out) {
+    unsigned char tag = *in++;
+    if (tag == MARSHAL_INT) {
+        int32_t size;
+        memcpy(&size, in, 4);
+        in += 4;
+        *out = long_from_bytes(in, Py_ABS(size), size < 0);
+        return in + Py_ABS(size);
+    }
+    if (tag == MARSHAL_TUPLE) {
+        int32_t size;
+        memcpy(&size, in, 4);
+        in += 4;
+        PyObject* tuple = PyTuple_New(size);
+        for (Py_ssize_t i = 0; i < size; i++) {
+            PyObject* item;
+            in = unmarshal_read(in, &item);
+            PyTuple_SET_ITEM(tuple, i, item);
+        }
+        *out = tuple;
+        return in;
+    }
+    if (tag == MARSHAL_BOOL) {
+        *out = Py_NewRef(*in++ ? Py_True : Py_False);
+        return in;
+    }
+    if (tag == MARSHAL_FLOAT) {
+        double value;
+        memcpy(&value, in, sizeof(double));
+        *out = PyFloat_FromDouble(value);
+        return in + sizeof(double);
+    }
+    if (tag == MARSHAL_NONE) {
+        *out = Py_NewRef(Py_None);
+        return in;
+    }
+    if (tag == MARSHAL_OBJECT) {
+        // an object that already lives in the runtime (i.e. a buffer), passed by reference
+        PyObject* v;
+        memcpy(&v, in, 4);
+        *out = Py_NewRef(v);
+        return in + 4;
+    }
+    PANIC("unmarshal: unknown tag!");
+}
+
+// buffer starts with count (u32) slots, followed by count serialised values.
+// each value is turned into a PyObject, and its pointer written into its slot, for python to pass on as arguments
+void unmarshal_args(unsigned char* buffer, int count) {
+    unsigned char* in = buffer + count * 4;
+    for (int i = 0; i < count; i++) {
+        PyObject* arg;
+        in = unmarshal_read(in, &arg);
+        memcpy(buffer + i * 4, &arg, 4);
+    }
+}
@@ -0,0 +1,320 @@
+#include "object.h"
+#include "glue.h"
+#include "cpython/floatobject.h"
+#include "cpython/longintrepr.h"
+#include "cpython/longobject.h"
+
+#include <float.h>
+#include <math.h>
+
+/*
+Conversions for the native exports (see CodeGenerator.native_export): functions annotated as taking and returning
+ints and floats get an extra export which takes i64s and f64s, and returns one, so that calling it from python
+doesn't need any marshalling at all.
+A result that doesn't fit (an int outside the i64 range, or a value of the wrong type) can't be returned that way,
+so it's kept here instead, and a sentinel returned: python then picks it up with native_take_boxed.
+*/
+
+PyLongObject* _PyLong_New(Py_ssize_t size);
+double PyLong_AsDouble(PyObject* v);
+
+// the result that didn't fit, if any
+static PyObject* native_boxed = NULL;
+
+static void native_keep(PyObject* v) {
+    if (native_boxed != NULL) {
+        // (whoever called last never came to collect it)
+        Py_DECREF(native_boxed);
+    }
+    native_boxed = v;
+}
+
+PyObject* native_take_boxed(void) {
+    PyObject* v = native_boxed;
+    native_boxed = NULL;
+    return v;
+}
+
+PyObject* native_box_int(int64_t value) {
+    if (value >= LONG_MIN && value <= LONG_MAX) {
+        return PyLong_FromLong((long) value);
+    }
+    // (this way round so that INT64_MIN doesn't overflow)
+    uint64_t magnitude = value < 0 ? 0 - (uint64_t) value : (uint64_t) value;
+    Py_ssize_t n = 0;
+    for (uint64_t t = magnitude; t; t >>= PyLong_SHIFT) {
+        n++;
+    }
+    PyLongObject* v = _PyLong_New(n);
+    for (Py_ssize_t i = 0; i < n; i++) {
+        v->ob_digit[i] = magnitude & PyLong_MASK;
+        magnitude >>= PyLong_SHIFT;
+    }
+    Py_SET_SIZE(v, value < 0 ? -n : n);
+    return (PyObject*) v;
+}
+
+// if v is an int which fits in an int64_t (other than INT64_MIN), puts it in *out and returns 1
+static int long_as_int64(PyObject* v, int64_t* out) {
+    if (Py_TYPE(v) != &PyLong_Type) {
+        return 0;
+    }
+    Py_ssize_t n = Py_ABS(Py_SIZE(v));
+    // 63 bits is 4 whole digits plus 3 bits of a fifth
+    if (n > 5 || (n == 5 && ((PyLongObject*) v)->ob_digit[4] >= 8)) {
+        return 0;
+    }
+    uint64_t magnitude = 0;
+    for (Py_ssize_t i = n; i > 0; i--) {
+        magnitude = (magnitude << PyLong_SHIFT) | ((PyLongObject*) v)->ob_digit[i - 1];
+    }
+    *out = Py_SIZE(v) < 0 ? -(int64_t) magnitude : (int64_t) magnitude;
+    return 1;
+}
+
+// INT64_MIN means "see native_take_boxed" (so INT64_MIN itself goes that way too)
+int64_t native_unbox_int(PyObject* v) {
+    int64_t value;
+    if (long_as_int64(v, &value)) {
+        Py_DECREF(v);
+        return value;
+    }
+    native_keep(v);
+    return INT64_MIN;
+}
+
+// NaN means "see native_take_boxed" (which returns NULL if the result really was NaN)
+double native_unbox_float(PyObject* v) {
+    if (Py_TYPE(v) == &PyFloat_Type) {
+        double value = ((PyFloatObject*) v)->ob_fval;
+        Py_DECREF(v);
+        return value;
+    }
+    native_keep(v);
+    return NAN;
+}
+
+
+/*
+Unboxed ints, for locals which the compiler has proven are always ints (see PythonModule.apply_unboxing_optimisation).
+They're kept in i64 wasm locals, tagged: an int x which fits in 62 bits is x << 1, and anything else (a bigger int,
+or in fact any object at all) is its pointer, (ptr << 1) | 1, which owns a reference.
+So arithmetic on small ints is done directly on the tagged values (they're all even, which addition and so on
+preserve), and anything that overflows, or isn't small, goes the usual way, through the PyObject functions.
+The compiler does the small int cases inline (see generate_code.UNBOXED_INT_FAST_PATHS), and only calls these for
+the rest, so these have to handle everything.
+*/
+
+#define UNBOXED_IS_SMALL(t) (((t) & 1) == 0)
+#define UNBOXED_BOTH_SMALL(a, b) ((((a) | (b)) & 1) == 0)
+#define UNBOXED_POINTER(t) ((PyObject*) (uintptr_t) ((uint64_t) (t) >> 1))
+#define UNBOXED_MIN (-((int64_t) 1 << 62))
+#define UNBOXED_MAX (((int64_t) 1 << 62) - 1)
+
+PyObject* add_pyobject(PyObject* a, PyObject* b);
+PyObject* subtract_pyobject(PyObject* a, PyObject* b);
+PyObject* mul_pyobject(PyObject* a, PyObject* b);
+PyObject* rem_pyobject(PyObject* a, PyObject* b);
+PyObject* floor_div_pyobject(PyObject* a, PyObject* b);
+PyObject* div_pyobject(PyObject* a, PyObject* b);
+PyObject* and_pyobject(PyObject* a, PyObject* b);
+PyObject* or_pyobject(PyObject* a, PyObject* b);
+int lt_pyobject(PyObject* a, PyObject* b);
+int lte_pyobject(PyObject* a, PyObject* b);
+int eq_pyobject(PyObject* a, PyObject* b);
+int neq_pyobject(PyObject* a, PyObject* b);
+int gt_pyobject(PyObject* a, PyObject* b);
+int gte_pyobject(PyObject* a, PyObject* b);
+
+// takes the reference
+PyObject* unboxed_box(int64_t t) {
+    if (UNBOXED_IS_SMALL(t)) {
+        return native_box_int(t >> 1);
+    }
+    return UNBOXED_POINTER(t);
+}
+
+// takes the reference
+int64_t unboxed_from(PyObject* v) {
+    int64_t value;
+    if (long_as_int64(v, &value) && value >= UNBOXED_MIN && value <= UNBOXED_MAX) {
+        Py_DECREF(v);
+        return value << 1;
+    }
+    return ((int64_t) (uintptr_t) v << 1) | 1;
+}
+
+int64_t unboxed_incref(int64_t t) {
+    if (!UNBOXED_IS_SMALL(t)) {
+        Py_INCREF(UNBOXED_POINTER(t));
+    }
+    return t;
+}
+
+void unboxed_decref(int64_t t) {
+    if (!UNBOXED_IS_SMALL(t)) {
+        Py_DECREF(UNBOXED_POINTER(t));
+    }
+}
+
+#define UNBOXED_SLOW_PATH(function, a, b) unboxed_from(function(unboxed_box(a), unboxed_box(b)))
+
+int64_t unboxed_add(int64_t a, int64_t b) {
+    int64_t r;
+    if (UNBOXED_BOTH_SMALL(a, b) && !__builtin_add_overflow(a, b, &r)) {
+        return r;
+    }
+    return UNBOXED_SLOW_PATH(add_pyobject, a, b);
+}
+
+int64_t unboxed_sub(int64_t a, int64_t b) {
+    int64_t r;
+    if (UNBOXED_BOTH_SMALL(a, b) && !__builtin_sub_overflow(a, b, &r)) {
+        return r;
+    }
+    return UNBOXED_SLOW_PATH(subtract_pyobject, a, b);
+}
+
+int64_t unboxed_mul(int64_t a, int64_t b) {
+    int64_t r;
+    // (x << 1) * y == (x * y) << 1
+    if (UNBOXED_BOTH_SMALL(a, b) && !__builtin_mul_overflow(a >> 1, b, &r)) {
+        return r;
+    }
+    return UNBOXED_SLOW_PATH(mul_pyobject, a, b);
+}
+
+// (dividing by zero goes the slow way, so that it fails the same way it always does)
+int64_t unboxed_mod(int64_t a, int64_t b) {
+    if (UNBOXED_BOTH_SMALL(a, b) && b != 0) {
+        int64_t x = a >> 1, y = b >> 1;
+        int64_t r = x % y;
+        // python's remainder has the sign of the divisor
+        if (r != 0 && ((r < 0) != (y < 0))) {
+            r += y;
+        }
+        return r << 1;
+    }
+    return UNBOXED_SLOW_PATH(rem_pyobject, a, b);
+}
+
+int64_t unboxed_floor_div(int64_t a, int64_t b) {
+    if (UNBOXED_BOTH_SMALL(a, b) && b != 0) {
+        int64_t x = a >> 1, y = b >> 1;
+        int64_t q = x / y;
+        // and rounds towards negative infinity
+        if (x % y != 0 && ((x < 0) != (y < 0))) {
+            q--;
+        }
+        // (the only way out of range is UNBOXED_MIN // -1)
+        if (q <= UNBOXED_MAX) {
+            return q << 1;
+        }
+    }
+    return UNBOXED_SLOW_PATH(floor_div_pyobject, a, b);
+}
+
+int64_t unboxed_and(int64_t a, int64_t b) {
+    if (UNBOXED_BOTH_SMALL(a, b)) {
+        return a & b;
+    }
+    return UNBOXED_SLOW_PATH(and_pyobject, a, b);
+}
+
+int64_t unboxed_or(int64_t a, int64_t b) {
+    if (UNBOXED_BOTH_SMALL(a, b)) {
+        return a | b;
+    }
+    return UNBOXED_SLOW_PATH(or_pyobject, a, b);
+}
+
+#define UNBOXED_COMPARE(name, op, slow) int name(int64_t a, int64_t b) { \
+    if (UNBOXED_BOTH_SMALL(a, b)) {                                       \
+        return a op b;                                                    \
+    }                                                                     \
+    return slow(unboxed_box(a), unboxed_box(b));                          \
+}
+
+UNBOXED_COMPARE(unboxed_lt, <, lt_pyobject)
+UNBOXED_COMPARE(unboxed_lte, <=, lte_pyobject)
+UNBOXED_COMPARE(unboxed_eq, ==, eq_pyobject)
+UNBOXED_COMPARE(unboxed_neq, !=, neq_pyobject)
+UNBOXED_COMPARE(unboxed_gt, >, gt_pyobject)
+UNBOXED_COMPARE(unboxed_gte, >=, gte_pyobject)
+
+
+/*
+Unboxed floats: locals which are always floats are kept in f64 wasm locals, as they are. Adding, subtracting,
+multiplying and comparing them is done inline (see CodeGenerator.compile_instruction), and the rest is here.
+Ints get promoted to floats on the way in, the same way python does it.
+*/
+
+// takes the reference
+double unboxed_float_from(PyObject* v) {
+    // (bools are ints too)
+    double value = PyLong_Check(v) ? PyLong_AsDouble(v) : PyFloat_AsDouble(v);
+    Py_DECREF(v);
+    return value;
+}
+
+double unboxed_int_to_float(int64_t t) {
+    if (UNBOXED_IS_SMALL(t)) {
+        return (double) (t >> 1);
+    }
+    return unboxed_float_from(UNBOXED_POINTER(t));
+}
+
+// int / int, which is a float
+double unboxed_true_div(int64_t a, int64_t b) {
+    // if both fit in a double exactly, dividing them is exact too (or rather, correctly rounded)
+    const int64_t exact = (int64_t) 1 << DBL_MANT_DIG;
+    if (UNBOXED_BOTH_SMALL(a, b) && b != 0) {
+        int64_t x = a >> 1, y = b >> 1;
+        if (-exact <= x && x <= exact && -exact <= y && y <= exact) {
+            return (double) x / (double) y;
+        }
+    }
+    return unboxed_float_from(div_pyobject(unboxed_box(a), unboxed_box(b)));
+}
+
+double unboxed_float_div(double a, double b) {
+    if (b == 0.0) {
+        PyErr_SetString(PyExc_ZeroDivisionError, "float division by zero");
+    }
+    return a / b;
+}
+
+// (these two are float_rem and _float_div_mod from floatobject.c)
+double unboxed_float_mod(double a, double b) {
+    if (b == 0.0) {
+        PyErr_SetString(PyExc_ZeroDivisionError, "float modulo");
+    }
+    double mod = fmod(a, b);
+    if (mod) {
+        if ((b < 0) != (mod < 0)) {
+            mod += b;
+        }
+    } else {
+        mod = copysign(0.0, b);
+    }
+    return mod;
+}
+
+double unboxed_float_floor_div(double a, double b) {
+    if (b == 0.0) {
+        PyErr_SetString(PyExc_ZeroDivisionError, "float divmod()");
+    }
+    double mod = fmod(a, b);
+    double div = (a - mod) / b;
+    if (mod && ((b < 0) != (mod < 0))) {
+        div -= 1.0;
+    }
+    if (div) {
+        double floordiv = floor(div);
+        if (div - floordiv > 0.5) {
+            floordiv += 1.0;
+        }
+        return floordiv;
+    }
+    return copysign(0.0, a / b);
+}
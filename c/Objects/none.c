@@ -119,8 +119,9 @@ PyTypeObject PyNone_Type = {
 //        none_new,           /*tp_new */
 };
 
+// (immortal, like the constant pool: uninitialised locals and globals point at it without holding a reference)
 PyObject _Py_NoneStruct = {
-        1, &PyNone_Type
+        IMMORTAL_REFCNT, &PyNone_Type
 };
 
 PyObject* return_none() {
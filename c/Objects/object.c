@@ -3,12 +3,49 @@
 #include "cpython/longintrepr.h"
 #include "cpython/longobject.h"
 #include "cpython/noneobject.h"
+#include "cpython/floatobject.h"
+#include "cpython/tupleobject.h"
 
+#include <malloc.h>
 #include <stdio.h>
 #include <stdlib.h>
 
 unsigned int created_objects = 0;
 
+HeapStats heap_stats[HEAP_STATS_TYPES];
+
+unsigned char const_pool[CONST_POOL_SIZE] __attribute__((aligned(8)));
+
+// the same as get_type, but with 0 instead of -1 for unknown types, so it can be used as an index
+static inline int heap_stats_index(PyObject* op) {
+    if (op->type == &PyLong_Type) return 1;
+    if (op->type == &PyTuple_Type) return 2;
+    if (op->type == &PyBool_Type) return 3;
+    if (op->type == &PyNone_Type) return 4;
+    if (op->type == &PyFloat_Type) return 5;
+    return 0;
+}
+
+// called whenever a new object is set up (see _PyObject_Init).
+// bytes are counted as whatever malloc actually handed out, since that's what'll be given back when it's freed
+// (an object's own idea of its size can change, e.g. when a long is normalised)
+void heap_stats_alloc(PyObject* op) {
+    HeapStats* stats = &heap_stats[heap_stats_index(op)];
+    stats->live++;
+    stats->allocations++;
+    stats->bytes_in_use += malloc_usable_size(op);
+}
+
+static inline void heap_stats_free(PyObject* op) {
+    HeapStats* stats = &heap_stats[heap_stats_index(op)];
+    stats->live--;
+    stats->bytes_in_use -= malloc_usable_size(op);
+}
+
+HeapStats* get_heap_stats(void) {
+    return heap_stats;
+}
+
 //void py_set_local_decref(PyObject *value, PyObject *old)
 //{
 //    if (op != NULL) {
@@ -23,12 +60,15 @@ PyObject* free_list_head_16 = NULL;
 PyObject* free_list_head_18 = NULL;
 
 inline void* py_malloc(int size) {
+    // (only longs go on the free lists)
     if ((size == 16 || size == 14) && free_list_head_16 != NULL) {
+        heap_stats[1].free_list_hits++;
         PyObject* tmp = free_list_head_16;
         free_list_head_16 = (PyObject*)free_list_head_16->refCount;
         return tmp;
     }
     if (size == 18 && free_list_head_18 != NULL) {
+        heap_stats[1].free_list_hits++;
         PyObject* tmp = free_list_head_18;
         free_list_head_18 = (PyObject*)free_list_head_18->refCount;
         return tmp;
@@ -40,6 +80,12 @@ inline void* py_malloc(int size) {
 
 inline void py_decref(PyObject* a) {
     if (--a->refCount == 0) {
+        if ((unsigned char*) a >= const_pool && (unsigned char*) a < const_pool + CONST_POOL_SIZE) {
+            // a constant, which has been decref'd a lot of times. It's immortal, so start again
+            a->refCount = IMMORTAL_REFCNT;
+            return;
+        }
+        heap_stats_free(a);
         // question: how big is this object? If it isn't a PyVarObject we can't tell
         // dumb workaround: check the type, only add ints to the free list
         if (a->type == &PyLong_Type) {
@@ -58,6 +58,7 @@ Short* new_short(int a) {
         created_objects++;
         ptr->Base.type = &SHORT;
         ptr->Base.refCount = 1;
+        heap_stats_alloc((PyObject*) ptr);
         ptr->value = a;
     }
     return ptr;
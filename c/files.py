@@ -37,6 +37,7 @@ files = [
     "first",
     "second",
     "_Py_NoneStruct",  # fun fact: this isn't a file, it's the actual struct
+    "_Py_TrueStruct", "_Py_FalseStruct",
     "return_none",
     "flow_control_example",
     "raise_name_error",
@@ -48,6 +49,28 @@ files = [
     # for extracting values
     "get_type",
 
+    # stats
+    "get_heap_stats",
+
+    # marshalling (see marshal.c)
+    "marshal_return", "get_marshal_area", "marshal_alloc", "marshal_free", "unmarshal_args",
+
+    # native exports (see native.c)
+    "native_box_int", "native_unbox_int", "native_unbox_float", "native_take_boxed",
+
+    # unboxed ints (see native.c)
+    "unboxed_box", "unboxed_from", "unboxed_incref", "unboxed_decref",
+    "unboxed_add", "unboxed_sub", "unboxed_mul", "unboxed_mod", "unboxed_floor_div", "unboxed_and", "unboxed_or",
+    "unboxed_lt", "unboxed_lte", "unboxed_eq", "unboxed_neq", "unboxed_gt", "unboxed_gte",
+    "unboxed_float_from", "unboxed_int_to_float", "unboxed_true_div",
+    "unboxed_float_div", "unboxed_float_mod", "unboxed_float_floor_div",
+
+    # buffers (see bufferobject.c)
+    "PyBuffer_New", "PyBuffer_Data",
+
+    # for laying out constants (see CodeGenerator.static_const)
+    "const_pool", "PyLong_Type", "PyFloat_Type", "PyTuple_Type",
+
     # float stuff
     "PyFloat_FromDouble", "PyFloat_AsDouble",
     "add_float",
@@ -0,0 +1,114 @@
+# vectorised calls: func.batch(*columns) calls a compiled function once per row of its argument columns, and
+# func.map(column) does the same for functions of one argument.
+# for functions with a native export, the columns are copied into linear memory in one go, a loop in wasm
+# (see CodeGenerator.batch_export) calls the function on every row, and the results come back as an array.array,
+# again in one go. Everything else just gets called in a loop from python.
+import array
+from functools import partial
+
+import marshalling
+from run_wasm import fixed_exports, flush_output
+from specialise import native_signature
+
+# what the native exports take and return, as array.array/memoryview typecodes
+TYPECODES = {int: 'q', float: 'd'}
+# the formats a buffer can already be in, and be copied across as is
+FORMATS = {int: ('q', 'l', '<q', '<l', '=q', '=l'), float: ('d', '<d', '=d')}
+ITEM_SIZE = 8
+
+
+def as_buffer(column, scalar):
+    # a flat view of the column's bytes, as the i64s/f64s the loop expects. If it isn't already, it gets converted
+    try:
+        view = memoryview(column)
+    except TypeError:
+        view = None
+    if view is not None and view.ndim == 1 and view.format in FORMATS[scalar] and view.itemsize == ITEM_SIZE \
+            and view.c_contiguous:
+        return view.cast('B')
+    return memoryview(array.array(TYPECODES[scalar], column)).cast('B')
+
+
+def python_batch(wrapper, *columns):
+    return [wrapper(*row) for row in zip(*columns)]
+
+
+def native_batch(exports, instance, loop, params, result, *columns):
+    if len(columns) != len(params):
+        raise TypeError(f'batch() takes {len(params)} columns but {len(columns)} were given')
+    buffers = [as_buffer(column, scalar) for column, scalar in zip(columns, params)]
+    size = len(buffers[0]) if buffers else 0
+    if any(len(buffer) != size for buffer in buffers):
+        raise ValueError('batch() columns must all be the same length')
+    count = size // ITEM_SIZE
+    results = array.array(TYPECODES[result])
+    if not count:
+        return results
+
+    # one allocation for all the columns, with the output after them
+    ptr = exports.marshal_alloc(size * (len(buffers) + 1))
+    try:
+        memory = memoryview(exports.memory.buffer)
+        pointers = [ptr + j * size for j in range(len(buffers) + 1)]
+        for pointer, buffer in zip(pointers, buffers):
+            memory[pointer:pointer + size] = buffer
+
+        # results that couldn't be unboxed (see native.c), by index
+        boxed = {}
+        start = 0
+        while True:
+            try:
+                start = loop(*pointers, start, count)
+            except RuntimeError:
+                if getattr(instance, 'reset_on_trap', False):
+                    # (the reset frees everything for us)
+                    ptr = None
+                    instance.reset()
+                raise
+            finally:
+                flush_output()
+            if start == count:
+                break
+            value = exports.native_take_boxed()
+            if value:
+                # (native_take_boxed handed us its reference, which read_return releases)
+                boxed[start] = marshalling.read_return(exports, value)
+            start += 1
+
+        # (after the loop, which might have grown the memory)
+        out = pointers[-1]
+        results.frombytes(memoryview(exports.memory.buffer)[out:out + size])
+    finally:
+        if ptr is not None:
+            exports.marshal_free(ptr)
+
+    if not boxed:
+        return results
+    # some results don't fit in the array, so it has to be a list
+    results = results.tolist()
+    for i, value in boxed.items():
+        results[i] = value
+    return results
+
+
+def single_column(batch, column):
+    return batch(column)
+
+
+def add_batch_api(wrapper, func, func_name, instance):
+    exports = fixed_exports(instance)
+    signature = native_signature(func)
+    batch = None
+    if exports is not None and signature is not None:
+        try:
+            loop = getattr(exports, f'__{func_name}_batch')
+        except (AttributeError, LookupError):
+            pass
+        else:
+            batch = partial(native_batch, exports, instance, loop, *signature)
+    if batch is None:
+        batch = partial(python_batch, wrapper)
+
+    wrapper.batch = batch
+    wrapper.map = partial(single_column, batch)
+    return wrapper
@@ -0,0 +1,69 @@
+# buffers: arrays of numbers that live in linear memory (see c/Objects/bufferobject.c).
+# python fills them in and reads them back through a memoryview, and compiled code indexes into them, so bulk data
+# gets in and out without being copied, or boxed an item at a time (only the items that get indexed are boxed).
+from run_wasm import fixed_exports
+
+# the formats a buffer can have (struct/array.array typecodes), and the size of their items
+ITEM_SIZES = {'B': 1, 'i': 4, 'q': 8, 'd': 8}
+
+
+class Buffer:
+    # passed to a compiled function, it arrives as the runtime's buffer object, by reference.
+    # it stays alive until release() (compiled code keeps its own references, like anything else).
+    # resetting the instance (see run_wasm.ResettableInstance) frees it too, after which it can't be used any more
+    def __init__(self, instance, length: int, format: str = 'B'):
+        if format not in ITEM_SIZES:
+            raise ValueError(f'unsupported buffer format {format!r} (expected one of {", ".join(ITEM_SIZES)})')
+        if length < 0:
+            raise ValueError('buffer length must not be negative')
+        exports = fixed_exports(instance)
+        if exports is None:
+            # (the buffer has to stay in one instance's memory)
+            raise ValueError('buffers need an instance whose exports are fixed, i.e. not tiered or pooled')
+
+        self.exports = exports
+        self.instance = instance
+        # (which reset of the instance we were made after, see ResettableInstance.generation)
+        self.generation = getattr(instance, 'generation', None)
+        self.format = format
+        self.length = length
+        self.nbytes = length * ITEM_SIZES[format]
+        self.ptr = exports.PyBuffer_New(length, ord(format))
+        self.data = exports.PyBuffer_Data(self.ptr)
+
+    @property
+    def reset(self) -> bool:
+        # whether the instance has been reset since, which freed the buffer
+        return getattr(self.instance, 'generation', None) != self.generation
+
+    @property
+    def pointer(self) -> int:
+        # the runtime's buffer object, as long as it's still there
+        if self.ptr is None:
+            raise ValueError('buffer has been released')
+        if self.reset:
+            raise ValueError('buffer was freed when its instance was reset')
+        return self.ptr
+
+    @property
+    def view(self) -> memoryview:
+        # a writable view of the items. It's a new one each time, since wasm can grow (and move) the memory,
+        # so don't hold on to it across calls
+        self.pointer
+        memory = memoryview(self.exports.memory.buffer)
+        return memory[self.data:self.data + self.nbytes].cast(self.format)
+
+    def __len__(self):
+        return self.length
+
+    def release(self):
+        # (if the instance has been reset, the buffer has gone already, and something else might be there now)
+        if self.ptr is not None and not self.reset:
+            self.exports.py_decref(self.ptr)
+            self.ptr = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
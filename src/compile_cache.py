@@ -0,0 +1,126 @@
+# on-disk cache for compiled modules, keyed on everything that can change the generated wasm:
+# the python functions themselves, the C runtime they get merged into, the compiler source and its options.
+# a warm start reads the bytes back and goes straight to instantiation, skipping codegen, wat2wasm and wasm-opt.
+import hashlib
+import os
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from types import CodeType
+
+
+def _default_cache_dir() -> str:
+    # the user's cache directory, so it doesn't matter where python was started from
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'wasm-py')
+
+
+CACHE_DIR = os.environ.get('WASM_PY_CACHE_DIR') or _default_cache_dir()
+# turns the cache off everywhere, whatever use_cache says (WASM_PY_CACHE=0 does the same from outside)
+ENABLED = os.environ.get('WASM_PY_CACHE', '1') != '0'
+
+# bump this if the key format changes in a way that the source hash wouldn't pick up
+CACHE_VERSION = 1
+
+# every file that has a say in what gets generated
+_src_dir = Path(__file__).parent
+COMPILER_SOURCES = [
+    _src_dir / 'compile_cache.py',
+    _src_dir / 'generate_code.py',
+    _src_dir / 'parse_wat.py',
+    _src_dir / 'profiles.py',
+    _src_dir / 'specialise.py',
+    _src_dir / 'wasm_binary.py',
+    *sorted((_src_dir / 'opt').glob('*.py')),
+]
+
+
+@lru_cache(maxsize=None)
+def _hash_file(path, mtime_ns, size) -> str:
+    # mtime and size are only there to invalidate the lru_cache if the file is rebuilt mid-process
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def hash_file(path) -> str:
+    stat = os.stat(path)
+    return _hash_file(str(path), stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=None)
+def compiler_hash() -> str:
+    h = hashlib.sha256()
+    for path in COMPILER_SOURCES:
+        h.update(path.name.encode())
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def _code_fingerprint(code: CodeType) -> tuple:
+    # deliberately leaves out filenames and line numbers -- moving a function around shouldn't cause a recompile
+    return (
+        code.co_name,
+        code.co_code,
+        code.co_argcount,
+        code.co_nlocals,
+        code.co_names,
+        code.co_varnames,
+        tuple(
+            _code_fingerprint(const) if isinstance(const, CodeType) else (type(const).__name__, repr(const))
+            for const in code.co_consts
+        ),
+    )
+
+
+def _func_fingerprint(func, name) -> tuple:
+    # annotations feed into static typing (see Analyzer.to_tree), so they're part of the key too
+    annotations = getattr(func, '__annotations__', {})
+    return (
+        name,
+        _code_fingerprint(func.__code__),
+        tuple(sorted((k, repr(v)) for k, v in annotations.items())),
+    )
+
+
+def cache_key(funcs, runtime_path, **options) -> str:
+    # funcs is a list of (function, name) pairs, in the order they're added to the module
+    # (order matters: it decides function and table indices)
+    h = hashlib.sha256()
+    h.update(repr((
+        CACHE_VERSION,
+        compiler_hash(),
+        hash_file(runtime_path),
+        tuple(sorted(options.items())),
+        tuple(_func_fingerprint(func, name) for func, name in funcs),
+    )).encode())
+    return h.hexdigest()
+
+
+def _path_for(key, suffix):
+    return Path(CACHE_DIR) / key[:2] / f'{key}{suffix}'
+
+
+def load(key, suffix='.wasm'):
+    if not ENABLED:
+        return None
+    try:
+        return _path_for(key, suffix).read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+def store(key, data: bytes, suffix='.wasm'):
+    if not ENABLED:
+        return
+    path = _path_for(key, suffix)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # write to a temp file and rename it into place, so that a concurrent reader (or a crash halfway through)
+    # never sees a partially written entry
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
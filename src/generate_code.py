@@ -1,3 +1,4 @@
+import struct
 from functools import lru_cache
 from itertools import chain
 from types import FunctionType, CodeType
@@ -5,11 +6,59 @@ from types import FunctionType, CodeType
 import opt.py_module, opt.main
 import parse_wat
 import run_wasm
+from specialise import native_signature
 from opt.cfg import NiceCFG
 from parse_wat import Func, KeywordLiteral as Instruction
+from profiles import get_profile
 import dis
 from typing import Optional
 
+RUNTIME_PATH = 'c/build/emcc/add2.wasm'
+
+# the wasm types used for annotated scalars by native exports
+NATIVE_TYPES = {int: 'i64', float: 'f64'}
+
+# the wasm types of unboxed locals (see PythonModule.apply_unboxing_optimisation)
+UNBOXED_TYPES = {'int': 'i64', 'float': 'f64'}
+FLOAT_COMPARISONS = {'<': 'lt', '<=': 'le', '==': 'eq', '!=': 'ne', '>': 'gt', '>=': 'ge'}
+INT_COMPARISONS = {'lt': 'lt_s', 'lte': 'le_s', 'eq': 'eq', 'neq': 'ne', 'gt': 'gt_s', 'gte': 'ge_s'}
+
+# unboxed ints which are small (tagged x << 1, see native.c) are worked on inline. For each operation:
+# a guard on the operands (as well as them both being small), the result, and a check that the result is right
+# (i.e. it didn't overflow). The operands are in locals {a} and {b}, and {r} is free.
+# if the guard or the check fails, it's the runtime's unboxed_* function instead, which does the rest
+UNBOXED_INT_FAST_PATHS = {
+    # (an overflow gives a result whose sign is different to both operands')
+    'add': ('', 'local.get {a} local.get {b} i64.add',
+            'local.get {a} local.get {r} i64.xor local.get {b} local.get {r} i64.xor i64.and i64.const 0 i64.ge_s'),
+    'sub': ('', 'local.get {a} local.get {b} i64.sub',
+            'local.get {a} local.get {b} i64.xor local.get {a} local.get {r} i64.xor i64.and i64.const 0 i64.ge_s'),
+    # x * (y << 1) == (x * y) << 1, which can't overflow if x and y << 1 both fit in 32 bits
+    'mul': ('local.get {a} i64.const 1 i64.shr_s local.tee {r} i32.wrap_i64 i64.extend_i32_s local.get {r} i64.eq '
+            'local.get {b} i32.wrap_i64 i64.extend_i32_s local.get {b} i64.eq i32.and',
+            'local.get {a} i64.const 1 i64.shr_s local.get {b} i64.mul', ''),
+    # python's remainder has the sign of the divisor (and dividing by zero goes the slow way, to fail the usual way)
+    'mod': ('local.get {b} i64.const 0 i64.ne',
+            'local.get {a} i64.const 1 i64.shr_s local.get {b} i64.const 1 i64.shr_s i64.rem_s local.set {r} '
+            'local.get {r} local.get {b} i64.const 1 i64.shr_s i64.add local.get {r} '
+            'local.get {r} i64.const 0 i64.ne local.get {r} local.get {b} i64.xor i64.const 0 i64.lt_s i32.and select '
+            'i64.const 1 i64.shl', ''),
+    # and division rounds towards negative infinity. (dividing by -1 goes the slow way, since it can overflow)
+    'floor_div': ('local.get {b} i64.const 0 i64.ne local.get {b} i64.const -2 i64.ne i32.and',
+                  'local.get {a} i64.const 1 i64.shr_s local.get {b} i64.const 1 i64.shr_s i64.div_s '
+                  'local.get {a} i64.const 1 i64.shr_s local.get {b} i64.const 1 i64.shr_s i64.rem_s '
+                  'i64.const 0 i64.ne '
+                  'local.get {a} local.get {b} i64.xor i64.const 0 i64.lt_s i32.and i64.extend_i32_u i64.sub '
+                  'i64.const 1 i64.shl', ''),
+    'and': ('', 'local.get {a} local.get {b} i64.and', ''),
+    'or': ('', 'local.get {a} local.get {b} i64.or', ''),
+    **{name: ('', f'local.get {{a}} local.get {{b}} i64.{op}', '') for name, op in INT_COMPARISONS.items()},
+}
+
+# the runtime's constant pool (see object.h), which has to be the same size as CONST_POOL_SIZE there
+CONST_POOL_SIZE = 16384
+IMMORTAL_REFCNT = 1 << 30
+
 
 def func(
         args: list[str],
@@ -17,6 +66,7 @@ def func(
         instructions: list[Instruction],
         local_arg_count: int = 0,
         export: Optional[str] = None,
+        local_types: list[str] = (),
 ) -> Func:
     children = []
     if export:
@@ -27,6 +77,8 @@ def func(
     if local_arg_count:
         locals_str = f'(local {"i32 " * local_arg_count})'
         children.append(locals_str)
+    if local_types:
+        children.append(f'(local {" ".join(local_types)})')
     children.extend(instructions)
     return Func(
         children=children,
@@ -35,9 +87,11 @@ def func(
 
 
 class CodeGenerator:
-    def __init__(self, path='c/build/emcc/add2.wasm'):
+    def __init__(self, path=RUNTIME_PATH, profile=None):
         self.path = path
-        self.wasm_module = parse_wat.load(path)
+        self.profile = get_profile(profile)
+        # the runtime is parsed once and shared, so we work on our own copy
+        self.wasm_module = parse_wat.load_template(path).clone()
         self.py_module = opt.py_module.PythonModule()
         self.builtin_names = {
             'abs': 'abs_pyobject',
@@ -50,11 +104,16 @@ class CodeGenerator:
             'pow': 'bin_pow_pyobject',
             'pow_mod': 'tri_pow_pyobject',
         }
+        # constants laid out so far (see static_const), and their addresses
+        self.const_pool = bytearray()
+        self.const_addresses = {}
 
-    def compile(self, save_name=None, optimise=True):
+    def compile(self, save_name=None, optimise=True, backend='binary', linked=False):
+        # (optimise=False skips wasm-opt, whatever the profile says)
         self.py_module.analyse()
         # generate a wasm global for each global
-        for global_name in chain(self.py_module.all_globals, self.builtin_names):
+        # (sorted, since set order depends on the hash seed, and the output should be the same every time)
+        for global_name in chain(sorted(self.py_module.all_globals), self.builtin_names):
             glob = self.wasm_module.add_global(global_name)
             glob.mutated = global_name in self.py_module.mutated_globals
 
@@ -70,8 +129,12 @@ class CodeGenerator:
             self.wasm_module.add_func(wasm_func, name)
             self.wasm_module.add_func_to_table(name)  # make the func globally accessible
             self.wasm_module.add_func(self.function_wrapper(cfg.func.__code__, name), f'__{name}_wrapper')
+            native = self.native_export(cfg, name)
+            if native is not None:
+                self.wasm_module.add_func(native, f'__{name}_native')
+                self.wasm_module.add_func(self.batch_export(cfg.func, name), f'__{name}_batch')
 
-        for glob in map(self.wasm_module.get_global_by_name, chain(self.py_module.all_globals, self.builtin_names)):
+        for glob in map(self.wasm_module.get_global_by_name, chain(sorted(self.py_module.all_globals), self.builtin_names)):
             if glob.func_name in self.wasm_module.funcs_by_name:
                 # populate the global with the table index of the function
                 value = self.wasm_module.get_table_entry_by_name(glob.func_name)
@@ -84,7 +147,16 @@ class CodeGenerator:
                 value = self.wasm_module.get_global_by_name('_Py_NoneStruct').children[1].children[0]
             self.wasm_module.set_global_value(glob.func_name, value)
 
-        return self.wasm_module.compile(save_name, optimise)
+        if self.const_pool:
+            self.wasm_module.add_data(self.runtime_address('const_pool'), bytes(self.const_pool))
+
+        return self.wasm_module.compile(save_name, optimise, backend, linked, self.profile)
+
+    def is_function_global(self, name):
+        # globals which start out as functions hold table indices rather than PyObjects, so they're left out of
+        # reference counting. Any other global holds a reference to its value
+        return (name in self.py_module.cfgs or name in self.builtin_names
+                or name in self.wasm_module.funcs_by_name)
 
     def add_rotation_funcs(self):
         # they're not very efficient, but they'll be inlined by wasm-opt
@@ -131,33 +203,160 @@ class CodeGenerator:
         self.wasm_module.add_func(dup_top, '__internal_dup_top')
         self.wasm_module.add_func(dup_top_two, '__internal_dup_top_two')
 
+    def runtime_address(self, name) -> int:
+        # the address of one of the runtime's exported variables
+        return self.wasm_module.get_global_by_name(name).children[1].children[0]
+
+    def static_const(self, value) -> Optional[int]:
+        # lays value out in the runtime's constant pool as an immortal object (see object.h), returning its address.
+        # each constant is only laid out once per module. returns None if the pool is full
+        if value is None:
+            return self.runtime_address('_Py_NoneStruct')
+        # bools are ints too, but they have to be the real True and False
+        if value is True:
+            return self.runtime_address('_Py_TrueStruct')
+        if value is False:
+            return self.runtime_address('_Py_FalseStruct')
+        # (the type is part of the key, so that e.g. 1 and 1.0 aren't the same constant)
+        key = (type(value), repr(value))
+        if key in self.const_addresses:
+            return self.const_addresses[key]
+
+        if isinstance(value, int):
+            magnitude = abs(value)
+            digits = []
+            while magnitude:
+                digits.append(magnitude & 0x7fff)  # PyLong_SHIFT is 15
+                magnitude >>= 15
+            size = -len(digits) if value < 0 else len(digits)
+            # (a PyLongObject always has room for at least one digit)
+            obj = struct.pack(f'<iIi{max(len(digits), 1)}H', IMMORTAL_REFCNT, self.runtime_address('PyLong_Type'),
+                              size, *(digits or [0]))
+        elif isinstance(value, float):
+            obj = struct.pack('<iId', IMMORTAL_REFCNT, self.runtime_address('PyFloat_Type'), value)
+        elif isinstance(value, tuple):
+            items = [self.static_const(item) for item in value]
+            if None in items:
+                return None
+            obj = struct.pack(f'<iIi{max(len(items), 1)}I', IMMORTAL_REFCNT, self.runtime_address('PyTuple_Type'),
+                              len(items), *(items or [0]))
+        else:
+            raise NotImplementedError(f'consts of type {type(value)} have not been implemented!')
+
+        obj += bytes(-len(obj) % 8)  # (floats need 8 byte alignment)
+        if len(self.const_pool) + len(obj) > CONST_POOL_SIZE:
+            return None
+        address = self.runtime_address('const_pool') + len(self.const_pool)
+        self.const_pool += obj
+        self.const_addresses[key] = address
+        return address
+
     def add_to_module(self, function: FunctionType, name: str):
         # current method: compile it to wasm, then add it.
         # new method: collect all functions first, then compile them all at once.
         self.py_module.add_function(function, name)
 
-    def func_to_wasm(self, name: str, cfg: NiceCFG):
+    def func_to_wasm(self, name: str, cfg: NiceCFG, native=False):
+        # native compiles the function as its native export instead (see native_export)
         instructions, jump_table = cfg.flatten()
         # pprint.pprint(instructions)
         # print(len(instructions))
         local_count = cfg.func.__code__.co_nlocals
-        instructions = [self._compile_instruction(i, jump_table, local_count) for i in instructions]
+        # locals which are kept unboxed (see PythonModule.apply_unboxing_optimisation) get an extra i64 or f64
+        # local. arguments still arrive boxed, so they're unboxed on the way in
+        unboxed_locals = getattr(cfg, 'unboxed_locals', {})
+        if native:
+            # (or as plain i64s, which only need tagging)
+            prologue = [self.unboxed_from_native(n, slot) for n, (slot, kind) in unboxed_locals.items()
+                        if n < cfg.func.__code__.co_argcount]
+            native_returns = {self.returned_by(i) for i in instructions if getattr(i, 'opname', None) == 'RETURN_VALUE'}
+            native_returns = {i for i in native_returns if getattr(i, 'convert', None) == ('int', None)}
+        else:
+            prologue = [
+                Instruction(f'local.get {n} call {self.wasm_module.get_func_index_by_name("unboxed_from")} '
+                            f'local.set {slot}\n')
+                for n, (slot, kind) in unboxed_locals.items()
+                if n < cfg.func.__code__.co_argcount
+            ]
+            native_returns = None
+        instructions = prologue + [
+            self._compile_instruction(i, jump_table, local_count, unboxed_locals, native_returns) for i in instructions
+        ]
         # print(len(instructions))
+        # every path ends in a return, but a loop scope can close after the last one,
+        # which leaves the end of the function looking reachable (with nothing on the stack)
+        instructions.append(Instruction('unreachable'))
 
         return func(
-            args=['i32'] * cfg.func.__code__.co_argcount,
-            return_type='i32',
+            args=['i64' if native else 'i32'] * cfg.func.__code__.co_argcount,
+            return_type='i64' if native else 'i32',
             instructions=instructions,
             local_arg_count=cfg.func.__code__.co_nlocals - cfg.func.__code__.co_argcount,
-            export=name,
+            export=f'__{name}_native' if native else name,
+            # (plus the scratch locals for unboxed_int_op)
+            local_types=[UNBOXED_TYPES[kind] for _slot, kind in sorted(unboxed_locals.values())]
+                        + ['i64'] * 3 * bool(unboxed_locals),
         )
 
-    def _compile_instruction(self, i, jump_table, local_count):
+    def unboxed_int_op(self, op_name, scratch):
+        # an operation on two unboxed ints (see UNBOXED_INT_FAST_PATHS), given the first of three free i64 locals
+        a, b, r = scratch, scratch + 1, scratch + 2
+        guard, result, check = (part.format(a=a, b=b, r=r) for part in UNBOXED_INT_FAST_PATHS[op_name])
+        result_type = 'i32' if op_name in INT_COMPARISONS else 'i64'
+        return Instruction(
+            f'local.set {b} local.set {a}',
+            f'block (result {result_type})',
+            # both small, i.e. neither is tagged
+            f'local.get {a} local.get {b} i64.or i32.wrap_i64 i32.const 1 i32.and i32.eqz',
+            f'{guard} i32.and' if guard else '',
+            'if',
+            result,
+            f'local.tee {r} {check} br_if 1 drop' if check else 'br 1',
+            'end',
+            f'local.get {a} local.get {b} call {self.wasm_module.get_func_index_by_name(f"unboxed_{op_name}")}',
+            'end',
+        )
+
+    def unboxed_from_native(self, n, slot):
+        # tags the i64 in local n into slot, which only needs a shift if it fits in 62 bits (see native.c)
+        return Instruction(f'local.get {n} i64.const 1 i64.shl local.set {slot}',
+                           f'local.get {slot} i64.const 1 i64.shr_s local.get {n} i64.ne',
+                           f'if local.get {n} call {self.wasm_module.get_func_index_by_name("native_box_int")} '
+                           f'call {self.wasm_module.get_func_index_by_name("unboxed_from")} local.set {slot} end\n')
+
+    @staticmethod
+    def returned_by(i):
+        # the instruction which pushed the value a RETURN_VALUE returns, if there's only one
+        pushed_by = {value.pushed_by for values in getattr(i, 'pops_values', {}).values() for value in values}
+        return pushed_by.pop() if len(pushed_by) == 1 else None
+
+    def unboxed_incref(self, slot):
+        # (only pointers need it, so small ints don't call out)
+        return Instruction(f'local.get {slot} i32.wrap_i64 i32.const 1 i32.and',
+                           f'if local.get {slot} call {self.wasm_module.get_func_index_by_name("unboxed_incref")} '
+                           f'drop end')
+
+    def unboxed_decref(self, slot):
+        return Instruction(f'local.get {slot} i32.wrap_i64 i32.const 1 i32.and',
+                           f'if local.get {slot} call {self.wasm_module.get_func_index_by_name("unboxed_decref")} end')
+
+    def _compile_instruction(self, i, jump_table, local_count, unboxed_locals, native_returns=None):
         # print(i)  # for debug reasons
-        instr = self.compile_instruction(i, jump_table, local_count)
+        instr = self.compile_instruction(i, jump_table, local_count, unboxed_locals, native_returns)
+        convert = getattr(i, 'convert', None)
+        # (in a native export, ints being returned don't get boxed just to be unboxed again, see RETURN_VALUE)
+        if convert is not None and not (native_returns and i in native_returns):
+            # the value is needed the other way (boxed or unboxed) by whatever uses it
+            function = opt.py_module.UNBOXED_CONVERSIONS[convert]
+            instr = Instruction(instr, f'call {self.wasm_module.get_func_index_by_name(function)}')
+        if not self.profile.annotate:
+            return Instruction(instr, '\n')
         return Instruction(instr, f'(; {str(i)} ;)\n')
 
-    def compile_instruction(self, i: dis.Instruction, jump_table, local_count) -> Instruction:
+    def compile_instruction(self, i: dis.Instruction, jump_table, local_count, unboxed_locals=None,
+                            native_returns=None) -> Instruction:
+        # native_returns is only given for native exports: which instructions push an unboxed int to be returned
+        unboxed_locals = unboxed_locals or {}
         if hasattr(i, 'disable') and i.disable:
             # some instructions are "removed" as part of the optimisation step.
             # Really, they should _actually_ be removed, but this works too.
@@ -166,8 +365,19 @@ class CodeGenerator:
         if isinstance(i, str):
             return Instruction(i)
 
+        unboxed_const = getattr(i, 'unboxed_const', None)
+        if unboxed_const == 'int':
+            return Instruction(f'i64.const {i.argval << 1}')
+        elif unboxed_const == 'float':
+            return Instruction(f'f64.const {float(i.argval)}')
+
         if i.opname == 'LOAD_CONST':
-            # this could be made much faster by having the consts be static
+            # constants are laid out in memory ahead of time, so loading one is just its address
+            address = self.static_const(i.argval)
+            if address is not None:
+                return Instruction(f'i32.const {address}')
+
+            # (otherwise, the pool is full, so it has to be made every time)
             def load_const(value):
                 if isinstance(value, int):
                     return Instruction(f'i32.const {value} '
@@ -176,10 +386,12 @@ class CodeGenerator:
                     return Instruction(f'f64.const {value} '
                                        f'call {self.wasm_module.get_func_index_by_name("PyFloat_FromDouble")}')
                 elif isinstance(value, tuple):
+                    # (the same as BUILD_TUPLE)
                     return Instruction(
                         *[load_const(item) for item in value],
+                        f'(call {self.wasm_module.get_func_index_by_name("PyTuple_New")} (i32.const {len(value)}))',
                         *[f'(call {self.wasm_module.get_func_index_by_name("PyTuple_set_item_unchecked")} (i32.const {j}))'
-                          for j in range(len(tuple)-1, -1, -1)]
+                          for j in range(len(value) - 1, -1, -1)]
                     )
                 elif value is None:
                     return Instruction(f'call {self.wasm_module.get_func_index_by_name("return_none")}')
@@ -189,9 +401,30 @@ class CodeGenerator:
         elif i.opname == 'RETURN_VALUE':
             # sometimes, returns are implicit. in those cases, the instruction should be optimised out
             # also: when the function ends, call py_decref on each local, once
-            values = [f'local.get {n} call {self.wasm_module.get_func_index_by_name("py_decref")} '
-                      for n in range(local_count)]
+            values = []
+            for n in range(local_count):
+                if n not in unboxed_locals:
+                    values.append(f'local.get {n} call {self.wasm_module.get_func_index_by_name("py_decref")} ')
+                elif unboxed_locals[n][1] == 'int':
+                    # (unboxed floats don't hold any references)
+                    values.append(self.unboxed_decref(unboxed_locals[n][0]))
+            if native_returns is not None:
+                # a native export returns a plain i64 (or a sentinel, see native.c)
+                unbox = self.wasm_module.get_func_index_by_name('native_unbox_int')
+                if self.returned_by(i) in native_returns:
+                    scratch = local_count + len(unboxed_locals)
+                    values.insert(0, f'local.tee {scratch} i32.wrap_i64 i32.const 1 i32.and '
+                                     f'if (result i64) local.get {scratch} '
+                                     f'call {self.wasm_module.get_func_index_by_name("unboxed_box")} call {unbox} '
+                                     f'else local.get {scratch} i64.const 1 i64.shr_s end ')
+                else:
+                    values.insert(0, f'call {unbox} ')
             return Instruction(*values, 'return')
+        elif i.opname == 'LOAD_FAST' and i.arg in unboxed_locals:
+            slot, kind = unboxed_locals[i.arg]
+            if kind == 'float':
+                return Instruction(f'local.get {slot}')
+            return Instruction(f'local.get {slot}', self.unboxed_incref(slot))
         elif i.opname == 'LOAD_FAST':
             # load_fast is for locals. The order is arguments, then other locals, I think.
             return Instruction(f'local.get {i.arg} '
@@ -204,19 +437,39 @@ class CodeGenerator:
             # if strict:
             #     return Instruction('(table.get 0', '(i32.const', self.wasm_module.get_table_entry_by_name(i.argval), '))')
             # return Instruction('i32.const', self.wasm_module.get_table_entry_by_name(i.argval))
-            return Instruction('global.get', self.wasm_module.global_index_by_name[i.argval])
+            index = self.wasm_module.global_index_by_name[i.argval]
+            if self.is_function_global(i.argval):
+                return Instruction('global.get', index)
+            # a global holds a reference to its value, so (like LOAD_FAST) the stack gets one of its own
+            return Instruction(f'global.get {index} '
+                               f'global.get {index} '
+                               f'call {self.wasm_module.get_func_index_by_name("py_incref")}')
         elif i.opname == 'STORE_GLOBAL':
-            return Instruction('global.set', self.wasm_module.global_index_by_name[i.argval])
+            index = self.wasm_module.global_index_by_name[i.argval]
+            if self.is_function_global(i.argval):
+                return Instruction('global.set', index)
+            return Instruction(f'global.get {index} '
+                               f'call {self.wasm_module.get_func_index_by_name("py_decref")} '
+                               f'global.set {index}')
         elif i.opname == 'DELETE_GLOBAL':
             # if it's shadowing a builtin, restore the builtin. Otherwise, set it to the sentry value (None).
-            # todo: decref? so far globals are immune to reference counting altogether
-            return Instruction(
-                (f'i32.const {self.wasm_module.get_table_entry_by_name(self.builtin_names[i.argval])} '
-                 if i.argval in self.builtin_names
-                 else f'call {self.wasm_module.get_func_index_by_name("return_none")} '),
-                'global.set', self.wasm_module.global_index_by_name[i.argval]
-            )
-            pass
+            index = self.wasm_module.global_index_by_name[i.argval]
+            if self.is_function_global(i.argval):
+                return Instruction(
+                    (f'i32.const {self.wasm_module.get_table_entry_by_name(self.builtin_names[i.argval])} '
+                     if i.argval in self.builtin_names
+                     else f'call {self.wasm_module.get_func_index_by_name("return_none")} '),
+                    'global.set', index
+                )
+            return Instruction(f'global.get {index} '
+                               f'call {self.wasm_module.get_func_index_by_name("py_decref")} '
+                               f'call {self.wasm_module.get_func_index_by_name("return_none")} '
+                               f'global.set {index}')
+        elif i.opname == 'STORE_FAST' and i.arg in unboxed_locals:
+            slot, kind = unboxed_locals[i.arg]
+            if kind == 'float':
+                return Instruction(f'local.set {slot}')
+            return Instruction(self.unboxed_decref(slot), f'local.set {slot}')
         elif i.opname == 'STORE_FAST':
             # in theory, this approach may become invalid in the future, if gc calls __del__ methods
             return Instruction(f'local.get {i.arg} '
@@ -228,6 +481,22 @@ class CodeGenerator:
                                f'call {self.wasm_module.get_func_index_by_name("py_decref")} '
                                f'call {self.wasm_module.get_func_index_by_name("return_none")} '
                                f'local.set {i.arg}')
+        # unboxed ints get their own versions of the number functions (see native.c)
+        elif getattr(i, 'unboxed', None) == 'int' and i.opname in opt.py_module.UNBOXED_TRUE_DIVIDES:
+            return Instruction(f'call {self.wasm_module.get_func_index_by_name("unboxed_true_div")}')
+        # (with the small int case inline, and the scratch locals after the unboxed ones, see func_to_wasm)
+        elif getattr(i, 'unboxed', None) == 'int' and i.opname in opt.py_module.UNBOXED_OPS:
+            return self.unboxed_int_op(opt.py_module.UNBOXED_OPS[i.opname], local_count + len(unboxed_locals))
+        elif getattr(i, 'unboxed', None) == 'int' and i.opname == 'COMPARE_OP':
+            return self.unboxed_int_op(opt.py_module.UNBOXED_COMPARISONS[i.argval], local_count + len(unboxed_locals))
+        # and unboxed floats are mostly done inline
+        elif getattr(i, 'unboxed', None) == 'float' and i.opname in opt.py_module.UNBOXED_FLOAT_OPS:
+            op_name = opt.py_module.UNBOXED_FLOAT_OPS[i.opname]
+            if op_name in ('add', 'sub', 'mul'):
+                return Instruction(f'f64.{op_name}')
+            return Instruction(f'call {self.wasm_module.get_func_index_by_name(f"unboxed_float_{op_name}")}')
+        elif getattr(i, 'unboxed', None) == 'float' and i.opname == 'COMPARE_OP':
+            return Instruction(f'f64.{FLOAT_COMPARISONS[i.argval]}')
         # currently no types support inplace operations (or, at least, treat them differently)
         # in the future, this will have to change, but it's good for now
         elif i.opname in ['BINARY_ADD', 'INPLACE_ADD']:
@@ -451,6 +720,70 @@ class CodeGenerator:
             local_arg_count=is_tuple,
         )
 
+    def native_export(self, cfg: NiceCFG, name) -> Optional[Func]:
+        # if the annotations say it only takes and returns ints and floats, it also gets an export which
+        # takes and returns i64s and f64s, so that python can call it without marshalling anything.
+        signature = native_signature(cfg.func)
+        if signature is None:
+            return None
+        params, result = signature
+
+        # if the arguments are all kept unboxed anyway, and it returns an int, that's a copy of the function
+        # which works on them directly, so that nothing gets allocated
+        unboxed_locals = getattr(cfg, 'unboxed_locals', {})
+        if params and result is int and all(n in unboxed_locals and unboxed_locals[n][1] == 'int'
+                                            for n in range(len(params))):
+            return self.func_to_wasm(name, cfg, native=True)
+
+        # otherwise, the values are boxed on the way in and unboxed on the way out, in the runtime (see native.c)
+
+        box = {int: 'native_box_int', float: 'PyFloat_FromDouble'}
+        unbox = {int: 'native_unbox_int', float: 'native_unbox_float'}
+        return func(
+            args=[NATIVE_TYPES[param] for param in params],
+            return_type=NATIVE_TYPES[result],
+            instructions=[Instruction(
+                *[f'local.get {i} call {self.wasm_module.get_func_index_by_name(box[param])}'
+                  for i, param in enumerate(params)],
+                f'call {self.wasm_module.get_func_index_by_name(name)}',
+                f'call {self.wasm_module.get_func_index_by_name(unbox[result])}',
+            )],
+            export=f'__{name}_native',
+        )
+
+    def batch_export(self, function: FunctionType, name) -> Func:
+        # a loop over the native export, for calling it on whole arrays at once (see batch.py).
+        # it takes a pointer to an array of i64s/f64s per argument, a pointer to the output array, and the range of
+        # indices to do. it stops early on a result that couldn't be unboxed, and returns where it got to
+        params, result = native_signature(function)
+        columns = len(params)
+        out, i, n, rv = columns, columns + 1, columns + 2, columns + 3
+
+        def address(ptr):
+            return f'local.get {ptr} local.get {i} i32.const 3 i32.shl i32.add'
+
+        unboxed = {
+            int: f'local.get {rv} i64.const {-2 ** 63} i64.ne',
+            float: f'local.get {rv} local.get {rv} f64.eq',
+        }
+        return func(
+            args=['i32'] * (columns + 3),
+            return_type='i32',
+            local_types=[NATIVE_TYPES[result]],
+            instructions=[Instruction(
+                'block loop',
+                f'local.get {i} local.get {n} i32.ge_u br_if 1',
+                *[f'{address(j)} {NATIVE_TYPES[param]}.load' for j, param in enumerate(params)],
+                f'call {self.wasm_module.get_func_index_by_name(f"__{name}_native")} local.set {rv}',
+                f'{address(out)} local.get {rv} {NATIVE_TYPES[result]}.store',
+                f'{unboxed[result]} i32.eqz br_if 1',
+                f'local.get {i} i32.const 1 i32.add local.set {i} br 0',
+                'end end',
+                f'local.get {i}',
+            )],
+            export=f'__{name}_batch',
+        )
+
 
 def main():
     def add1(x):
@@ -1,7 +1,19 @@
+import asyncio
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from inspect import getmembers, isfunction
 
-from generate_code import CodeGenerator
-from run_wasm import run_wasm
+import compile_cache
+import marshalling
+import parse_wat
+import wasm_binary
+from generate_code import CodeGenerator, RUNTIME_PATH
+from profiles import get_profile
+from specialise import specialised_wrapper
+from batch import add_batch_api
+from buffers import Buffer
+from run_wasm import run_wasm, flush_output, read_heap_stats, InstancePool, ResettableInstance, TieredInstance
 
 
 # for use as a decorator
@@ -17,106 +29,218 @@ def wrapper_wrapper(func_name, instance):
     def call(name, *args):
         return getattr(instance.exports, name)(*args)
 
-    def extract_int(value):
-        # so far: just assume it's a long
-        return call('PyLong_AsLong', value)
-
-    def extract_tuple(value):
-        # 1. get length of tuple
-        # 2. extract each value in turn
-        # 3. reconstruct the tuple
-        size = call('PyTuple_Size', value)
-        return tuple(
-            extract(call('PyTuple_GetItem', value, i))
-            for i in range(size)
-        )
-
-    def extract_bool(value):
-        return bool(call('PyLong_AsLong', value))
-
-    def extract_none(value):
-        return None
-
-    def extract_float(value):
-        return call('PyFloat_AsDouble', value)
-
-    def extract_error(value):
-        raise RuntimeError('failed to extract value! Unknown type!')
-
-    extract_map = {1: extract_int, 2: extract_tuple, 3: extract_bool, 4: extract_none, 5: extract_float,
-                -1: extract_error}
-
     def extract(value):
-        return extract_map[call('get_type', value)](value)
-
-    def push_int(value):
-        return call('PyLong_FromLong', value)
-
-    def push_tuple(value):
-        args = [push_arg(item) for item in value]
-        tp = call('PyTuple_New', len(value))
-        for i, arg in enumerate(args):
-            tp = call('PyTuple_set_item_unchecked', arg, tp, i)
-        return tp
-
-    def push_bool(value):
-        # is it weird to go via long? kinda yes
-        return call('bool_pyobject', push_int(value))
+        # the whole value (e.g. every item of a tuple) comes back in one go, see marshalling.py
+        return marshalling.read_return(instance.exports, value)
 
-    def push_none(value):
-        return call('return_none')
+    area = None
 
-    def push_float(value):
-        return call('PyFloat_FromDouble', value)
-
-    push_map = {int: push_int, tuple: push_tuple, bool: push_bool, type(None): push_none, float: push_float,
-                -1: extract_error}
-
-    def push_arg(arg):
-        return push_map[type(arg)](arg)
+    def push_args(args):
+        # and the arguments all go the other way in one go too
+        nonlocal area
+        if area is None:
+            area = call('get_marshal_area')
+        return marshalling.write_args(instance.exports, area, args)
 
     def inner(*args):
         # todo: maybe fix that we don't wrap nicely too
-        args = [push_arg(arg) for arg in args]
-        rv = call(func_name, *args)
+        args = push_args(args)
+        try:
+            rv = call(func_name, *args)
+        except RuntimeError:
+            if getattr(instance, 'reset_on_trap', False):
+                instance.reset()
+            raise
+        finally:
+            # anything the call printed is buffered until now
+            flush_output()
         return extract(rv)
 
     inner.__name__ = func_name
+    inner.instance = instance
 
     return inner
 
 
-def compile_func_to_wasm(func, name=None, save=False):
+def wrap(func, func_name, instance):
+    # the fastest wrapper there is for func (see specialise.py), falling back on wrapper_wrapper.
+    # it also gets .map and .batch, for calling it on whole arrays (see batch.py)
+    wrapper = specialised_wrapper(func, func_name, instance, wrapper_wrapper(func_name, instance))
+    return add_batch_api(wrapper, func, func_name, instance)
+
+
+def heap_stats(func) -> dict:
+    # the runtime's allocation counters, for a compiled function (or anything else with an instance),
+    # as {'types': {type name: {counter: value}}, 'totals': {counter: value}, 'memory_size': bytes}.
+    # all the functions compiled together share one heap, so it doesn't matter which one you pass in
+    return read_heap_stats(getattr(func, 'instance', func))
+
+
+def buffer(func, length, format='B') -> Buffer:
+    # a buffers.Buffer of `length` items in the instance func was compiled into, for passing to it (or to anything
+    # compiled along with it) without copying. Fill it in through .view, and release() it when you're done
+    return Buffer(getattr(func, 'instance', func), length, format)
+
+
+def reset(func):
+    # puts a function compiled with resettable=True (and everything compiled along with it) back the way it started
+    getattr(func, 'instance', func).reset()
+
+
+def build_runtime(optimise=True, use_cache=True, profile=None) -> bytes:
+    # the runtime on its own, for user code to be linked against (see build_wasm's `linked`).
+    # this only needs building once per runtime, so it's always worth caching.
+    profile = get_profile(profile)
+    key = None
+    if use_cache:
+        key = compile_cache.cache_key([], RUNTIME_PATH, optimise=optimise, runtime=True, profile=profile)
+        wasm = compile_cache.load(key)
+        if wasm is not None:
+            return wasm
+
+    wasm = wasm_binary.encode_runtime(parse_wat.load_template(RUNTIME_PATH), names=profile.names)
+    if optimise and profile.optimise:
+        wasm = parse_wat.Module.opt_wasm(wasm, profile=profile)
+
+    if use_cache:
+        compile_cache.store(key, wasm)
+    return wasm
+
+
+def wasm_cache_key(funcs, optimise=True, linked=False, profile=None) -> str:
+    return compile_cache.cache_key(funcs, RUNTIME_PATH, optimise=optimise, linked=linked, profile=get_profile(profile))
+
+
+def build_wasm(funcs, save_name=None, optimise=True, use_cache=True, linked=False, profile=None) -> bytes:
+    # funcs is a list of (function, name) pairs
+    # on a cache hit we never even construct a CodeGenerator, so the runtime doesn't get parsed either.
+    # note that `save_name` only dumps the intermediate files on a cache miss.
+    # if linked, the result contains only the user's code, and needs to be run along with build_runtime()
+    # profile is a profiles.CompileProfile, or the name of one (see profiles.PROFILES)
+    key = None
+    if use_cache:
+        key = wasm_cache_key(funcs, optimise, linked, profile)
+        wasm = compile_cache.load(key)
+        if wasm is not None:
+            return wasm
+
+    g = CodeGenerator(profile=profile)
+    for func, name in funcs:
+        g.add_to_module(func, name)
+    wasm = g.compile(save_name=save_name, optimise=optimise, linked=linked)
+
+    if use_cache:
+        compile_cache.store(key, wasm)
+    return wasm
+
+
+def build_many(jobs, workers=None, **options) -> list:
+    # like build_wasm, but for several independent modules at once: each entry of jobs is a list of
+    # (function, name) pairs, and misses get compiled in a pool of worker processes.
+    # the wasm comes back in the same order as jobs, and each module is compiled on its own, so the output
+    # doesn't depend on how the work happened to be scheduled.
+    # (functions within one module stay on one process -- they share function/table indices and lazily
+    # resolved calls, so there's nothing independent to hand out below the module level)
+    use_cache = options.get('use_cache', True)
+    results = [None] * len(jobs)
+    if use_cache:
+        for i, funcs in enumerate(jobs):
+            results[i] = compile_cache.load(wasm_cache_key(
+                funcs, options.get('optimise', True), options.get('linked', False), options.get('profile'),
+            ))
+    misses = [i for i, wasm in enumerate(results) if wasm is None]
+
+    try:
+        # the functions get sent to the workers by reference, so they have to be importable
+        pickle.dumps([jobs[i] for i in misses])
+    except (pickle.PicklingError, AttributeError, TypeError):
+        workers = 1
+
+    if workers == 1 or len(misses) <= 1:
+        for i in misses:
+            results[i] = build_wasm(jobs[i], **options)
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            for i, wasm in zip(misses, pool.map(partial(build_wasm, **options), [jobs[i] for i in misses])):
+                results[i] = wasm
+    return results
+
+
+def build_instance(funcs, save_name=None, use_cache=True, linked=False, tiered=False, pooled=False, profile=None,
+                   output=None, resettable=False):
+    # compiles funcs to WASM (or fetches it from the cache, if we've seen it before), and then uses
+    # Wasmer (a dependency) to load that WASM into a runtime, which then exposes its functions to Python.
+    # if tiered, the instance starts off unoptimised, and swaps to the optimised version once it's been built
+    # in the background (see TieredInstance). It's not worth it if the optimised version is already cached,
+    # or if the profile doesn't optimise anyway.
+    # if pooled, each thread that calls into it gets an instance of its own (see InstancePool)
+    # output is a run_wasm.Output, saying where anything the code prints goes
+    # if resettable, the instance can be put back to how it started with reset(), and is whenever a call traps
+    profile = get_profile(profile)
+    if tiered and linked:
+        raise ValueError('tiered instances must be standalone (not linked)')
+    if tiered and pooled:
+        raise ValueError('instances can be tiered or pooled, but not both')
+
+    tiered = tiered and profile.optimise
+    optimised_key = wasm_cache_key(funcs, profile=profile) if tiered else None
+    if tiered and not (use_cache and compile_cache.load(optimised_key) is not None):
+        baseline = build_wasm(funcs, save_name=save_name, optimise=False, use_cache=use_cache, profile=profile)
+
+        def optimise():
+            # the optimised build is the same module put through wasm-opt, so there's no need to generate it again
+            wasm = parse_wat.Module.opt_wasm(baseline, profile=profile)
+            if use_cache:
+                compile_cache.store(optimised_key, wasm)
+            return wasm
+
+        instance = TieredInstance(baseline, optimise, use_cache=use_cache, output=output)
+    else:
+        wasm = build_wasm(funcs, save_name=save_name, use_cache=use_cache, linked=linked, profile=profile)
+        runtime = build_runtime(profile=profile) if linked else None
+        if pooled:
+            instance = InstancePool(wasm, runtime=runtime, use_cache=use_cache, output=output)
+        else:
+            instance = run_wasm(wasm, runtime=runtime, use_cache=use_cache, output=output)
+
+    if resettable:
+        instance = ResettableInstance(instance)
+    return instance
+
+
+def compile_func_to_wasm(func, name=None, save=False, use_cache=True, linked=False, tiered=False, pooled=False,
+                         profile=None, output=None, resettable=False):
     if name is None:
         name = func.__name__
     save_name = name if save else None
 
-    # compile the function to WASM
-    g = CodeGenerator()
-    g.add_to_module(func, name)
-    wasm = g.compile(save_name=save_name)
-
-    # use Wasmer (a dependency) to load that WASM into a runtime,
-    # which then exposes its functions to Python
-    instance = run_wasm(wasm)
+    instance = build_instance(
+        [(func, name)], save_name=save_name, use_cache=use_cache, linked=linked, tiered=tiered, pooled=pooled,
+        profile=profile, output=output, resettable=resettable,
+    )
 
     # g.add_to_module also adds a shim which can convert from C types
     # (which is how they're represented after going through Wasmer's interface)
     # to PyObjects, allowing us to treat the function like it was a builtin.
-    return wrapper_wrapper(name, instance)
-
-
-def compile_multiple(*funcs):
-    g = CodeGenerator()
-
-    for func in funcs:
-        g.add_to_module(func, func.__name__)
-
-    wasm = g.compile(save_name=funcs[0].__name__)
-    instance = run_wasm(wasm)
+    return wrap(func, name, instance)
+
+
+def compile_multiple(*funcs, save=False, use_cache=True, linked=False, tiered=False, pooled=False, profile=None,
+                     output=None, resettable=False):
+    instance = build_instance(
+        [(func, func.__name__) for func in funcs],
+        save_name=funcs[0].__name__ if save else None,
+        use_cache=use_cache,
+        linked=linked,
+        tiered=tiered,
+        pooled=pooled,
+        profile=profile,
+        output=output,
+        resettable=resettable,
+    )
 
     return [
-        wrapper_wrapper(func.__name__, instance)
+        wrap(func, func.__name__, instance)
         for func in funcs
     ]
 
@@ -134,6 +258,98 @@ def compile_module(mod):
     })
 
 
+def compile_modules(*mods, workers=None, use_cache=True, profile=None):
+    # compile_module for several modules, with the compiling done in parallel (see build_many)
+    # wasmer instances can't be sent between processes, so instantiating still happens here
+    jobs = [[(f, f.__name__) for _, f in getmembers(mod, isfunction)] for mod in mods]
+    wasms = build_many(jobs, workers=workers, use_cache=use_cache, profile=profile)
+    modules = []
+    for funcs, wasm in zip(jobs, wasms):
+        instance = run_wasm(wasm, use_cache=use_cache)
+        modules.append(Dotdict({name: wrap(func, name, instance) for func, name in funcs}))
+    return modules
+
+
+# async versions of the above, for use from an event loop. Nothing here blocks the loop:
+# code generation runs in an executor, wasm-opt is an asyncio subprocess, and calls are run on worker threads.
+
+async def build_wasm_async(funcs, optimise=True, use_cache=True, linked=False, profile=None, executor=None) -> bytes:
+    profile = get_profile(profile)
+    key = wasm_cache_key(funcs, optimise, linked, profile)
+    if use_cache:
+        wasm = compile_cache.load(key)
+        if wasm is not None:
+            return wasm
+
+    loop = asyncio.get_running_loop()
+    # (the binary encoder means wat2wasm is only a fallback now, so that stays in the executor too)
+    wasm = await loop.run_in_executor(executor, partial(
+        build_wasm, funcs, optimise=False, use_cache=False, linked=linked, profile=profile,
+    ))
+    if optimise and profile.optimise:
+        wasm = await parse_wat.Module.opt_wasm_async(wasm, profile)
+
+    if use_cache:
+        compile_cache.store(key, wasm)
+    return wasm
+
+
+class AsyncInstance:
+    # calls get dispatched to a pool of worker threads, each of which has an instance of its own (see InstancePool).
+    # with more than one worker, state (e.g. globals) isn't shared between calls on different workers,
+    # which is why the default is one.
+    # the workers (and their instances) live until close(), or the end of an `async with` block.
+    def __init__(self, pool, workers=1):
+        self.pool = pool
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='wasm')
+
+    def wrap(self, func_name):
+        func = wrapper_wrapper(func_name, self.pool)
+
+        async def inner(*args):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+        inner.__name__ = func_name
+        inner.instance = self
+        return inner
+
+    def close(self, wait=False):
+        self.executor.shutdown(wait=wait)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        # waiting for the workers to finish blocks, so that happens off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.close, True)
+
+
+async def build_instance_async(funcs, use_cache=True, linked=False, workers=1, profile=None, executor=None):
+    wasm = await build_wasm_async(funcs, use_cache=use_cache, linked=linked, profile=profile, executor=executor)
+    loop = asyncio.get_running_loop()
+    runtime = await loop.run_in_executor(executor, partial(build_runtime, profile=profile)) if linked else None
+    # JIT compiling the module is slow too
+    pool = await loop.run_in_executor(executor, partial(InstancePool, wasm, runtime=runtime, use_cache=use_cache))
+    return AsyncInstance(pool, workers)
+
+
+async def compile_func_to_wasm_async(func, name=None, use_cache=True, linked=False, workers=1, profile=None):
+    # like compile_func_to_wasm, but it has to be awaited, and so does calling the result
+    if name is None:
+        name = func.__name__
+    instance = await build_instance_async(
+        [(func, name)], use_cache=use_cache, linked=linked, workers=workers, profile=profile,
+    )
+    return instance.wrap(name)
+
+
+async def compile_multiple_async(*funcs, use_cache=True, linked=False, workers=1, profile=None):
+    instance = await build_instance_async(
+        [(func, func.__name__) for func in funcs], use_cache=use_cache, linked=linked, workers=workers, profile=profile,
+    )
+    return [instance.wrap(func.__name__) for func in funcs]
+
+
 def main():
     pass
 
@@ -0,0 +1,109 @@
+# the python side of c/Objects/marshal.c: values go across the boundary as one flat buffer in linear memory,
+# rather than as one call per value. Return values come back that way, and arguments are sent that way.
+# format (little endian), a tag byte followed by:
+#   'i' int: i32 size (whose sign is the sign of the number), then abs(size) bytes of magnitude, least significant first
+#   't' tuple: u32 length, then that many values
+#   'b' bool: u8
+#   'f' float: f64
+#   'n' None: nothing
+#   'o' an object already in the runtime (a buffers.Buffer), passed by reference: i32 pointer. Arguments only
+#   '?' anything else: nothing (it can't be converted)
+import struct
+
+from buffers import Buffer
+
+INT, TUPLE, BOOL, NONE, FLOAT, OBJECT, UNKNOWN = b'itbnfo?'
+
+# the size of the runtime's static buffer (MARSHAL_AREA_SIZE in marshal.c)
+AREA_SIZE = 4096
+
+_int32 = struct.Struct('<i')
+_uint32 = struct.Struct('<I')
+_float64 = struct.Struct('<d')
+
+
+def decode(buffer, offset=0):
+    # returns the value at offset, and the offset just after it
+    tag = buffer[offset]
+    offset += 1
+
+    if tag == INT:
+        size, = _int32.unpack_from(buffer, offset)
+        offset += 4
+        n = abs(size)
+        value = int.from_bytes(buffer[offset:offset + n], 'little')
+        return (-value if size < 0 else value), offset + n
+    if tag == TUPLE:
+        size, = _uint32.unpack_from(buffer, offset)
+        offset += 4
+        items = []
+        for _ in range(size):
+            item, offset = decode(buffer, offset)
+            items.append(item)
+        return tuple(items), offset
+    if tag == BOOL:
+        return bool(buffer[offset]), offset + 1
+    if tag == FLOAT:
+        return _float64.unpack_from(buffer, offset)[0], offset + 8
+    if tag == NONE:
+        return None, offset
+    raise RuntimeError('failed to extract value! Unknown type!')
+
+
+def read_return(exports, value):
+    # converts the PyObject* value into a python object, with a single call into the runtime.
+    # the caller's reference to value is handed over, and released once it's been read
+    ptr = exports.marshal_return(value)
+    buffer = memoryview(exports.memory.buffer)
+    result = decode(buffer, ptr + 4)[0]
+    exports.py_decref(value)
+    return result
+
+
+def encode(value, out: bytearray):
+    # appends value to out
+    # (bool first, since it's a subclass of int)
+    if type(value) is bool:
+        out += bytes((BOOL, value))
+    elif type(value) is int:
+        # (the runtime does the conversion to and from its 15 bit digits, see long_from_bytes in marshal.c)
+        magnitude = abs(value)
+        n = (magnitude.bit_length() + 7) // 8
+        out.append(INT)
+        out += _int32.pack(-n if value < 0 else n)
+        out += magnitude.to_bytes(n, 'little')
+    elif type(value) is float:
+        out.append(FLOAT)
+        out += _float64.pack(value)
+    elif value is None:
+        out.append(NONE)
+    elif type(value) is Buffer:
+        ptr = value.pointer
+        out.append(OBJECT)
+        out += _int32.pack(ptr)
+    elif type(value) is tuple:
+        out.append(TUPLE)
+        out += _uint32.pack(len(value))
+        for item in value:
+            encode(item, out)
+    else:
+        raise TypeError(f'cannot pass a {type(value).__name__} to wasm')
+
+
+def write_args(exports, area, args) -> tuple:
+    # turns args into PyObject*s, with a single call into the runtime (two more if they don't fit into the area).
+    # area is the address of the runtime's static buffer (get_marshal_area), which never moves
+    if not args:
+        return ()
+    data = bytearray(4 * len(args))  # space for the runtime to write the pointers into
+    for arg in args:
+        encode(arg, data)
+
+    ptr = area if len(data) <= AREA_SIZE else exports.marshal_alloc(len(data))
+    memoryview(exports.memory.buffer)[ptr:ptr + len(data)] = data
+    exports.unmarshal_args(ptr, len(args))
+    # (the memory might have grown, so this has to be a new view)
+    pointers = struct.unpack_from(f'<{len(args)}i', memoryview(exports.memory.buffer), ptr)
+    if ptr != area:
+        exports.marshal_free(ptr)
+    return pointers
@@ -123,6 +123,8 @@ class Analyzer:
         if instruction.opname in ['LOAD_FAST', 'LOAD_CONST', 'LOAD_GLOBAL']:
             if isinstance(instruction.argval, int):
                 push(Int(instruction.argval, instruction))
+            elif isinstance(instruction.argval, float):
+                push(Float(instruction.argval, instruction))
             else:
                 if instruction.argval in type_map:
                     push(
@@ -142,7 +144,7 @@ class Analyzer:
             self.mutated_globals.append(instruction)
         elif instruction.opname in ['DELETE_GLOBAL']:
             self.mutated_globals.append(instruction)
-        elif instruction.opname in ['JUMP_FORWARD']:
+        elif instruction.opname in ['JUMP_FORWARD', 'JUMP_ABSOLUTE']:
             pass  # does not effect the stack
         elif instruction.opname in ['COMPARE_OP']:
             pop()
@@ -152,8 +154,8 @@ class Analyzer:
             push(pop())
         # todo this section is a bit messy -- clean it up
         elif instruction.opname in ['BINARY_SUBTRACT', 'INPLACE_SUBTRACT',
-                                    'BINARY_ADD', 'INPLACE_ADD', 'BINARY_MULTIPLY',
-                                    'BINARY_MODULO', 'BINARY_FLOOR_DIVIDE',
+                                    'BINARY_ADD', 'INPLACE_ADD', 'BINARY_MULTIPLY', 'INPLACE_MULTIPLY',
+                                    'BINARY_MODULO', 'INPLACE_MODULO', 'BINARY_FLOOR_DIVIDE', 'INPLACE_FLOOR_DIVIDE',
                                     'BINARY_POWER', 'BINARY_RSHIFT', 'BINARY_LSHIFT',
                                     'BINARY_OR', 'BINARY_AND',
                                     ]:
@@ -161,12 +163,18 @@ class Analyzer:
             b = pop()
             if isinstance(a, Int) and isinstance(b, Int):
                 push(Int())
+            elif (isinstance(a, (Int, Float)) and isinstance(b, (Int, Float))
+                  and instruction.opname not in ['BINARY_POWER', 'BINARY_RSHIFT', 'BINARY_LSHIFT',
+                                                 'BINARY_OR', 'BINARY_AND']):
+                # ints get promoted to floats
+                # (but not for powers, since a negative float to a fractional power is complex)
+                push(Float())
             else:
                 push(Var())
-        elif instruction.opname in ['BINARY_TRUE_DIVIDE']:
+        elif instruction.opname in ['BINARY_TRUE_DIVIDE', 'INPLACE_TRUE_DIVIDE']:
             a = pop()
             b = pop()
-            if isinstance(a, Int) and isinstance(b, Int):
+            if isinstance(a, (Int, Float)) and isinstance(b, (Int, Float)):
                 push(Float())
             else:
                 push(Var())
@@ -14,12 +14,44 @@
 # so the CodeGenerator has a PythonModule, and interacts with that until it's ready to emit code.
 
 # this awkwardly means we have two classes that are called *Module -- fine, whatever.
+import typing
 from types import FunctionType
 from typing import Any
 
 from opt.analyse import Analyzer
 from opt.cfg import NiceCFG
-from opt.main import InstructionList
+from opt.main import InstructionList, Int, Float
+
+# ops which can be done on unboxed ints (see native.c), and the name of the function that does them
+UNBOXED_OPS = {
+    'BINARY_ADD': 'add', 'INPLACE_ADD': 'add',
+    'BINARY_SUBTRACT': 'sub', 'INPLACE_SUBTRACT': 'sub',
+    'BINARY_MULTIPLY': 'mul', 'INPLACE_MULTIPLY': 'mul',
+    'BINARY_MODULO': 'mod', 'INPLACE_MODULO': 'mod',
+    'BINARY_FLOOR_DIVIDE': 'floor_div', 'INPLACE_FLOOR_DIVIDE': 'floor_div',
+    'BINARY_AND': 'and', 'INPLACE_AND': 'and',
+    'BINARY_OR': 'or', 'INPLACE_OR': 'or',
+}
+# and on unboxed floats (add, sub and mul are done inline, the rest by unboxed_float_*)
+UNBOXED_FLOAT_OPS = {
+    'BINARY_ADD': 'add', 'INPLACE_ADD': 'add',
+    'BINARY_SUBTRACT': 'sub', 'INPLACE_SUBTRACT': 'sub',
+    'BINARY_MULTIPLY': 'mul', 'INPLACE_MULTIPLY': 'mul',
+    'BINARY_TRUE_DIVIDE': 'div', 'INPLACE_TRUE_DIVIDE': 'div',
+    'BINARY_MODULO': 'mod', 'INPLACE_MODULO': 'mod',
+    'BINARY_FLOOR_DIVIDE': 'floor_div', 'INPLACE_FLOOR_DIVIDE': 'floor_div',
+}
+# int / int takes unboxed ints, but gives an unboxed float
+UNBOXED_TRUE_DIVIDES = ['BINARY_TRUE_DIVIDE', 'INPLACE_TRUE_DIVIDE']
+UNBOXED_COMPARISONS = {'<': 'lt', '<=': 'lte', '==': 'eq', '!=': 'neq', '>': 'gt', '>=': 'gte'}
+# the functions which convert between boxed (None) and unboxed values
+UNBOXED_CONVERSIONS = {
+    (None, 'int'): 'unboxed_from',
+    ('int', None): 'unboxed_box',
+    (None, 'float'): 'unboxed_float_from',
+    ('float', None): 'PyFloat_FromDouble',
+    ('int', 'float'): 'unboxed_int_to_float',
+}
 
 
 class PythonModule:
@@ -83,6 +115,7 @@ class PythonModule:
                 self.apply_static_typing_optimisation(instruction)
                 if instruction.opname == 'CALL_FUNCTION':
                     self.apply_direct_function_call_optimisation(instruction)
+            self.apply_unboxing_optimisation(cfg)
 
     def apply_direct_function_call_optimisation(self, i):
         try:
@@ -128,3 +161,137 @@ class PythonModule:
                 # 2. mark it as allowed
                 i.use_static_typing = True
                 i.static_type = base_type
+
+    @staticmethod
+    def apply_unboxing_optimisation(cfg: NiceCFG):
+        # locals which are always ints or always floats get kept unboxed, in i64 and f64 locals (see native.c for
+        # how they're represented), along with the results of arithmetic on them. They're only boxed when they
+        # escape: when they're returned, passed to a function, put in a tuple, and so on.
+        # the result is cfg.unboxed_locals, mapping the index of each of those locals to its wasm local and
+        # what's kept in it ('int' or 'float'), and on the instructions:
+        # - i.unboxed: which unboxed version of the instruction to use ('int' or 'float'), if any
+        # - i.convert: the value it pushes has to be converted for whatever uses it, as (from, to),
+        #   where None means boxed (see UNBOXED_CONVERSIONS)
+        # - i.unboxed_const: it's a constant, which should be pushed already unboxed, as an 'int' or 'float'
+        cfg.unboxed_locals = {}
+        instructions = cfg.cfg.instructions.instructions
+        analyzer = cfg.cfg.analyzer
+        code = cfg.func.__code__
+
+        # to keep things simple, every value has to be used in the same block it's made in, by exactly one instruction
+        if any(analyzer.block_starting_stack_size.values()) or any(
+                i.opname.startswith(('ROT_', 'DUP_', 'JUMP_IF_', 'UNARY_', 'EXTENDED_ARG')) for i in instructions):
+            return
+
+        def analysed(i):
+            # (instructions in blocks which are never reached don't get analysed)
+            return hasattr(i, 'pops_values') or hasattr(i, 'pushes_values')
+
+        producers = {}
+        for consumer in instructions:
+            for slot, values in getattr(consumer, 'pops_values', {}).items():
+                pushed_by = {value.pushed_by for value in values}
+                if len(pushed_by) != 1 or None in pushed_by:
+                    return
+                producers[consumer, slot] = pushed_by.pop()
+
+        # which locals are always stored as ints, or as floats. Arguments arrive boxed, so they can only be
+        # unboxed if they're ints (which can hold anything, if it comes to it)
+        try:
+            hints = typing.get_type_hints(cfg.func)
+        except Exception:
+            hints = {}
+        stored_types = {name: [] for name in code.co_varnames}
+        for i in instructions:
+            if i.opname not in ('LOAD_FAST', 'STORE_FAST', 'DELETE_FAST'):
+                continue
+            if not analysed(i) or i.opname == 'DELETE_FAST':
+                stored_types.pop(i.argval, None)
+            elif i.opname == 'STORE_FAST' and i.argval in stored_types:
+                stored_types[i.argval].append(i.pops_types[0])
+        kinds = {}
+        for n, name in enumerate(code.co_varnames):
+            if name not in stored_types:
+                continue
+            if n < code.co_argcount:
+                if hints.get(name) is int and all(types == {Int} for types in stored_types[name]):
+                    kinds[name] = 'int'
+            elif stored_types[name] and all(types == {Int} for types in stored_types[name]):
+                kinds[name] = 'int'
+            elif stored_types[name] and all(types == {Float} for types in stored_types[name]):
+                kinds[name] = 'float'
+        if not kinds:
+            return
+
+        def exact_float(consumer, slot):
+            # a float, or an int constant which is exactly one (comparing ints to floats has to be exact)
+            producer = producers[consumer, slot]
+            return consumer.pops_types[slot] == {Float} or (
+                    producer.opname == 'LOAD_CONST' and type(producer.argval) is int and abs(producer.argval) <= 2 ** 53)
+
+        def unboxed_version(i):
+            if not analysed(i):
+                return None
+            if i.opname == 'STORE_FAST':
+                return kinds.get(i.argval)
+            popped = list(getattr(i, 'pops_types', {}).values())
+            if not popped:
+                return None
+            comparison = i.opname == 'COMPARE_OP' and i.argval in UNBOXED_COMPARISONS
+            if all(types == {Int} for types in popped):
+                if i.opname in UNBOXED_OPS or i.opname in UNBOXED_TRUE_DIVIDES or comparison:
+                    return 'int'
+            elif all(types <= {Int, Float} for types in popped):
+                if i.opname in UNBOXED_FLOAT_OPS or (comparison and all(exact_float(i, slot) for slot in i.pops_types)):
+                    return 'float'
+            return None
+
+        def gives(i):
+            if i.opname == 'LOAD_FAST':
+                return kinds.get(i.argval)
+            if i.opname == 'COMPARE_OP':
+                return None  # (comparisons always give a native bool)
+            version = unboxed_version(i)
+            if version == 'int' and i.opname in UNBOXED_TRUE_DIVIDES:
+                return 'float'
+            return version
+
+        def fits(value, kind):
+            # whether a constant can be pushed as it is
+            if kind == 'int':
+                return type(value) is int and -(1 << 62) <= value < (1 << 62)
+            if type(value) not in (int, float):
+                return False
+            try:
+                float(value)
+            except OverflowError:
+                return False
+            return True
+
+        wanted = {}
+        for (consumer, slot), producer in producers.items():
+            kind = unboxed_version(consumer)
+            if wanted.get(producer, kind) != kind:
+                return
+            wanted[producer] = kind
+        consts, conversions = {}, {}
+        for producer, kind in wanted.items():
+            if gives(producer) == kind:
+                continue
+            if producer.opname == 'LOAD_CONST' and kind is not None and fits(producer.argval, kind):
+                consts[producer] = kind
+            elif (gives(producer), kind) in UNBOXED_CONVERSIONS:
+                conversions[producer] = (gives(producer), kind)
+            else:
+                return
+
+        # nothing has been changed yet, so we can still back out above. Now the plan is known to work, apply it
+        for i in instructions:
+            i.unboxed = unboxed_version(i)
+            i.unboxed_const = consts.get(i)
+            i.convert = conversions.get(i)
+        unboxed = [n for n, name in enumerate(code.co_varnames) if name in kinds]
+        cfg.unboxed_locals = {
+            n: (code.co_nlocals + k, kinds[code.co_varnames[n]])
+            for k, n in enumerate(unboxed)
+        }
@@ -1,14 +1,21 @@
 from __future__ import annotations
 
+import asyncio
+import copy
+import hashlib
 import io
+import pickle
 import re
 import string
 import subprocess
+import sys
+import warnings
 from ast import literal_eval
 from functools import lru_cache
 from typing import Union
 
-pattern = re.compile(r'(-?)0x(\d*)\.?([pP])?([+\-])?(\d*)?')
+import compile_cache
+from profiles import get_profile
 
 
 def numeric_literal(token) -> Union[int, float]:
@@ -18,14 +25,12 @@ def numeric_literal(token) -> Union[int, float]:
         return KeywordLiteral(token)
 
     if token.startswith('0x'):
-        # in case this breaks: treat it as an opaque string instead
-        _sign_1, p, is_float, sign, e = pattern.match(token).groups()
-        if is_float:
-            return int(p, 16) * (2 ** numeric_literal(f'{sign}{e}'))
-        else:
-            return int(p, 16)
         # ok we don't really know if it's a float or an int
-        # they both start with '0x' and then a hexnum
+        # they both start with '0x' and then a hexnum, but only floats have a '.' or an exponent
+        if '.' in token or 'p' in token.lower():
+            return float.fromhex(token)
+        else:
+            return int(token, 16)
 
     else:
         return literal_eval(token)
@@ -142,6 +147,79 @@ def tokenize(file):
             break
 
 
+# matches one token (or comment), plus any whitespace before it.
+# groups: 1 = comment, 2 = paren, 3 = string, 4 = anything else (keywords, numbers, $identifiers)
+token_pattern = re.compile(r'''
+    \s*
+    (?:
+        (;;[^\n]*|\(;)
+      | ([()])
+      | ("(?:[^"\\]|\\.)*")
+      | ([^\s()";]+)
+    )
+''', re.VERBOSE | re.DOTALL)
+trailing_whitespace_pattern = re.compile(r'\s*\Z')
+block_comment_pattern = re.compile(r'\(;|;\)')
+string_escape_pattern = re.compile(r'\\([0-9a-fA-F]{2}|.)', re.DOTALL)
+string_escapes = {'t': '\t', 'n': '\n', 'r': '\r', '"': '"', "'": "'", '\\': '\\'}
+
+
+def _unescape(match):
+    escape = match.group(1)
+    if escape in string_escapes:
+        return string_escapes[escape]
+    return chr(int(escape, 16))
+
+
+def tokenize_buffer(text: str):
+    # produces the same token stream as tokenize, but works on the whole buffer at once using regexes,
+    # rather than a character at a time. Much faster on big inputs like the runtime.
+    pos = 0
+    end = len(text)
+    match_at = token_pattern.match
+    numeric_start = set('+-0123456789')
+    keyword_start = set(string.ascii_lowercase + '$')
+
+    while pos < end:
+        m = match_at(text, pos)
+        if m is None:
+            if trailing_whitespace_pattern.match(text, pos):
+                break
+            raise ValueError(f'failed to tokenize wat at position {pos}: {text[pos:pos + 20]!r}')
+        pos = m.end()
+
+        comment, paren, str_token, atom = m.groups()
+        if comment == '(;':
+            # block comments can nest (generated code puts them inside instruction comments), so skip to the
+            # matching ;) by hand
+            depth = 1
+            while depth:
+                m = block_comment_pattern.search(text, pos)
+                if m is None:
+                    raise ValueError(f'unterminated block comment at position {pos}')
+                depth += 1 if m.group() == '(;' else -1
+                pos = m.end()
+        elif atom is not None:
+            c = atom[0]
+            if c in keyword_start:
+                yield KeywordLiteral(atom)
+            elif c in numeric_start:
+                # nearly every number in the runtime is a plain decimal, so skip literal_eval where we can
+                try:
+                    yield int(atom)
+                except ValueError:
+                    try:
+                        yield float(atom)
+                    except ValueError:
+                        yield numeric_literal(atom)
+            else:
+                raise NotImplementedError(atom)
+        elif paren is not None:
+            yield paren
+        elif str_token is not None:
+            yield StringLiteral(string_escape_pattern.sub(_unescape, str_token[1:-1]))
+
+
 def tree_ify(token_stream) -> Node:
     # to start a module, we read a single '('. In all other cases, we have already read it.
     name = next(token_stream)
@@ -167,21 +245,32 @@ class Node:
         self.name: str = name
 
     def __str__(self) -> str:
-        return ' '.join(['(', self.name, *self._body_to_wat(), ')'])
+        out = io.StringIO()
+        self.write(out)
+        return out.getvalue()
 
     def __repr__(self):
         # 1/0
         return f'{type(self).__name__}({str(self)})'
 
-    def _body_to_wat(self) -> list[str]:
-        return [
-            (
-                str(child)
-                # if isinstance(child, Node)
-                # else print(child) or repr(child)
-            )
-            for child in self.children
-        ]
+    def copy(self):
+        # shallow, but with its own list of children -- enough to mutate the children without affecting the original
+        node = copy.copy(self)
+        node.children = list(self.children)
+        return node
+
+    def write(self, out):
+        # streams the wat for this node into out (anything with a .write(str) method), a piece at a time,
+        # so the text for a whole module never has to be held in memory at once
+        out.write('( ')
+        out.write(self.name)
+        for child in self.children:
+            out.write(' ')
+            if isinstance(child, Node):
+                child.write(out)
+            else:
+                out.write(str(child))
+        out.write(' )')
 
 
 class Module(Node):
@@ -226,14 +315,67 @@ class Module(Node):
 
         assert len(self.table) == 1
 
+        # the runtime's own mutable globals (i.e. the C stack pointer) get exported too, so that all of an instance's
+        # state can be saved and restored from outside (see run_wasm.Snapshot)
+        exported_globals = {export.ref_index for export in self.exports if export.ref_type == 'global'}
+        for i, glob in enumerate(self.globals):
+            if i not in exported_globals and any(getattr(child, 'name', None) == 'mut' for child in glob.children):
+                export = Export(
+                    [StringLiteral(f'__runtime_global_{i}'), Node(name='global', children=[i])], name='export',
+                )
+                self.exports.append(export)
+                self.children.append(export)
+
+        # everything after these was generated, rather than parsed from the runtime (see wasm_binary)
+        self.parsed_func_count = len(self.funcs)
+        self.parsed_global_count = len(self.globals)
+        self.parsed_elem_count = len(self.elems)
+        self.parsed_export_count = len(self.exports)
+        self.parsed_misc_count = len(self.misc_nodes)
+
         self.tmp_register = self.add_func_to_table('__internal__tmp_register', 0)
 
+    def clone(self) -> Module:
+        # a cheap copy, suitable for adding user code to without touching the original.
+        # once parsed, the runtime's funcs, types, imports and exports are never changed, so clones share them.
+        # the only nodes which get mutated in place are the table (its size), the globals (their values),
+        # and the elems, so they get copied.
+        copies = {id(node): node.copy() for node in [*self.table, *self.globals, *self.elems]}
+
+        def swap(nodes):
+            return [copies.get(id(node), node) for node in nodes]
+
+        module = object.__new__(Module)
+        module.__dict__.update(self.__dict__)
+        module.children = swap(self.children)
+        module.table = swap(self.table)
+        module.globals = swap(self.globals)
+        module.elems = swap(self.elems)
+        module.types = list(self.types)
+        module.imports = list(self.imports)
+        module.funcs = list(self.funcs)
+        module.exports = list(self.exports)
+        module.misc_nodes = list(self.misc_nodes)
+        module.funcs_by_name = dict(self.funcs_by_name)
+        module.global_index_by_name = dict(self.global_index_by_name)
+        module.table_indices_by_name = dict(self.table_indices_by_name)
+        return module
+
     def add_func(self, func: Func, name: str):
         self.funcs.append(func)
         self.funcs_by_name[name] = func
         # ok this might not work
         self.children.append(func)
 
+    def add_data(self, offset: int, content: bytes):
+        # an active data segment, which writes content into memory at offset on instantiation
+        data = Node(
+            children=[Node(name='i32.const', children=[offset]), StringLiteral(content.decode('latin-1'))],
+            name='data',
+        )
+        self.misc_nodes.append(data)
+        self.children.append(data)
+
     def get_func_by_index(self, i):
         if isinstance(i, KeywordLiteral):
             # it's actually a $identifier
@@ -283,6 +425,11 @@ class Module(Node):
 
         self.globals.append(glob)
         self.children.append(glob)
+
+        # exported so that their state can be carried across to another instance (see run_wasm.TieredInstance)
+        export = Export([StringLiteral(f'__global_{name}'), Node(name='global', children=[glob.index])], name='export')
+        self.exports.append(export)
+        self.children.append(export)
         return glob
 
     def set_global_value(self, name, value):
@@ -336,39 +483,81 @@ class Module(Node):
 
         return LazyEntry()
 
-    def compile(self, save_name=None, opt=True) -> bytes:
-        # awful hack to fix table size problems -- will be fixed soon
-        str(self)
-        thing = str(self)
-        enc = thing.encode()
+    def finalise(self):
+        # generated funcs are partly lazy (see LazyCallFunction), and resolving them can add more funcs
+        # and table entries. Resolve each of them once, so that nothing moves while the module is written out
+        # (this replaces the old "print it twice" hack)
+        i = self.parsed_func_count
+        while i < len(self.funcs):
+            str(self.funcs[i])
+            i += 1
+
+    def compile(self, save_name=None, opt=True, backend='binary', linked=False, profile=None) -> bytes:
+        # backend is either 'binary', which encodes the module directly (see wasm_binary), or 'wat2wasm'.
+        # the text format is still written out when save_name is given, for debugging.
+        # if linked, only the generated code is compiled, and it imports the rest from a separately built runtime
+        # (see main.build_runtime). That only works with the binary encoder.
+        # profile decides how (and whether) wasm-opt is run, and whether names are kept (see profiles.py)
+        profile = get_profile(profile)
+        self.finalise()
+
+        wasm = None
+        if linked:
+            import wasm_binary  # (circular import)
+            wasm = wasm_binary.encode_linked(self, names=profile.names)
+        elif backend == 'binary':
+            import wasm_binary  # (circular import)
+            try:
+                wasm = wasm_binary.encode_module(self, names=profile.names)
+            except NotImplementedError as e:
+                warnings.warn(f'binary encoder failed ({e}), falling back to wat2wasm', RuntimeWarning)
 
         if save_name:
-            open(f'tmp/{save_name}.raw.wat', 'wb').write(enc)
-
-        process = subprocess.run(
-            ['wat2wasm', '--enable-reference-types', '-', '-o', '/dev/stdout'],
-            input=enc,
-            capture_output=True
-        )
-        if process.returncode != 0:
-            raise RuntimeError(f'Failed to compile:\n {process.stderr.decode()}')
+            with open(f'tmp/{save_name}.raw.wat', 'w') as f:
+                self.write(f)
+        if wasm is None:
+            wasm = self.wat2wasm(names=profile.names)
 
         if save_name:
-            open(f'tmp/{save_name}.wasm', 'wb').write(process.stdout)
+            open(f'tmp/{save_name}.wasm', 'wb').write(wasm)
             subprocess.run(
                 ['wasm2wat', '--enable-reference-types', f'tmp/{save_name}.wasm', '-o', f'tmp/{save_name}.wat'],
             )
 
-        if opt:
-            return self.opt_wasm(process.stdout, save_name)
+        if opt and profile.optimise:
+            return self.opt_wasm(wasm, save_name, profile)
         else:
-            return process.stdout
+            return wasm
+
+    def wat2wasm(self, names=False) -> bytes:
+        # the text is streamed straight into wat2wasm's stdin, rather than built up as one big string first
+        process = subprocess.Popen(
+            ['wat2wasm', '--enable-reference-types', '-', '-o', '/dev/stdout', *(['--debug-names'] if names else [])],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        stdin = io.TextIOWrapper(process.stdin, encoding='utf-8')
+        try:
+            self.write(stdin)
+            stdin.flush()
+        except BrokenPipeError:
+            pass  # wat2wasm gave up early, stderr will say why
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f'Failed to compile:\n {stderr.decode()}')
+        return stdout
 
     @staticmethod
-    def opt_wasm(wasm: bytes, save_name=None) -> bytes:
-        process = subprocess.run(
-            ['wasm-opt', '--enable-multivalue', '--enable-reference-types', '-', '-O4', '-o', '/dev/stdout'],
-            input=wasm, capture_output=True)
+    def opt_args(profile=None) -> list:
+        profile = get_profile(profile)
+        args = [f'-{profile.opt_level}'] if profile.opt_level else []
+        args += profile.passes
+        if profile.names:
+            args.append('--debuginfo')  # otherwise wasm-opt drops the name section
+        return ['wasm-opt', '--enable-multivalue', '--enable-reference-types', '-', *args, '-o', '/dev/stdout']
+
+    @staticmethod
+    def opt_wasm(wasm: bytes, save_name=None, profile=None) -> bytes:
+        process = subprocess.run(Module.opt_args(profile), input=wasm, capture_output=True)
         if process.returncode != 0:
             raise RuntimeError(f'Failed to optimise:\n {process.stderr.decode()}')
         if save_name:
@@ -379,6 +568,17 @@ class Module(Node):
 
         return process.stdout
 
+    @staticmethod
+    async def opt_wasm_async(wasm: bytes, profile=None) -> bytes:
+        # the same as opt_wasm, but the event loop keeps running while wasm-opt does
+        process = await asyncio.create_subprocess_exec(
+            *Module.opt_args(profile), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate(wasm)
+        if process.returncode != 0:
+            raise RuntimeError(f'Failed to optimise:\n {stderr.decode()}')
+        return stdout
+
 
 class Type(Node):
     name = 'type'
@@ -455,6 +655,9 @@ class StringLiteral(Node):
         a2 = ['"', almost_str, '"']
         return ''.join(a2)
 
+    def write(self, out):
+        out.write(str(self))
+
 
 class KeywordLiteral(Node):
     def __init__(self, *content):
@@ -464,6 +667,9 @@ class KeywordLiteral(Node):
     def __str__(self):
         return ' '.join(str(c) for c in self.content)
 
+    def write(self, out):
+        out.write(str(self))
+
 
 class FloatLiteral(Node):
     name = 'float'
@@ -483,12 +689,84 @@ def parse_based_on_name(name, children) -> Node:
     return mapping.get(name, Node)(children, name)
 
 
-def load(path) -> Module:
+def decompile(path) -> str:
     # probably really bad for memory -- if it starts using too much, we can start caching to disk
     with open(path, 'rb') as f:
         process = subprocess.run(['wasm2wat', '-', '-o', '/dev/stdout'], stdin=f, capture_output=True)
         if process.returncode != 0:
             raise RuntimeError(f'Failed to decompile {path} {process}')
+    return process.stdout.decode()
+
+
+def load(path) -> Module:
+    return tree_ify(token_stream=tokenize_buffer(decompile(path)))
+
+
+# parsed runtimes, keyed by the hash of the wasm file they came from
+_templates: dict[str, Module] = {}
+
+
+def load_template(path, persist=True) -> Module:
+    # parsing the runtime is the slowest part of making a CodeGenerator, so we only do it once per process,
+    # and (if persist is set) once per build of the runtime, by pickling the parsed tree into the compile cache.
+    # the returned module is shared -- never modify it directly, clone() it first.
+    runtime_hash = compile_cache.hash_file(path)
+    if runtime_hash in _templates:
+        return _templates[runtime_hash]
+
+    # the pickle is only valid for this version of the parser (and of python)
+    key = hashlib.sha256(repr((runtime_hash, compile_cache.compiler_hash(), sys.version)).encode()).hexdigest()
+
+    module = None
+    if persist:
+        data = compile_cache.load(key, suffix='.pickle')
+        if data is not None:
+            try:
+                module = pickle.loads(data)
+            except Exception as e:
+                # a stale or corrupt entry isn't fatal, we just parse it again
+                warnings.warn(f'failed to load cached runtime {path}: {e!r}', RuntimeWarning)
+
+    if module is None:
+        module = load(path)
+        if persist:
+            compile_cache.store(key, pickle.dumps(module, protocol=pickle.HIGHEST_PROTOCOL), suffix='.pickle')
+
+    _templates[runtime_hash] = module
+    return module
+
+
+def _token_key(token):
+    # tokens are Nodes without __eq__, so compare them by type and content instead
+    if isinstance(token, Node):
+        return type(token).__name__, getattr(token, 'content', None)
+    return type(token).__name__, token
+
+
+def bench_tokenizers(path='c/build/emcc/add2.wasm', n=3):
+    import time
+
+    text = decompile(path)
+    print(f'{path}: {len(text)} chars, {text.count(chr(10))} lines')
+
+    slow = list(tokenize(io.StringIO(text)))
+    fast = list(tokenize_buffer(text))
+    assert list(map(_token_key, slow)) == list(map(_token_key, fast)), 'token streams differ!'
+
+    for name, run in [
+        ('tokenize', lambda: list(tokenize(io.StringIO(text)))),
+        ('tokenize_buffer', lambda: list(tokenize_buffer(text))),
+        ('tokenize_buffer + tree_ify', lambda: tree_ify(tokenize_buffer(text))),
+    ]:
+        t = time.perf_counter()
+        for _ in range(n):
+            run()
+        print(f'{name}: {(time.perf_counter() - t) / n * 1000:.0f}ms')
+
+
+def main():
+    bench_tokenizers()
+
 
-    stream = io.StringIO(process.stdout.decode())
-    return tree_ify(token_stream=tokenize(file=stream))
+if __name__ == '__main__':
+    main()
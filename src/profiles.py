@@ -0,0 +1,54 @@
+# named sets of compile options, trading off compile time against how fast the generated code runs.
+# pass one (or its name) as `profile` to compile_func_to_wasm, compile_multiple and friends.
+
+
+class CompileProfile:
+    def __init__(self, name, opt_level=None, passes=(), annotate=False, names=False):
+        self.name = name
+        # the wasm-opt optimisation level (e.g. 'O4'), or None to skip wasm-opt altogether
+        self.opt_level = opt_level
+        # extra wasm-opt passes, run after the optimisation level
+        self.passes = tuple(passes)
+        # put a (; instr ;) comment after every generated instruction, saying which bytecode it came from.
+        # only visible in the text format (i.e. with save=True), and slows down code generation noticeably
+        self.annotate = annotate
+        # keep function names in the binary (the "name" section), so traps have readable stack traces
+        self.names = names
+
+    @property
+    def optimise(self):
+        return self.opt_level is not None or bool(self.passes)
+
+    def __repr__(self):
+        # (also used as part of the cache key, so everything that affects the output has to be in here)
+        return (
+            f'CompileProfile({self.name!r}, opt_level={self.opt_level!r}, passes={self.passes!r}, '
+            f'annotate={self.annotate!r}, names={self.names!r})'
+        )
+
+
+PROFILES = {
+    # for development: no wasm-opt at all, so compiling is about as cheap as it gets
+    'fast-compile': CompileProfile('fast-compile'),
+    'balanced': CompileProfile('balanced', opt_level='O2'),
+    # the same wasm-opt run as always: -O4, and nothing else
+    'default': CompileProfile('default', opt_level='O4'),
+    # for production: optimise as hard as wasm-opt can, and keep going while it's still finding things
+    'max-throughput': CompileProfile('max-throughput', opt_level='O4', passes=['--converge']),
+    # readable output, at the cost of speed
+    'debug': CompileProfile('debug', annotate=True, names=True),
+}
+
+DEFAULT_PROFILE = 'default'
+
+
+def get_profile(profile=None) -> CompileProfile:
+    # accepts a profile, the name of one, or None for the default
+    if profile is None:
+        profile = DEFAULT_PROFILE
+    if isinstance(profile, CompileProfile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError(f'unknown compile profile {profile!r} (expected one of {", ".join(PROFILES)})') from None
@@ -1,17 +1,143 @@
+import codecs
+import hashlib
+import struct
 import sys
+import threading
+import warnings
 
-from wasmer import engine, Store, Module, Instance, Memory, ImportObject, Function, FunctionType, Type
+import wasmer
+from wasmer import engine, Store, Module, Instance, Memory, ImportObject, Function, FunctionType, Type, Global
 from wasmer_compiler_cranelift import Compiler
-# from wasmer_compiler_singlepass import Compiler as C2
+
+# singlepass compiles much faster than cranelift, but generates slower code, so it's only used as a baseline
+# for tiered instances. It's optional.
+try:
+    from wasmer_compiler_singlepass import Compiler as BaselineCompiler
+except ImportError:
+    BaselineCompiler = None
+
+import compile_cache
 
 # from generate_code import CodeGenerator
 
 
-def run_wasm(wasm):
-    e = engine.JIT(Compiler)
-    store = Store(e)
+def native_cache_key(wasm: bytes, compiler=Compiler) -> str:
+    # native code depends on the wasm, and on what compiled it
+    h = hashlib.sha256()
+    h.update(repr((compile_cache.CACHE_VERSION, wasmer.__version__, compiler.__module__)).encode())
+    h.update(wasm)
+    return h.hexdigest()
+
+
+def load_module(store, wasm: bytes, use_cache=True, compiler=Compiler) -> Module:
+    # JIT compiling is the slow part of loading a module, so the native code gets cached on disk,
+    # and a warm load is just a deserialize.
+    # note that this trusts the cache dir completely: whatever's in there gets run as machine code
+    if not use_cache:
+        return Module(store, wasm)
+
+    key = native_cache_key(wasm, compiler)
+    native = compile_cache.load(key, suffix='.native')
+    if native is not None:
+        try:
+            return Module.deserialize(store, native)
+        except RuntimeError as e:
+            # e.g. it was written by an incompatible version of wasmer
+            warnings.warn(f'failed to load cached native module: {e}', RuntimeWarning)
+
     module = Module(store, wasm)
+    compile_cache.store(key, module.serialize(), suffix='.native')
+    return module
+
+
+class Output:
+    # where the runtime's stdout/stderr (i.e. fd_write) goes. Writes are buffered, and only passed on at the end
+    # of each call from python (see flush_output), or once the buffer gets big.
+    # by default they go to whatever sys.stdout/sys.stderr is at the time, but any text files can be given instead,
+    # and with capture=True it's all kept in memory, for getvalue() to return.
+    def __init__(self, stdout=None, stderr=None, capture=False, buffer_size=1 << 16):
+        self.files = {1: stdout, 2: stderr}
+        self.capture = capture
+        self.buffer_size = buffer_size
+        self.buffers = {1: bytearray(), 2: bytearray()}
+        self.captured = {1: bytearray(), 2: bytearray()}
+        # (incremental, so a character split across two flushes still comes out right)
+        self.decoders = {fd: codecs.getincrementaldecoder('utf-8')('replace') for fd in self.buffers}
+        self.lock = threading.Lock()
+
+    def write(self, fd, data: bytes):
+        with self.lock:
+            buffer = self.buffers[fd]
+            buffer += data
+            full = len(buffer) >= self.buffer_size
+        if full:
+            self.flush()
+        else:
+            _pending.add(self)
+
+    def flush(self):
+        _pending.discard(self)
+        with self.lock:
+            for fd, buffer in self.buffers.items():
+                if not buffer:
+                    continue
+                if self.capture:
+                    self.captured[fd] += buffer
+                else:
+                    file = self.files[fd] or (sys.stdout if fd == 1 else sys.stderr)
+                    file.write(self.decoders[fd].decode(bytes(buffer)))
+                buffer.clear()
+
+    def getvalue(self, fd=1) -> str:
+        # everything captured so far
+        self.flush()
+        return self.captured[fd].decode('utf-8', 'replace')
+
+    def clear(self):
+        self.flush()
+        for captured in self.captured.values():
+            captured.clear()
+
+
+default_output = Output()
+# outputs with something in their buffers
+_pending = set()
+
+
+def flush_output():
+    # called at the end of every call into wasm (see main.wrapper_wrapper)
+    while _pending:
+        try:
+            _pending.pop().flush()
+        except KeyError:
+            break  # another thread got there first
+
+
+# per-thread state: each thread's store, and the runtimes it has loaded (see load_runtime)
+_local = threading.local()
+
 
+def thread_store() -> Store:
+    # one engine and store per thread, shared by everything that thread loads.
+    # like modules and instances, stores can't be used from any thread but the one that made them
+    store = getattr(_local, 'store', None)
+    if store is None:
+        store = _local.store = Store(engine.JIT(Compiler))
+    return store
+
+
+def run_wasm(wasm, runtime=None, use_cache=True, output=None):
+    # if runtime is given, wasm is just user code, which gets linked against it (see main.build_runtime)
+    # output is an Output, or None for default_output
+    if runtime is not None:
+        return run_linked(wasm, runtime, use_cache, output)
+
+    store = thread_store()
+    module = load_module(store, wasm, use_cache)
+    return instantiate(store, module, output)
+
+
+def instantiate(store, module, output=None):
     # the file has some imports we need to fill in
     # specifically: emscripten_resize_heap, emscripten_memcpy_big, fd_write, and setTempRet0
     # not all of these seem to be used, but it complains if we don't have them
@@ -34,26 +160,18 @@ def run_wasm(wasm):
         raise RuntimeError('setTempRet0', x)
 
     def fd_write(fd: int, iov: int, iovcnt: int, pnum: int) -> int:
-        # transcribed from emscripten (i have no idea how this works)
-        # reads what i can only assume to be a null-terminated string from memory into a file descriptor
-        # (currently only stdout is supported)
+        # iov points to iovcnt (pointer, length) pairs, each of which is a chunk of bytes to write.
+        # they're copied out of memory a slice at a time, and handed to the output in one go
+        # (only stdout and stderr are supported)
         if fd not in {1, 2}:
             raise NotImplementedError('trying to write to a file other than stdout/err!')
 
-        sink = {1: sys.stdout, 2: sys.stderr}[fd]
-
-        i32 = memory.int32_view()
-        u8 = memory.uint8_view()
-
-        num = 0
-        for i in range(iovcnt):
-            ptr = i32[((iov + (i * 8)) >> 2)]
-            len_ = i32[((iov + (i * 8 + 4)) >> 2)]
-            # i would write it as a slice, but the buffers are weird and return an int for slices of size 1
-            string = ''.join(chr(u8[ptr + j]) for j in range(len_))
-            print(string, end='', file=sink)
-            num += len_
-        i32[pnum >> 2] = num
+        # (the buffer has to be fetched each time, since the memory might have grown)
+        buffer = memoryview(memory.buffer)
+        iovecs = struct.unpack_from(f'<{2 * iovcnt}I', buffer, iov)
+        data = b''.join(buffer[ptr:ptr + len_] for ptr, len_ in zip(iovecs[::2], iovecs[1::2]))
+        output.write(fd, data)
+        struct.pack_into('<I', buffer, pnum, len(data))
         return 0
 
     def fd_close(x: int) -> int:
@@ -84,6 +202,9 @@ def run_wasm(wasm):
         }
     )
 
+    if output is None:
+        output = default_output
+
     # Now the module is compiled, we can instantiate it.
     instance = Instance(module, import_object)
     memory: Memory = instance.exports.memory
@@ -91,6 +212,257 @@ def run_wasm(wasm):
     return instance
 
 
+# the runtime's heap statistics (see HeapStats in c/Include/object.h): a set of counters per type,
+# in get_type order (with anything else first)
+HEAP_STATS_TYPES = ['other', 'int', 'tuple', 'bool', 'None', 'float']
+HEAP_STATS_FIELDS = ['live', 'allocations', 'free_list_hits', 'bytes_in_use']
+
+
+def read_heap_stats(instance) -> dict:
+    # one call into the runtime, which returns a pointer to its counters, and then they're all read out at once
+    exports = instance.exports
+    ptr = exports.get_heap_stats()
+    counters = struct.unpack_from(
+        f'<{len(HEAP_STATS_TYPES) * len(HEAP_STATS_FIELDS)}I', memoryview(exports.memory.buffer), ptr,
+    )
+    n = len(HEAP_STATS_FIELDS)
+    types = {
+        type_name: dict(zip(HEAP_STATS_FIELDS, counters[i * n:(i + 1) * n]))
+        for i, type_name in enumerate(HEAP_STATS_TYPES)
+    }
+    return {
+        'types': types,
+        'totals': {field: sum(stats[field] for stats in types.values()) for field in HEAP_STATS_FIELDS},
+        # (the heap is only part of this, but it's the number that matters for sizing)
+        'memory_size': exports.memory.data_size,
+    }
+
+
+# prebuilt runtimes, keyed by the hash of their wasm. Each one only gets compiled once per process,
+# which is the point: user code linked against it then only has to compile itself.
+# modules can't be used outside the thread that made them, so what's shared is the native code,
+# and each thread deserializes its own copy (which is cheap)
+runtimes = {}
+
+
+def load_runtime(runtime: bytes, use_cache=True):
+    key = hashlib.sha256(runtime).digest()
+    store = thread_store()
+    modules = _local.__dict__.setdefault('runtimes', {})
+    if key not in modules:
+        if key in runtimes:
+            modules[key] = Module.deserialize(store, runtimes[key])
+        else:
+            modules[key] = load_module(store, runtime, use_cache)
+            runtimes[key] = modules[key].serialize()
+    return store, modules[key]
+
+
+class LinkedExports:
+    # looks in the user's module first, then in the runtime
+    def __init__(self, *exports):
+        self.exports = exports
+
+    def __getattr__(self, name):
+        for exports in self.exports:
+            try:
+                return getattr(exports, name)
+            except LookupError:
+                pass
+        raise AttributeError(name)
+
+
+class LinkedInstance:
+    def __init__(self, instance, runtime_instance):
+        self.instance = instance
+        self.runtime_instance = runtime_instance
+        self.exports = LinkedExports(instance.exports, runtime_instance.exports)
+
+
+def run_linked(wasm, runtime, use_cache=True, output=None):
+    store, runtime_module = load_runtime(runtime, use_cache)
+    return instantiate_linked(store, load_module(store, wasm, use_cache), runtime_module, output)
+
+
+def instantiate_linked(store, module, runtime_module, output=None):
+    # every user module gets its own copy of the runtime, so they can't trample on each other's memory
+    runtime_instance = instantiate(store, runtime_module, output)
+
+    import_object = ImportObject()
+    for namespace in {i.module for i in module.imports}:
+        import_object.register(namespace, {
+            i.name: getattr(runtime_instance.exports, i.name)
+            for i in module.imports if i.module == namespace
+        })
+
+    return LinkedInstance(Instance(module, import_object), runtime_instance)
+
+
+class InstancePool:
+    # one instance per thread, all of the same compiled module, so that several threads can call the same
+    # functions at once without sharing a linear memory (or tripping wasmer's checks for using an instance
+    # from the wrong thread). The module is only compiled once: other threads deserialize its native code.
+    # note that each instance has its own globals too, so e.g. a mutated global is only seen by that thread.
+    def __init__(self, wasm, runtime=None, use_cache=True, output=None):
+        self.runtime = runtime
+        self.use_cache = use_cache
+        self.output = output
+        self.native = load_module(thread_store(), wasm, use_cache).serialize()
+        self.local = threading.local()
+
+    @property
+    def instance(self):
+        instance = getattr(self.local, 'instance', None)
+        if instance is None:
+            store = thread_store()
+            module = Module.deserialize(store, self.native)
+            if self.runtime is not None:
+                runtime_module = load_runtime(self.runtime, self.use_cache)[1]
+                instance = instantiate_linked(store, module, runtime_module, self.output)
+            else:
+                instance = instantiate(store, module, self.output)
+            self.local.instance = instance
+        return instance
+
+    @property
+    def exports(self):
+        return self.instance.exports
+
+
+def load_baseline(wasm, use_cache=True):
+    # singlepass doesn't support everything (e.g. multi-value), in which case it's cranelift after all
+    if BaselineCompiler is not None:
+        store = Store(engine.JIT(BaselineCompiler))
+        try:
+            return store, load_module(store, wasm, use_cache, BaselineCompiler)
+        except RuntimeError:
+            pass
+    store = Store(engine.JIT(Compiler))
+    return store, load_module(store, wasm, use_cache)
+
+
+class TieredInstance:
+    # starts out on a quickly compiled baseline instance, so calls can start straight away, while the optimised
+    # module is compiled in a background thread. Once that's ready, it gets swapped in on the next access to .exports,
+    # which can be part way through a wrapper (e.g. between writing the arguments and looking up the function).
+    # that's fine, because the memory and mutable globals are copied across, so pointers into the old instance
+    # stay valid in the new one, and as far as callers are concerned nothing changes.
+    def __init__(self, baseline, optimise, use_cache=True, output=None):
+        # baseline is the wasm to start with, and optimise is a function that returns the wasm to end up with
+        store, module = load_baseline(baseline, use_cache)
+        self.output = output
+        self.instance = instantiate(store, module, output)
+        self.ready = None
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.build_optimised, args=(optimise, use_cache), daemon=True)
+        self.thread.start()
+
+    def build_optimised(self, optimise, use_cache):
+        # wasmer objects can't be used from any thread but the one that made them,
+        # so this hands back serialised native code, which the swap turns into an instance.
+        try:
+            self.ready = load_module(Store(engine.JIT(Compiler)), optimise(), use_cache).serialize()
+        except Exception as e:
+            # not fatal, we just stay on the baseline
+            warnings.warn(f'failed to build optimised module: {e!r}', RuntimeWarning)
+
+    @property
+    def exports(self):
+        if self.ready is not None:
+            self.swap()
+        return self.instance.exports
+
+    def wait(self):
+        # blocks until the optimised instance is in use (or has failed to build)
+        self.thread.join()
+        if self.ready is not None:
+            self.swap()
+
+    def swap(self):
+        with self.lock:
+            native, self.ready = self.ready, None
+            if native is None:
+                return
+            store = Store(engine.JIT(Compiler))
+            old, new = self.instance, instantiate(store, Module.deserialize(store, native), self.output)
+
+            old_memory, new_memory = old.exports.memory, new.exports.memory
+            if old_memory.size > new_memory.size:
+                new_memory.grow(old_memory.size - new_memory.size)
+            memoryview(new_memory.buffer)[:] = memoryview(old_memory.buffer)
+
+            for name, export in old.exports:
+                if isinstance(export, Global) and export.mutable:
+                    getattr(new.exports, name).value = export.value
+
+            self.instance = new
+
+
+def wasm_instances(instance) -> list:
+    # the wasmer instances behind any of the kinds of instance above
+    if isinstance(instance, LinkedInstance):
+        return [instance.instance, instance.runtime_instance]
+    if isinstance(instance, (TieredInstance, InstancePool, ResettableInstance)):
+        return wasm_instances(instance.instance)
+    return [instance]
+
+
+def fixed_exports(instance):
+    # the exports of instance, if they're always going to be the same ones (so they can be looked up in advance),
+    # otherwise None (a tiered instance swaps its instance, and a pool has one per thread)
+    if isinstance(instance, ResettableInstance):
+        return fixed_exports(instance.instance)
+    if isinstance(instance, (TieredInstance, InstancePool)):
+        return None
+    return instance.exports
+
+
+class Snapshot:
+    # a copy of an instance's state: all of its linear memory, and all of its mutable globals
+    # (everything mutable is exported, including the runtime's stack pointer -- see parse_wat.Module)
+    def __init__(self, instance):
+        self.memory = bytes(memoryview(instance.exports.memory.buffer))
+        self.globals = [
+            {name: export.value for name, export in wasm_instance.exports
+             if isinstance(export, Global) and export.mutable}
+            for wasm_instance in wasm_instances(instance)
+        ]
+
+    def restore(self, instance):
+        # puts the state back in place, which is just a memcpy and a few global writes.
+        # memory can't shrink, so anything it's grown by since is zeroed instead, like it would be in a new instance
+        buffer = memoryview(instance.exports.memory.buffer)
+        size = len(self.memory)
+        buffer[:size] = self.memory
+        if len(buffer) > size:
+            buffer[size:] = bytes(len(buffer) - size)
+
+        for wasm_instance, values in zip(wasm_instances(instance), self.globals):
+            for name, value in values.items():
+                getattr(wasm_instance.exports, name).value = value
+
+
+class ResettableInstance:
+    # an instance that remembers the state it started in, and can be put back into it (see Snapshot) with reset().
+    # that's much cheaper than making a new instance, so it's good for isolating requests from each other.
+    # if reset_on_trap, a call that traps resets it too (see main.wrapper_wrapper), since the state is undefined after
+    # a trap: the stack pointer is wherever it was, and anything allocated has leaked.
+    def __init__(self, instance, reset_on_trap=True):
+        self.instance = instance
+        self.reset_on_trap = reset_on_trap
+        self.snapshot = Snapshot(instance)
+        # counts resets, so anything pointing into the memory (i.e. a buffers.Buffer) can tell it's been freed
+        self.generation = 0
+
+    @property
+    def exports(self):
+        return self.instance.exports
+
+    def reset(self):
+        self.snapshot.restore(self.instance)
+        self.generation += 1
+
+
 # noinspection PyArgumentList,PyUnresolvedReferences
 def run_wasm_function(wasm, func_name, *args):
     store = Store(engine.JIT(Compiler))
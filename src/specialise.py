@@ -0,0 +1,159 @@
+# generates a python wrapper for each compiled function, specialised to its signature.
+# wrapper_wrapper works for anything, but pays for it on every call: it looks up the export by name,
+# takes *args, and marshals everything. These wrappers take the function's actual parameters, have their exports
+# bound in advance, and turn scalar arguments (if that's what the annotations say they are) straight into
+# PyObjects. Anything the annotations don't cover goes through the generic wrapper instead.
+# functions annotated with nothing but ints and floats get a native export (see CodeGenerator.native_export), which
+# takes and returns plain numbers, and that gets used in preference to everything else.
+import inspect
+
+import marshalling
+from run_wasm import fixed_exports, flush_output
+
+# the range of a C long in the runtime (it's 32 bit), which is what PyLong_FromLong takes
+LONG_MIN, LONG_MAX = -2 ** 31, 2 ** 31 - 1
+# and of an i64, which is what native exports take
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+# for each scalar annotation: a guard that the argument really is one, and how to convert it
+SCALARS = {
+    int: ('type({0}) is int and LONG_MIN <= {0} <= LONG_MAX', 'PyLong_FromLong({0})'),
+    float: ('type({0}) is float', 'PyFloat_FromDouble({0})'),
+}
+
+# the same for native exports: a guard for each argument, and a check that the result could be unboxed
+# (if not, native.c returns a sentinel and keeps the result for us)
+NATIVE_SCALARS = {
+    int: ('type({0}) is int and INT64_MIN <= {0} <= INT64_MAX', 'rv != INT64_MIN'),
+    float: ('type({0}) is float', 'rv == rv'),
+}
+
+TEMPLATE = '''\
+def wrapper({params}):
+    if {guard}:
+        args = {args}
+    else:
+        return generic({params})
+    try:
+        rv = export(*args)
+    except RuntimeError:
+        if reset_on_trap:
+            instance.reset()
+        raise
+    finally:
+        flush_output()
+    ptr = marshal_return(rv)
+    # (after the call, which might have grown the memory)
+    value = decode(memoryview(memory.buffer), ptr + 4)[0]
+    py_decref(rv)
+    return value
+'''
+
+NATIVE_TEMPLATE = '''\
+def wrapper({params}):
+    if not ({guard}):
+        return generic({params})
+    try:
+        rv = native({params})
+    except RuntimeError:
+        if reset_on_trap:
+            instance.reset()
+        raise
+    finally:
+        flush_output()
+    if {unboxed}:
+        return rv
+    # it didn't fit, so it comes back the usual way (unless it was a NaN all along)
+    boxed = take_boxed()
+    if not boxed:
+        return rv
+    ptr = marshal_return(boxed)
+    value = decode(memoryview(memory.buffer), ptr + 4)[0]
+    # (take_boxed handed us its reference)
+    py_decref(boxed)
+    return value
+'''
+
+
+def scalar_type(annotation):
+    # (annotations might be strings, e.g. with `from __future__ import annotations`)
+    for scalar in SCALARS:
+        if annotation in (scalar, scalar.__name__):
+            return scalar
+    return None
+
+
+def native_signature(func):
+    # the scalar types of the parameters and return value, if they're all ints and floats, which is what it takes
+    # to get a native export (see CodeGenerator.native_export). Otherwise None
+    code = func.__code__
+    if code.co_kwonlyargcount or code.co_flags & (inspect.CO_VARARGS | inspect.CO_VARKEYWORDS):
+        return None
+    annotations = getattr(func, '__annotations__', {})
+    params = [scalar_type(annotations.get(arg)) for arg in code.co_varnames[:code.co_argcount]]
+    result = scalar_type(annotations.get('return'))
+    if result is None or not all(params):
+        return None
+    return params, result
+
+
+def specialised_wrapper(func, func_name, instance, generic):
+    # generic is the wrapper to fall back on (see main.wrapper_wrapper), which is also used as is if the instance's
+    # exports can change (e.g. a tiered instance) or the function takes anything other than plain parameters
+    exports = fixed_exports(instance)
+    try:
+        params = list(inspect.signature(func).parameters.values())
+    except (TypeError, ValueError):
+        return generic
+    if exports is None or any(param.kind != param.POSITIONAL_OR_KEYWORD for param in params):
+        return generic
+
+    names = [f'arg_{i}' for i in range(len(params))]
+    scalars = [scalar_type(param.annotation) for param in params]
+    try:
+        native = getattr(exports, f'__{func_name}_native')
+    except (AttributeError, LookupError):
+        native = None
+
+    if native is not None:
+        result = scalar_type(inspect.signature(func).return_annotation)
+        guard = ' and '.join(NATIVE_SCALARS[scalar][0].format(name) for scalar, name in zip(scalars, names)) or 'True'
+        source = NATIVE_TEMPLATE.format(params=', '.join(names), guard=guard, unboxed=NATIVE_SCALARS[result][1])
+    else:
+        if params and all(scalars):
+            guard = ' and '.join(SCALARS[scalar][0].format(name) for scalar, name in zip(scalars, names))
+            args = '(' + ''.join(SCALARS[scalar][1].format(name) + ', ' for scalar, name in zip(scalars, names)) + ')'
+        else:
+            # (the marshalled path takes anything, so there's nothing to guard)
+            guard = 'True'
+            area = exports.get_marshal_area()
+            args = f'write_args(exports, {area}, ({"".join(name + ", " for name in names)}))'
+        source = TEMPLATE.format(params=', '.join(names), guard=guard, args=args)
+
+    namespace = {
+        'LONG_MIN': LONG_MIN,
+        'LONG_MAX': LONG_MAX,
+        'INT64_MIN': INT64_MIN,
+        'INT64_MAX': INT64_MAX,
+        'native': native,
+        'take_boxed': exports.native_take_boxed,
+        'py_decref': exports.py_decref,
+        'PyLong_FromLong': exports.PyLong_FromLong,
+        'PyFloat_FromDouble': exports.PyFloat_FromDouble,
+        'write_args': marshalling.write_args,
+        'exports': exports,
+        'export': getattr(exports, func_name),
+        'generic': generic,
+        'instance': instance,
+        'reset_on_trap': getattr(instance, 'reset_on_trap', False),
+        'flush_output': flush_output,
+        'memory': exports.memory,
+        'marshal_return': exports.marshal_return,
+        'decode': marshalling.decode,
+    }
+    exec(compile(source, f'<wrapper for {func_name}>', 'exec'), namespace)
+
+    wrapper = namespace['wrapper']
+    wrapper.__name__ = wrapper.__qualname__ = func_name
+    wrapper.instance = instance
+    return wrapper
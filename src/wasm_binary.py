@@ -0,0 +1,948 @@
+# encodes a parse_wat.Module straight into the wasm binary format, so we don't have to go via wat2wasm.
+# it only understands the parts of the text format that actually show up here: whatever wasm2wat produces for
+# the runtime, and whatever generate_code produces for user code. Anything else raises NotImplementedError,
+# which Module.compile treats as a signal to fall back to wat2wasm.
+from __future__ import annotations
+
+import struct
+from typing import Optional
+
+from parse_wat import Node, KeywordLiteral, StringLiteral, tree_ify, tokenize_buffer
+
+
+def uleb(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def sleb(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if (n == 0 and not byte & 0x40) or (n == -1 and byte & 0x40):
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+
+def vec(items) -> bytes:
+    items = list(items)
+    return uleb(len(items)) + b''.join(items)
+
+
+def name_bytes(name: str) -> bytes:
+    data = name.encode()
+    return uleb(len(data)) + data
+
+
+VALUE_TYPES = {'i32': 0x7f, 'i64': 0x7e, 'f32': 0x7d, 'f64': 0x7c, 'v128': 0x7b, 'funcref': 0x70, 'externref': 0x6f}
+REF_TYPES = {'func': 0x70, 'funcref': 0x70, 'extern': 0x6f, 'externref': 0x6f}
+EXPORT_KINDS = {'func': 0, 'table': 1, 'memory': 2, 'global': 3}
+SECTION_IDS = {
+    'type': 1, 'import': 2, 'function': 3, 'table': 4, 'memory': 5, 'global': 6,
+    'export': 7, 'start': 8, 'elem': 9, 'code': 10, 'data': 11,
+    'name': 0,  # (a custom section, so it can go anywhere -- wat2wasm puts it last)
+}
+
+# instruction name -> (opcode, kind of immediates it takes)
+OPCODES: dict[str, tuple[bytes, str]] = {}
+# memory instructions default to their natural alignment
+NATURAL_ALIGNMENT: dict[str, int] = {}
+
+
+def _add_opcodes(names, start, kind='none', prefix=None):
+    for i, name in enumerate(names.split()):
+        opcode = bytes([start + i]) if prefix is None else bytes([prefix]) + uleb(start + i)
+        OPCODES[name] = (opcode, kind)
+
+
+_add_opcodes('unreachable nop', 0x00)
+_add_opcodes('block loop if', 0x02, 'block')
+_add_opcodes('else', 0x05, 'else')
+_add_opcodes('end', 0x0b, 'end')
+_add_opcodes('br br_if', 0x0c, 'label')
+_add_opcodes('br_table', 0x0e, 'br_table')
+_add_opcodes('return', 0x0f)
+_add_opcodes('call', 0x10, 'call')
+_add_opcodes('call_indirect', 0x11, 'call_indirect')
+_add_opcodes('drop', 0x1a)
+_add_opcodes('select', 0x1b, 'select')
+_add_opcodes('local.get local.set local.tee', 0x20, 'local')
+_add_opcodes('global.get global.set', 0x23, 'global')
+_add_opcodes('table.get table.set', 0x25, 'table')
+_add_opcodes('memory.size memory.grow', 0x3f, 'memory')
+_add_opcodes('i32.const', 0x41, 'i32')
+_add_opcodes('i64.const', 0x42, 'i64')
+_add_opcodes('f32.const', 0x43, 'f32')
+_add_opcodes('f64.const', 0x44, 'f64')
+_add_opcodes('ref.null', 0xd0, 'ref.null')
+_add_opcodes('ref.is_null', 0xd1)
+_add_opcodes('ref.func', 0xd2, 'call')
+
+for _i, (_name, _align) in enumerate([
+    ('i32.load', 2), ('i64.load', 3), ('f32.load', 2), ('f64.load', 3),
+    ('i32.load8_s', 0), ('i32.load8_u', 0), ('i32.load16_s', 1), ('i32.load16_u', 1),
+    ('i64.load8_s', 0), ('i64.load8_u', 0), ('i64.load16_s', 1), ('i64.load16_u', 1),
+    ('i64.load32_s', 2), ('i64.load32_u', 2),
+    ('i32.store', 2), ('i64.store', 3), ('f32.store', 2), ('f64.store', 3),
+    ('i32.store8', 0), ('i32.store16', 1), ('i64.store8', 0), ('i64.store16', 1), ('i64.store32', 2),
+]):
+    OPCODES[_name] = (bytes([0x28 + _i]), 'memarg')
+    NATURAL_ALIGNMENT[_name] = _align
+
+_add_opcodes('''
+    i32.eqz i32.eq i32.ne i32.lt_s i32.lt_u i32.gt_s i32.gt_u i32.le_s i32.le_u i32.ge_s i32.ge_u
+    i64.eqz i64.eq i64.ne i64.lt_s i64.lt_u i64.gt_s i64.gt_u i64.le_s i64.le_u i64.ge_s i64.ge_u
+    f32.eq f32.ne f32.lt f32.gt f32.le f32.ge
+    f64.eq f64.ne f64.lt f64.gt f64.le f64.ge
+    i32.clz i32.ctz i32.popcnt i32.add i32.sub i32.mul i32.div_s i32.div_u i32.rem_s i32.rem_u
+    i32.and i32.or i32.xor i32.shl i32.shr_s i32.shr_u i32.rotl i32.rotr
+    i64.clz i64.ctz i64.popcnt i64.add i64.sub i64.mul i64.div_s i64.div_u i64.rem_s i64.rem_u
+    i64.and i64.or i64.xor i64.shl i64.shr_s i64.shr_u i64.rotl i64.rotr
+    f32.abs f32.neg f32.ceil f32.floor f32.trunc f32.nearest f32.sqrt
+    f32.add f32.sub f32.mul f32.div f32.min f32.max f32.copysign
+    f64.abs f64.neg f64.ceil f64.floor f64.trunc f64.nearest f64.sqrt
+    f64.add f64.sub f64.mul f64.div f64.min f64.max f64.copysign
+    i32.wrap_i64 i32.trunc_f32_s i32.trunc_f32_u i32.trunc_f64_s i32.trunc_f64_u
+    i64.extend_i32_s i64.extend_i32_u i64.trunc_f32_s i64.trunc_f32_u i64.trunc_f64_s i64.trunc_f64_u
+    f32.convert_i32_s f32.convert_i32_u f32.convert_i64_s f32.convert_i64_u f32.demote_f64
+    f64.convert_i32_s f64.convert_i32_u f64.convert_i64_s f64.convert_i64_u f64.promote_f32
+    i32.reinterpret_f32 i64.reinterpret_f64 f32.reinterpret_i32 f64.reinterpret_i64
+    i32.extend8_s i32.extend16_s i64.extend8_s i64.extend16_s i64.extend32_s
+''', 0x45)
+assert OPCODES['i64.extend32_s'][0] == b'\xc4'
+
+_add_opcodes('''
+    i32.trunc_sat_f32_s i32.trunc_sat_f32_u i32.trunc_sat_f64_s i32.trunc_sat_f64_u
+    i64.trunc_sat_f32_s i64.trunc_sat_f32_u i64.trunc_sat_f64_s i64.trunc_sat_f64_u
+''', 0, prefix=0xfc)
+_add_opcodes('memory.copy', 10, 'memory.copy', prefix=0xfc)
+_add_opcodes('memory.fill', 11, 'memory', prefix=0xfc)
+_add_opcodes('table.init', 12, 'table.init', prefix=0xfc)
+_add_opcodes('elem.drop', 13, 'elem', prefix=0xfc)
+_add_opcodes('table.grow table.size table.fill', 15, 'table', prefix=0xfc)
+
+HEADER_NODES = {'export', 'import', 'type', 'param', 'result', 'local'}
+TYPE_USE_NODES = {'type', 'param', 'result'}
+
+# instructions which refer to a func or global, and which index space they refer to
+REFERENCE_OPS = {'call': 'func', 'ref.func': 'func', 'global.get': 'global', 'global.set': 'global'}
+
+# the import module that user code links against the runtime with (see encode_linked)
+LINK_MODULE = 'runtime'
+
+
+def link_name(kind: str, index: int) -> str:
+    # what the runtime exports each func, global, table and memory as
+    return f'__link_{kind}_{index}'
+
+
+def _word(token):
+    # the content of a keyword, or None if it isn't one
+    if isinstance(token, KeywordLiteral) and len(token.content) == 1 and isinstance(token.content[0], str):
+        return token.content[0]
+    return None
+
+
+def _is_identifier(token):
+    word = _word(token)
+    return word is not None and word.startswith('$')
+
+
+def _is_instruction_node(token):
+    return (
+        isinstance(token, Node)
+        and not isinstance(token, (KeywordLiteral, StringLiteral))
+        and token.name not in TYPE_USE_NODES
+    )
+
+
+def _value_types(node: Node) -> list[str]:
+    types = []
+    for child in node.children:
+        word = _word(child)
+        if word is None or word.startswith('$'):
+            continue
+        if word not in VALUE_TYPES:
+            raise NotImplementedError(f'unsupported value type {word}')
+        types.append(word)
+    return types
+
+
+def _int_literal(token, bits) -> int:
+    # returns the value as a signed integer of the given width (the text format allows either signedness)
+    if isinstance(token, bool) or not isinstance(token, (int, KeywordLiteral)):
+        raise NotImplementedError(f'expected an integer, got {token!r}')
+    value = token if isinstance(token, int) else int(_word(token).replace('_', ''), 0)
+    if not -(1 << (bits - 1)) <= value < (1 << bits):
+        raise ValueError(f'constant {value} out of range for i{bits}')
+    if value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
+
+def _float_literal(token, bits) -> bytes:
+    fmt, exponent_bits, mantissa_bits = {32: ('<f', 8, 23), 64: ('<d', 11, 52)}[bits]
+
+    if isinstance(token, (int, float)) and not isinstance(token, bool):
+        return struct.pack(fmt, float(token))
+
+    word = _word(token)
+    if word is None:
+        raise NotImplementedError(f'expected a float, got {token!r}')
+    word = word.replace('_', '')
+    sign = 1 if word.startswith('-') else 0
+    magnitude = word.lstrip('+-')
+
+    if magnitude.startswith('nan'):
+        # nans get built by hand, so that the sign and payload survive
+        payload = int(magnitude[4:], 16) if magnitude.startswith('nan:') else 1 << (mantissa_bits - 1)
+        value = (sign << (bits - 1)) | (((1 << exponent_bits) - 1) << mantissa_bits) | payload
+        return value.to_bytes(bits // 8, 'little')
+    if magnitude == 'inf':
+        return struct.pack(fmt, float('-inf') if sign else float('inf'))
+    if magnitude.startswith('0x'):
+        return struct.pack(fmt, float.fromhex(word))
+    return struct.pack(fmt, float(word))
+
+
+def _references(tokens):
+    # yields (index space, token) for every func or global referred to by some instructions
+    for i, token in enumerate(tokens):
+        word = _word(token)
+        if word in REFERENCE_OPS and i + 1 < len(tokens):
+            yield REFERENCE_OPS[word], tokens[i + 1]
+        elif _is_instruction_node(token):
+            if token.name in REFERENCE_OPS and token.children:
+                yield REFERENCE_OPS[token.name], token.children[0]
+            yield from _references(token.children)
+
+
+def _reparse(node: Node) -> Node:
+    # generated nodes are a mixture of real tokens and snippets of wat (see generate_code.func),
+    # so the easiest way to get at their contents is to print and re-parse them. They're small, so it's cheap.
+    return tree_ify(tokenize_buffer(str(node)))
+
+
+class ModuleEncoder:
+    def __init__(self, module, names=False):
+        self.module = module
+        # whether to write a name section, which lets stack traces say which function they're in
+        self.names = names
+        self.func_debug_names: dict[int, str] = {}
+
+        self.types: list[tuple[tuple[str, ...], tuple[str, ...]]] = []
+        self.type_indices: dict[tuple, int] = {}
+        self.type_names: dict[str, int] = {}
+
+        self.func_names: dict[str, int] = {}
+        self.global_names: dict[str, int] = {}
+        self.table_names: dict[str, int] = {}
+        self.memory_names: dict[str, int] = {}
+
+        self.imported = {'func': [], 'table': [], 'memory': [], 'global': []}
+        self.import_entries: list[bytes] = []
+
+        # when linking, maps indices in the merged module to their new indices (see encode_linked)
+        self.func_remap: Optional[dict[int, int]] = None
+        self.global_remap: Optional[dict[int, int]] = None
+
+        # (position in the module, encoded export), so they can be written in the same order as wat2wasm would
+        self.exports: list[tuple[int, bytes]] = []
+        self.positions = {id(node): i for i, node in enumerate(module.children)}
+
+    # --- types ---
+
+    def type_index(self, params, results) -> int:
+        signature = (tuple(params), tuple(results))
+        if signature not in self.type_indices:
+            self.type_indices[signature] = len(self.types)
+            self.types.append(signature)
+        return self.type_indices[signature]
+
+    def add_type_node(self, node: Node):
+        children = node.children
+        if _is_identifier(children[0]):
+            self.type_names[_word(children[0])] = len(self.types)
+            children = children[1:]
+        func_type = children[0]
+        params, results = self.signature(func_type.children)
+        # keep duplicate types where they are, since the runtime refers to them by index
+        signature = (tuple(params), tuple(results))
+        self.type_indices.setdefault(signature, len(self.types))
+        self.types.append(signature)
+
+    @staticmethod
+    def signature(nodes) -> tuple[list[str], list[str]]:
+        params, results = [], []
+        for node in nodes:
+            if isinstance(node, Node) and node.name == 'param':
+                params.extend(_value_types(node))
+            elif isinstance(node, Node) and node.name == 'result':
+                results.extend(_value_types(node))
+        return params, results
+
+    def type_use(self, nodes) -> int:
+        # a (type n) wins if there is one, otherwise find (or add) a type matching the params and results
+        for node in nodes:
+            if node.name == 'type':
+                return self.resolve(node.children[0], self.type_names)
+        return self.type_index(*self.signature(nodes))
+
+    def block_type(self, nodes) -> bytes:
+        if any(node.name == 'type' for node in nodes):
+            return sleb(self.type_use(nodes))
+        params, results = self.signature(nodes)
+        if not params and not results:
+            return b'\x40'
+        if not params and len(results) == 1:
+            return bytes([VALUE_TYPES[results[0]]])
+        return sleb(self.type_index(params, results))
+
+    # --- names ---
+
+    @staticmethod
+    def resolve(token, names: dict[str, int]) -> int:
+        if isinstance(token, int) and not isinstance(token, bool):
+            return token
+        word = _word(token)
+        if word is not None and word in names:
+            return names[word]
+        raise NotImplementedError(f'cannot resolve reference {token!r}')
+
+    def func_index(self, token) -> int:
+        index = self.resolve(token, self.func_names)
+        return index if self.func_remap is None else self.func_remap[index]
+
+    def global_index(self, token) -> int:
+        index = self.resolve(token, self.global_names)
+        return index if self.global_remap is None else self.global_remap[index]
+
+    def collect_names(self, nodes, names, start=0):
+        for i, node in enumerate(nodes, start):
+            if node.children and _is_identifier(node.children[0]):
+                names[_word(node.children[0])] = i
+
+    # --- instructions ---
+
+    def encode_instructions(self, tokens, out: bytearray, labels: list, local_names: dict):
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            i += 1
+            word = _word(token)
+            if word is not None:
+                i = self.encode_instruction(word, tokens, i, out, labels, local_names)
+            elif _is_instruction_node(token):
+                self.encode_folded(token, out, labels, local_names)
+            else:
+                raise NotImplementedError(f'unexpected token in instructions: {token!r}')
+
+    def encode_folded(self, node: Node, out: bytearray, labels: list, local_names: dict):
+        # (op immediates... operands...) is the same as operands... op immediates...
+        if node.name in ('block', 'loop', 'if'):
+            raise NotImplementedError(f'folded {node.name} is not supported')
+        immediates = [child for child in node.children if not _is_instruction_node(child)]
+        for child in node.children:
+            if _is_instruction_node(child):
+                self.encode_folded(child, out, labels, local_names)
+        end = self.encode_instruction(node.name, immediates, 0, out, labels, local_names)
+        if end != len(immediates):
+            raise NotImplementedError(f'unexpected immediates in {node!r}')
+
+    def encode_instruction(self, op: str, tokens, i: int, out: bytearray, labels: list, local_names: dict) -> int:
+        # writes a single instruction to out, consuming its immediates from tokens[i:]. Returns the new position.
+        try:
+            opcode, kind = OPCODES[op]
+        except KeyError:
+            raise NotImplementedError(f'unsupported instruction {op}') from None
+
+        def peek():
+            return tokens[i] if i < len(tokens) else None
+
+        def type_use_nodes():
+            nonlocal i
+            nodes = []
+            while isinstance(peek(), Node) and peek().name in TYPE_USE_NODES:
+                nodes.append(tokens[i])
+                i += 1
+            return nodes
+
+        if kind == 'select':
+            # select can optionally be given its result type
+            nodes = type_use_nodes()
+            if nodes:
+                out += b'\x1c' + vec(bytes([VALUE_TYPES[t]]) for t in self.signature(nodes)[1])
+            else:
+                out += opcode
+            return i
+
+        out += opcode
+
+        if kind == 'none':
+            pass
+        elif kind == 'block':
+            label = None
+            if _is_identifier(peek()):
+                label = _word(tokens[i])
+                i += 1
+            out += self.block_type(type_use_nodes())
+            labels.append(label)
+        elif kind in ('else', 'end'):
+            if kind == 'end' and labels:
+                labels.pop()
+            if _is_identifier(peek()):
+                i += 1
+        elif kind in ('label', 'br_table'):
+            targets = []
+            while isinstance(peek(), int) or _is_identifier(peek()):
+                targets.append(self.label_depth(tokens[i], labels))
+                i += 1
+                if kind == 'label':
+                    break
+            if not targets:
+                raise NotImplementedError(f'{op} without a label')
+            if kind == 'br_table':
+                out += vec(uleb(t) for t in targets[:-1])
+            out += uleb(targets[-1])
+        elif kind == 'call':
+            out += uleb(self.func_index(tokens[i]))
+            i += 1
+        elif kind == 'call_indirect':
+            table = 0
+            if isinstance(peek(), int) or _is_identifier(peek()):
+                table = self.resolve(tokens[i], self.table_names)
+                i += 1
+            out += uleb(self.type_use(type_use_nodes())) + uleb(table)
+        elif kind == 'local':
+            out += uleb(self.resolve(tokens[i], local_names))
+            i += 1
+        elif kind == 'global':
+            out += uleb(self.global_index(tokens[i]))
+            i += 1
+        elif kind == 'table':
+            table = 0
+            if isinstance(peek(), int) or _is_identifier(peek()):
+                table = self.resolve(tokens[i], self.table_names)
+                i += 1
+            out += uleb(table)
+        elif kind == 'table.init':
+            # (only the single table form, table.init elemidx)
+            out += uleb(tokens[i]) + b'\x00'
+            i += 1
+        elif kind == 'elem':
+            out += uleb(tokens[i])
+            i += 1
+        elif kind == 'memory':
+            out += b'\x00'
+        elif kind == 'memory.copy':
+            out += b'\x00\x00'
+        elif kind == 'memarg':
+            offset, align = 0, 1 << NATURAL_ALIGNMENT[op]
+            while (word := _word(peek())) is not None and word.startswith(('offset=', 'align=')):
+                key, value = word.split('=')
+                if key == 'offset':
+                    offset = int(value.replace('_', ''), 0)
+                else:
+                    align = int(value.replace('_', ''), 0)
+                i += 1
+            out += uleb(align.bit_length() - 1) + uleb(offset)
+        elif kind in ('i32', 'i64'):
+            out += sleb(_int_literal(tokens[i], int(kind[1:])))
+            i += 1
+        elif kind in ('f32', 'f64'):
+            out += _float_literal(tokens[i], int(kind[1:]))
+            i += 1
+        elif kind == 'ref.null':
+            out.append(REF_TYPES[_word(tokens[i])])
+            i += 1
+        else:
+            raise RuntimeError(f'unknown immediate kind {kind}')
+        return i
+
+    @staticmethod
+    def label_depth(token, labels) -> int:
+        if isinstance(token, int):
+            return token
+        name = _word(token)
+        for depth, label in enumerate(reversed(labels)):
+            if label == name:
+                return depth
+        raise ValueError(f'unknown label {name}')
+
+    def encode_expression(self, tokens) -> bytes:
+        # constant expressions, as used by globals, elems and data
+        out = bytearray()
+        self.encode_instructions(tokens, out, [], {})
+        return bytes(out) + b'\x0b'
+
+    # --- functions ---
+
+    @staticmethod
+    def split_func(func: Node) -> tuple[list[Node], list]:
+        # returns (header, body): header being the export/type/param/result/local nodes
+        children = func.children
+        start = 0
+        if children and _is_identifier(children[0]):
+            start = 1
+
+        header = []
+        for child in children[start:]:
+            if isinstance(child, Node) and not isinstance(child, (KeywordLiteral, StringLiteral)) \
+                    and child.name in HEADER_NODES:
+                header.append(child)
+                start += 1
+            else:
+                break
+        return header, children[start:]
+
+    def func_type(self, func: Node) -> int:
+        encoded = getattr(func, 'encoded', None)
+        if encoded is not None:
+            return encoded[0]
+        header, _ = self.split_func(func)
+        return self.type_use([node for node in header if node.name in TYPE_USE_NODES])
+
+    def encode_func(self, func: Node) -> tuple[int, bytes]:
+        # returns (type index, body)
+        header, body = self.split_func(func)
+
+        local_names = {}
+        local_types = []
+        param_count = 0
+        for node in header:
+            if node.name in ('param', 'local'):
+                if node.children and _is_identifier(node.children[0]):
+                    local_names[_word(node.children[0])] = param_count + len(local_types)
+                types = _value_types(node)
+                if node.name == 'param':
+                    param_count += len(types)
+                else:
+                    local_types.extend(types)
+            elif node.name == 'import':
+                raise NotImplementedError('inline function imports are not supported')
+
+        type_index = self.type_use([node for node in header if node.name in TYPE_USE_NODES])
+
+        # locals are run-length encoded
+        runs = []
+        for t in local_types:
+            if runs and runs[-1][0] == t:
+                runs[-1][1] += 1
+            else:
+                runs.append([t, 1])
+
+        out = bytearray(vec(uleb(count) + bytes([VALUE_TYPES[t]]) for t, count in runs))
+        self.encode_instructions(body, out, [], local_names)
+        out += b'\x0b'
+        return type_index, bytes(out)
+
+    def inline_exports(self, node: Node, kind: str, index: int, position: int):
+        for child in node.children:
+            if isinstance(child, Node) and not isinstance(child, (KeywordLiteral, StringLiteral)) \
+                    and child.name == 'export':
+                entry = name_bytes(child.children[0].content) + bytes([EXPORT_KINDS[kind]]) + uleb(index)
+                self.exports.append((position, entry))
+                if kind == 'func':
+                    self.func_debug_names.setdefault(index, child.children[0].content)
+
+    def debug_name(self, func: Node, index: int):
+        # a $name beats an export name (see inline_exports), so this has to be called first
+        if func.children and _is_identifier(func.children[0]):
+            self.func_debug_names.setdefault(index, _word(func.children[0])[1:])
+
+    # --- the module ---
+
+    def encode_imports(self) -> list[bytes]:
+        # imports come first in each index space
+        for node in self.module.imports:
+            module_name, field_name, desc = node.children
+            kind = desc.name
+            names = {'func': self.func_names, 'table': self.table_names,
+                     'memory': self.memory_names, 'global': self.global_names}[kind]
+            if desc.children and _is_identifier(desc.children[0]):
+                names[_word(desc.children[0])] = len(self.imported[kind])
+            self.imported[kind].append(desc)
+
+            entry = name_bytes(module_name.content) + name_bytes(field_name.content) + bytes([EXPORT_KINDS[kind]])
+            if kind == 'func':
+                entry += uleb(self.type_use([c for c in desc.children if isinstance(c, Node)
+                                             and c.name in TYPE_USE_NODES]))
+            elif kind == 'global':
+                entry += self.global_type(desc.children)
+            else:
+                raise NotImplementedError(f'{kind} imports are not supported')
+            self.import_entries.append(entry)
+
+    def module_fields(self):
+        memories = [n for n in self.module.misc_nodes if n.name == 'memory']
+        datas = [n for n in self.module.misc_nodes if n.name == 'data']
+        starts = [n for n in self.module.misc_nodes if n.name == 'start']
+        for node in self.module.misc_nodes:
+            if node.name not in ('memory', 'data', 'start'):
+                raise NotImplementedError(f'unsupported module field {node.name}')
+        return memories, datas, starts
+
+    def encode(self, link_exports=False) -> bytes:
+        # link_exports is for building the runtime on its own: it exports every func and global (along with the
+        # memory and table) under a predictable name, so that user code can be linked against it (see encode_linked)
+        module = self.module
+        parsed_func_count = getattr(module, 'parsed_func_count', 0)
+        sections: dict[str, bytes] = {}
+
+        for node in module.types:
+            self.add_type_node(node)
+
+        globals_ = [_reparse(g) for g in module.globals]
+        elems = [_reparse(e) for e in module.elems]
+        funcs = [f if i < parsed_func_count else _reparse(f) for i, f in enumerate(module.funcs)]
+        memories, datas, starts = self.module_fields()
+
+        self.encode_imports()
+        imported = self.imported
+        self.collect_names(funcs, self.func_names, len(imported['func']))
+        self.collect_names(globals_, self.global_names, len(imported['global']))
+        self.collect_names(module.table, self.table_names, len(imported['table']))
+        self.collect_names(memories, self.memory_names, len(imported['memory']))
+
+        if self.import_entries:
+            sections['import'] = vec(self.import_entries)
+
+        func_types = []
+        bodies = []
+        for i, func in enumerate(funcs):
+            index = len(imported['func']) + i
+            # the runtime's functions never change, so their encoding is cached on the node itself.
+            # that's only safe if they didn't need any new types, since those are numbered per-module.
+            cached = getattr(func, 'encoded', None)
+            if cached is None:
+                type_count = len(self.types)
+                cached = self.encode_func(func)
+                if i < parsed_func_count and len(self.types) == type_count:
+                    func.encoded = cached
+            type_index, body = cached
+            func_types.append(uleb(type_index))
+            bodies.append(uleb(len(body)) + body)
+            self.debug_name(func, index)
+            self.inline_exports(func, 'func', index, self.positions[id(module.funcs[i])])
+
+        if funcs:
+            sections['function'] = vec(func_types)
+
+        tables = []
+        for i, table in enumerate(module.table):
+            values = [c for c in table.children if not isinstance(c, Node) or _word(c) in REF_TYPES]
+            limits = [v for v in values if isinstance(v, int)]
+            ref_type = [REF_TYPES[_word(v)] for v in values if not isinstance(v, int)]
+            if link_exports:
+                # user code adds itself to the table, so it can't have a max size
+                limits = limits[:1]
+            tables.append(bytes(ref_type) + self.limits(limits))
+            self.inline_exports(table, 'table', len(imported['table']) + i, self.positions[id(table)])
+        if tables:
+            sections['table'] = vec(tables)
+
+        memory_entries = []
+        for i, memory in enumerate(memories):
+            memory_entries.append(self.limits([c for c in memory.children if isinstance(c, int)]))
+            self.inline_exports(memory, 'memory', len(imported['memory']) + i, self.positions[id(memory)])
+        if memory_entries:
+            sections['memory'] = vec(memory_entries)
+
+        global_entries = []
+        for i, glob in enumerate(globals_):
+            value_type, init = self.split_global(glob)
+            global_entries.append(self.global_type(value_type) + self.encode_expression(init))
+            self.inline_exports(glob, 'global', len(imported['global']) + i,
+                                self.positions[id(module.globals[i])])
+        if global_entries:
+            sections['global'] = vec(global_entries)
+
+        index_spaces = {'func': self.func_names, 'table': self.table_names,
+                        'memory': self.memory_names, 'global': self.global_names}
+        for export in module.exports:
+            index = self.resolve(export.ref_index, index_spaces[export.ref_type])
+            entry = name_bytes(export.ref_name) + bytes([EXPORT_KINDS[export.ref_type]]) + uleb(index)
+            self.exports.append((self.positions[id(export)], entry))
+            if export.ref_type == 'func':
+                self.func_debug_names.setdefault(index, export.ref_name)
+
+        if link_exports:
+            end = len(module.children)
+            for kind, count in [('func', len(imported['func']) + len(funcs)),
+                                ('global', len(imported['global']) + len(globals_)),
+                                ('table', 1), ('memory', 1)]:
+                for i in range(count):
+                    self.exports.append((end, name_bytes(link_name(kind, i)) + bytes([EXPORT_KINDS[kind]]) + uleb(i)))
+
+        if self.exports:
+            self.exports.sort(key=lambda export: export[0])
+            sections['export'] = vec(entry for _, entry in self.exports)
+
+        if starts:
+            sections['start'] = uleb(self.func_index(starts[0].children[0]))
+
+        if elems:
+            sections['elem'] = vec(self.encode_elem(elem) for elem in elems)
+
+        if bodies:
+            sections['code'] = vec(bodies)
+
+        if datas:
+            sections['data'] = vec(self.encode_data(data) for data in datas)
+
+        return self.assemble(sections)
+
+    def encode_linked(self) -> bytes:
+        # encodes just the generated parts of the module (user code, and the globals and table entries that go with
+        # it), importing whatever they use from a separately built runtime (see encode(link_exports=True)).
+        # indices in the merged module get remapped: imports come first, then the generated funcs and globals.
+        module = self.module
+        sections: dict[str, bytes] = {}
+
+        for node in module.types:
+            self.add_type_node(node)
+
+        memories, _datas, _starts = self.module_fields()
+        # (the runtime's own data is already in the runtime)
+        datas = [n for n in module.misc_nodes[module.parsed_misc_count:] if n.name == 'data']
+        self.encode_imports()
+        imported = self.imported
+        if imported['global'] or imported['table'] or imported['memory'] or len(memories) != 1:
+            raise NotImplementedError('runtime must define its own memory, table and globals')
+        self.collect_names(module.funcs, self.func_names, len(imported['func']))
+        self.collect_names(module.globals, self.global_names)
+
+        funcs = [_reparse(f) for f in module.funcs[module.parsed_func_count:]]
+        globals_ = [_reparse(g) for g in module.globals[module.parsed_global_count:]]
+        elems = [_reparse(e) for e in module.elems[module.parsed_elem_count:]]
+        runtime_func_count = len(imported['func']) + module.parsed_func_count
+        runtime_global_count = module.parsed_global_count
+
+        # work out which bits of the runtime actually get used, and only import those
+        used = {'func': set(), 'global': set()}
+        for node in [*funcs, *globals_]:
+            for kind, token in _references(node.children):
+                used[kind].add(self.resolve(token, self.func_names if kind == 'func' else self.global_names))
+        for elem in elems:
+            used['func'].update(self.resolve(item, self.func_names) for item in self.parse_elem(elem)[3])
+
+        self.func_remap = {}
+        self.global_remap = {}
+        imports = []
+        for index in sorted(i for i in used['func'] if i < runtime_func_count):
+            if index < len(imported['func']):
+                desc = imported['func'][index]
+                type_index = self.type_use([c for c in desc.children if isinstance(c, Node)
+                                            and c.name in TYPE_USE_NODES])
+            else:
+                type_index = self.func_type(module.funcs[index - len(imported['func'])])
+            self.func_remap[index] = len(imports)
+            imports.append(self.link_import('func', index, uleb(type_index)))
+        for index in sorted(i for i in used['global'] if i < runtime_global_count):
+            value_type, _ = self.split_global(module.globals[index])
+            self.global_remap[index] = len(self.global_remap)
+            imports.append(self.link_import('global', index, self.global_type(value_type)))
+        # the table's min size doesn't matter, since the start func grows it to fit
+        imports.append(self.link_import('table', 0, bytes([REF_TYPES['funcref']]) + self.limits([0])))
+        imports.append(self.link_import('memory', 0, self.limits([c for c in memories[0].children
+                                                                  if isinstance(c, int)][:1])))
+        sections['import'] = vec(imports)
+
+        func_import_count = len(self.func_remap)
+        for i in range(len(funcs)):
+            self.func_remap[runtime_func_count + i] = func_import_count + i
+        global_import_count = len(self.global_remap)
+        for i in range(len(globals_)):
+            self.global_remap[runtime_global_count + i] = global_import_count + i
+
+        func_types = []
+        bodies = []
+        for i, func in enumerate(funcs):
+            type_index, body = self.encode_func(func)
+            func_types.append(uleb(type_index))
+            bodies.append(uleb(len(body)) + body)
+            original = module.funcs[module.parsed_func_count + i]
+            self.debug_name(func, func_import_count + i)
+            self.inline_exports(func, 'func', func_import_count + i, self.positions[id(original)])
+
+        # elem segments can't be active, since the table isn't big enough for them until it's been grown.
+        # so they're passive, and copied in by a start function instead.
+        start = [KeywordLiteral('ref.null'), KeywordLiteral('func'),
+                 KeywordLiteral('i32.const'), module.table[0].children[0],
+                 KeywordLiteral('table.size'), KeywordLiteral('i32.sub'),
+                 KeywordLiteral('table.grow'), KeywordLiteral('drop')]
+        elem_entries = []
+        for i, elem in enumerate(elems):
+            table, offset, declare, items = self.parse_elem(elem)
+            if table != 0 or declare or offset is None:
+                raise NotImplementedError('only active elems can be linked')
+            elem_entries.append(b'\x01\x00' + vec(uleb(self.func_index(item)) for item in items))
+            start += [*offset, KeywordLiteral('i32.const'), 0, KeywordLiteral('i32.const'), len(items),
+                      KeywordLiteral('table.init'), i, KeywordLiteral('elem.drop'), i]
+        start_body = bytearray(vec([]))
+        self.encode_instructions(start, start_body, [], {})
+        start_body += b'\x0b'
+        func_types.append(uleb(self.type_index([], [])))
+        bodies.append(uleb(len(start_body)) + start_body)
+
+        sections['function'] = vec(func_types)
+
+        global_entries = []
+        for i, glob in enumerate(globals_):
+            value_type, init = self.split_global(glob)
+            global_entries.append(self.global_type(value_type) + self.encode_expression(init))
+            original = module.globals[module.parsed_global_count + i]
+            self.inline_exports(glob, 'global', global_import_count + i, self.positions[id(original)])
+        if global_entries:
+            sections['global'] = vec(global_entries)
+
+        for export in module.exports[module.parsed_export_count:]:
+            if export.ref_type not in ('func', 'global'):
+                raise NotImplementedError(f'cannot link {export.ref_type} exports')
+            index = (self.func_index if export.ref_type == 'func' else self.global_index)(export.ref_index)
+            entry = name_bytes(export.ref_name) + bytes([EXPORT_KINDS[export.ref_type]]) + uleb(index)
+            self.exports.append((self.positions[id(export)], entry))
+        if self.exports:
+            self.exports.sort(key=lambda export: export[0])
+            sections['export'] = vec(entry for _, entry in self.exports)
+
+        sections['start'] = uleb(func_import_count + len(funcs))
+        if elem_entries:
+            sections['elem'] = vec(elem_entries)
+        sections['code'] = vec(bodies)
+        if datas:
+            sections['data'] = vec(self.encode_data(data) for data in datas)
+
+        return self.assemble(sections)
+
+    @staticmethod
+    def link_import(kind: str, index: int, desc: bytes) -> bytes:
+        return name_bytes(LINK_MODULE) + name_bytes(link_name(kind, index)) + bytes([EXPORT_KINDS[kind]]) + desc
+
+    def assemble(self, sections: dict[str, bytes]) -> bytes:
+        # the type section goes first, but can only be written once everything else has had a chance to add to it
+        sections['type'] = vec(
+            b'\x60' + vec(bytes([VALUE_TYPES[t]]) for t in params) + vec(bytes([VALUE_TYPES[t]]) for t in results)
+            for params, results in self.types
+        )
+
+        if self.names and self.func_debug_names:
+            # a custom section, made up of subsections. We only write subsection 1 (function names).
+            func_names = vec(uleb(i) + name_bytes(name) for i, name in sorted(self.func_debug_names.items()))
+            sections['name'] = name_bytes('name') + b'\x01' + uleb(len(func_names)) + func_names
+
+        out = bytearray(b'\x00asm\x01\x00\x00\x00')
+        for section, section_id in SECTION_IDS.items():
+            if section in sections:
+                payload = sections[section]
+                out.append(section_id)
+                out += uleb(len(payload)) + payload
+        return bytes(out)
+
+    @staticmethod
+    def limits(values) -> bytes:
+        if len(values) == 1:
+            return b'\x00' + uleb(values[0])
+        if len(values) == 2:
+            return b'\x01' + uleb(values[0]) + uleb(values[1])
+        raise NotImplementedError(f'bad limits {values}')
+
+    @staticmethod
+    def split_global(glob: Node) -> tuple[list, list]:
+        # returns (type, init expression)
+        children = [c for c in glob.children if not _is_identifier(c)
+                    and not (isinstance(c, Node) and c.name == 'export')]
+        return children[:1], children[1:]
+
+    @staticmethod
+    def global_type(children) -> bytes:
+        (value_type,) = children
+        if isinstance(value_type, Node) and value_type.name == 'mut':
+            return bytes([VALUE_TYPES[_value_types(value_type)[0]], 1])
+        return bytes([VALUE_TYPES[_word(value_type)], 0])
+
+    def parse_elem(self, elem: Node):
+        # returns (table index, offset expression or None, whether it's declarative, item tokens)
+        children = [c for c in elem.children if not _is_identifier(c) or c is not elem.children[0]]
+        table = 0
+        offset = None
+        declare = False
+        items = []
+        for child in children:
+            word = _word(child)
+            if isinstance(child, Node) and child.name == 'table' and not word:
+                table = self.resolve(child.children[0], self.table_names)
+            elif isinstance(child, Node) and child.name == 'offset' and not word:
+                offset = child.children
+            elif _is_instruction_node(child):
+                if offset is not None:
+                    raise NotImplementedError('element expressions are not supported')
+                offset = [child]
+            elif word == 'declare':
+                declare = True
+            elif word in ('func', 'funcref'):
+                pass
+            else:
+                items.append(child)
+        return table, offset, declare, items
+
+    def encode_elem(self, elem: Node) -> bytes:
+        table, offset, declare, items = self.parse_elem(elem)
+        items = [uleb(self.func_index(item)) for item in items]
+
+        if declare:
+            return b'\x03\x00' + vec(items)
+        if offset is None:
+            return b'\x01\x00' + vec(items)
+        if table == 0:
+            return b'\x00' + self.encode_expression(offset) + vec(items)
+        return b'\x02' + uleb(table) + self.encode_expression(offset) + b'\x00' + vec(items)
+
+    def encode_data(self, data: Node) -> bytes:
+        memory = 0
+        offset = None
+        content = bytearray()
+        for child in data.children:
+            if isinstance(child, StringLiteral):
+                # each char is a byte (see StringLiteral.__str__)
+                content += child.content.encode('latin-1')
+            elif _is_identifier(child):
+                pass
+            elif isinstance(child, Node) and child.name == 'memory':
+                memory = self.resolve(child.children[0], self.memory_names)
+            elif isinstance(child, Node) and child.name == 'offset':
+                offset = child.children
+            elif _is_instruction_node(child):
+                offset = [child]
+            else:
+                raise NotImplementedError(f'unexpected token in data: {child!r}')
+
+        content = uleb(len(content)) + bytes(content)
+        if offset is None:
+            return b'\x01' + content
+        if memory == 0:
+            return b'\x00' + self.encode_expression(offset) + content
+        return b'\x02' + uleb(memory) + self.encode_expression(offset) + content
+
+
+def encode_module(module, names=False) -> bytes:
+    return ModuleEncoder(module, names).encode()
+
+
+def encode_runtime(module, names=False) -> bytes:
+    # the runtime on its own, ready to be linked against. Should be given the unmodified runtime
+    # (i.e. parse_wat.load_template), rather than one with user code in it.
+    return ModuleEncoder(module, names).encode(link_exports=True)
+
+
+def encode_linked(module, names=False) -> bytes:
+    return ModuleEncoder(module, names).encode_linked()
@@ -1,6 +1,13 @@
+import array
 import dis
+import math
+import threading
 
-from generate_code import CodeGenerator
+import pytest
+
+import compile_cache
+import main
+from generate_code import CodeGenerator, RUNTIME_PATH
 # from src.main_old import func_to_wasm, run_func, Module
 from main import compile_func_to_wasm, compile_and_save, compile_multiple, compile_module
 
@@ -312,6 +319,552 @@ def test_weird_code():
     assert sum_of_primes_(20000) == sum_of_primes(20000)
 
 
+def test_compile_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(compile_cache, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(compile_cache, 'ENABLED', True)
+
+    def triple(x):
+        return x * 3
+
+    key = main.wasm_cache_key([(triple, 'triple')])
+    assert compile_func_to_wasm(triple)(5) == 15
+    assert compile_cache.load(key) is not None
+
+    # a warm compile must come straight from the cache, without touching the code generator
+    def no_codegen(*args, **kwargs):
+        raise AssertionError('cache miss!')
+
+    monkeypatch.setattr(main, 'CodeGenerator', no_codegen)
+    assert compile_func_to_wasm(triple)(7) == 21
+
+    # but changing the function has to miss
+    def triple_plus_one(x):
+        return x * 3 + 1
+
+    assert main.wasm_cache_key([(triple_plus_one, 'triple')]) != key
+
+    # and it can be turned off altogether
+    monkeypatch.setattr(compile_cache, 'ENABLED', False)
+    assert compile_cache.load(key) is None
+
+
+def test_runtime_template_is_shared():
+    import parse_wat
+
+    def add_two(x):
+        return x + 2
+
+    g = CodeGenerator()
+    table_size = g.wasm_module.table[0].children[0]
+    g.add_to_module(add_two, 'add_two')
+    g.compile()
+
+    # the second generator gets a fresh copy of the same template, untouched by the first
+    g2 = CodeGenerator()
+    assert 'add_two' not in g2.wasm_module.funcs_by_name
+    assert g2.wasm_module.table[0].children[0] == table_size
+    assert g2.wasm_module.funcs[0] is g.wasm_module.funcs[0]
+    assert parse_wat.load_template(RUNTIME_PATH) is parse_wat.load_template(RUNTIME_PATH)
+
+
+def test_tokenizers_agree():
+    import io
+    import parse_wat
+
+    text = parse_wat.decompile(RUNTIME_PATH)
+    slow = map(parse_wat._token_key, parse_wat.tokenize(io.StringIO(text)))
+    fast = map(parse_wat._token_key, parse_wat.tokenize_buffer(text))
+    assert list(slow) == list(fast)
+
+
+def test_binary_encoder_matches_wat2wasm():
+    import parse_wat
+    import wasm_binary
+
+    module = parse_wat.load_template(RUNTIME_PATH).clone()
+    module.finalise()
+    assert wasm_binary.encode_module(module) == module.wat2wasm()
+
+
+def test_linked_runtime():
+    from example_files.fib import fib_python
+    from example_files.function_swap import foo, add_1, add_10
+
+    fib = compile_func_to_wasm(fib_python, linked=True, use_cache=False)
+    assert fib(20) == 6765
+
+    foo, *_ = compile_multiple(foo, add_1, add_10, linked=True, use_cache=False)
+    assert foo(3, 1) == 5
+    assert foo(3, 2) == 14
+
+
+def test_native_cache(monkeypatch, tmp_path):
+    import run_wasm
+
+    monkeypatch.setattr(compile_cache, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(compile_cache, 'ENABLED', True)
+
+    def triple(x):
+        return x * 3
+
+    wasm = main.build_wasm([(triple, 'triple')], use_cache=False)
+    assert main.wrapper_wrapper('triple', run_wasm.run_wasm(wasm))(5) == 15
+    assert compile_cache.load(run_wasm.native_cache_key(wasm), suffix='.native') is not None
+
+    # a warm load has to skip JIT compilation entirely
+    class NoCompile:
+        deserialize = staticmethod(run_wasm.Module.deserialize)
+
+        def __new__(cls, *args):
+            raise AssertionError('cache miss!')
+
+    monkeypatch.setattr(run_wasm, 'Module', NoCompile)
+    assert main.wrapper_wrapper('triple', run_wasm.run_wasm(wasm))(7) == 21
+
+
+def test_tiered_instance():
+    from example_files.global_mutation import foo, foo_2, call_foo, swap_foo, counter, set_counter
+    funcs = [call_foo, swap_foo, counter, set_counter, foo, foo_2]
+    instance = main.build_instance([(f, f.__name__) for f in funcs], use_cache=False, tiered=True)
+    call_foo, swap_foo, counter, set_counter, *_ = [main.wrapper_wrapper(f.__name__, instance) for f in funcs]
+    # before any call, as any of them could do the swap
+    baseline = instance.instance
+
+    # state built up on the baseline instance has to survive the swap
+    set_counter()
+    swap_foo()
+    assert counter() == 1
+
+    instance.wait()
+    assert instance.instance is not baseline
+
+    assert counter() == 2
+    assert call_foo() == 1
+
+
+def test_compile_profiles():
+    from profiles import PROFILES, get_profile
+
+    # by default, wasm-opt runs the same as it always has (--converge is only for max-throughput)
+    assert get_profile().opt_level == 'O4' and get_profile().passes == ()
+
+    def add(a, b):
+        return a + b
+
+    for profile in PROFILES:
+        assert compile_func_to_wasm(add, profile=profile, use_cache=False)(2, 3) == 5
+
+    # only debug keeps the name section
+    assert b'\x04name' in main.build_wasm([(add, 'add')], profile='debug', use_cache=False)
+    assert b'\x04name' not in main.build_wasm([(add, 'add')], profile='fast-compile', use_cache=False)
+
+    with pytest.raises(ValueError):
+        compile_func_to_wasm(add, profile='warp-speed')
+
+
+def test_build_many():
+    from example_files import fib, function_swap, global_mutation
+    jobs = [
+        [(f, f.__name__) for f in (function_swap.foo, function_swap.add_1, function_swap.add_10)],
+        [(fib.fib_python, 'fib_python')],
+    ]
+    sequential = [main.build_wasm(funcs, use_cache=False) for funcs in jobs]
+    assert main.build_many(jobs, workers=2, use_cache=False) == sequential
+
+    mutation_mod, swap_mod = main.compile_modules(global_mutation, function_swap, workers=2, use_cache=False)
+    mutation_mod.swap_foo()
+    assert mutation_mod.call_foo() == 1
+    assert swap_mod.foo(1, 1) == 3
+
+
+def test_instance_pool():
+    from concurrent.futures import ThreadPoolExecutor
+    from example_files.global_mutation import counter, set_counter
+    counter, set_counter = compile_multiple(counter, set_counter, pooled=True)
+
+    def count(n):
+        set_counter()
+        return [counter() for _ in range(n)]
+
+    # every thread has its own instance, so the counts don't interfere
+    with ThreadPoolExecutor(4) as pool:
+        for result in pool.map(count, [50] * 8):
+            assert result == list(range(1, 51))
+
+    for linked in (False, True):
+        add = compile_func_to_wasm(lambda x, y: x + y, name='add', linked=linked, pooled=True)
+        with ThreadPoolExecutor(4) as pool:
+            assert list(pool.map(add, range(20), range(20))) == list(range(0, 40, 2))
+
+    # and its own store to go with it
+    import run_wasm
+    with ThreadPoolExecutor(1) as pool:
+        assert pool.submit(run_wasm.thread_store).result() is not run_wasm.thread_store()
+
+
+def test_async_api():
+    import asyncio
+    from example_files.global_mutation import counter, set_counter
+
+    def add(x, y):
+        return x + y
+
+    async def run():
+        add_async = await main.compile_func_to_wasm_async(add, use_cache=False)
+        async with add_async.instance:
+            assert await asyncio.gather(*(add_async(i, i) for i in range(10))) == list(range(0, 20, 2))
+
+        # one worker, so the global is shared between calls
+        counter_async, set_counter_async = await main.compile_multiple_async(counter, set_counter, use_cache=False)
+        async with counter_async.instance:
+            await set_counter_async()
+            assert [await counter_async() for _ in range(3)] == [1, 2, 3]
+
+    asyncio.run(run())
+    # closing the instances stopped their workers
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('wasm_')]
+
+
+def test_captured_output():
+    from run_wasm import Output
+    from example_files.global_scope_1 import use_x
+
+    output = Output(capture=True)
+    use_x = compile_multiple(use_x, output=output)[0]
+    with pytest.raises(RuntimeError):
+        use_x(5)
+    # (x is uninitialised, so the runtime complains about it before bailing out)
+    assert output.getvalue() == 'PyLong CHECK_BINOP got non-long argument!\n'
+    output.clear()
+    assert output.getvalue() == ''
+
+
+def test_heap_stats():
+    @compile_func_to_wasm
+    def make_pair(x, y):
+        return (x + 1, y + 0.5), 0
+
+    before = main.heap_stats(make_pair)
+    assert set(before['types']) == {'other', 'int', 'tuple', 'bool', 'None', 'float'}
+    assert before['memory_size'] > 0
+
+    for i in range(10):
+        # (x is freed at the end of each call, so the next one's x comes off the free list)
+        assert make_pair(i + 100000, 2.0) == ((i + 100001, 2.5), 0)
+    after = main.heap_stats(make_pair)
+
+    assert after['types']['tuple']['allocations'] > before['types']['tuple']['allocations']
+    assert after['types']['float']['allocations'] > before['types']['float']['allocations']
+    assert after['types']['int']['free_list_hits'] > before['types']['int']['free_list_hits']
+    assert after['totals']['bytes_in_use'] >= after['totals']['live'] > 0
+
+
+def test_resettable_instance():
+    import run_wasm
+    from example_files.global_mutation import counter, set_counter
+    from example_files.global_scope_1 import assign_x, use_x
+
+    for linked in (False, True):
+        count, set_count = compile_multiple(counter, set_counter, linked=linked, resettable=True)
+        set_count()
+        assert [count(), count()] == [1, 2]
+
+        main.reset(count)
+        snapshot, current = count.instance.snapshot, run_wasm.Snapshot(count.instance)
+        assert (current.memory, current.globals) == (snapshot.memory, snapshot.globals)
+        set_count()
+        assert count() == 1
+
+    # a trap resets everything, including the global that was set before it
+    assign_x, use_x = compile_multiple(assign_x, use_x, resettable=True)
+    assign_x(3)
+    assert use_x(5) == 8
+    with pytest.raises(RuntimeError):
+        use_x(None)
+    with pytest.raises(RuntimeError):
+        use_x(5)
+
+
+def test_marshal_return():
+    @compile_func_to_wasm
+    def nested(x, y, z):
+        return (x, (y, None)), x * y, z, (z, z)
+
+    assert nested(3, -4, None) == ((3, (-4, None)), -12, None, (None, None))
+    assert nested(2 ** 20, 2 ** 20, 2.5) == ((2 ** 20, (2 ** 20, None)), 2 ** 40, 2.5, (2.5, 2.5))
+
+    # big enough that it doesn't fit in the runtime's static buffer
+    @compile_func_to_wasm
+    def big(x):
+        t = (x, x, x, x, x, x, x, x)
+        t = (t, t, t, t, t, t, t, t)
+        return (t, t, t, t, t, t, t, t)
+
+    assert big(-70000) == ((((-70000,) * 8,) * 8,) * 8)
+
+
+def test_marshal_args():
+    @compile_func_to_wasm
+    def identity(x):
+        return x
+
+    for value in [0, -1, 7, -70000, 2 ** 31, -(2 ** 100), 1.5, None, True, False, (1, (2.5, (None, True)), ())]:
+        assert identity(value) == value
+        assert type(identity(value)) is type(value)
+
+    # too big for the runtime's static buffer
+    value = tuple(range(-1000, 1000))
+    assert identity(value) == value
+
+    with pytest.raises(TypeError):
+        identity('hello')
+
+
+def test_big_ints():
+    @compile_func_to_wasm
+    def big_ops(x, y):
+        return x * y, x + y, x - y
+
+    for x, y in [(3 ** 200, 7 ** 150), (-(2 ** 64), 2 ** 64 - 1), (2 ** 15, -(2 ** 30)), (255, 2 ** 24)]:
+        assert big_ops(x, y) == (x * y, x + y, x - y)
+
+
+def test_specialised_wrappers():
+    from example_files.fib import fib_python
+
+    fib = compile_func_to_wasm(fib_python)
+    assert fib.__code__.co_filename == '<wrapper for fib_python>'
+    assert fib(20) == 6765
+    # the guard fails, so it goes the generic way
+    assert fib(True) == 1
+
+    def scale(x: float, y: int):
+        return x * x, y * 2
+
+    scale = compile_func_to_wasm(scale)
+    assert scale(1.5, 4) == (2.25, 8)
+    # too big for a C long, so that one goes the generic way too
+    assert scale(2.0, 2 ** 40) == (4.0, 2 ** 41)
+
+    # unannotated, so everything is marshalled
+    swap = compile_func_to_wasm(lambda x, y: (y, x), name='swap')
+    assert swap((1, 2), 3.5) == (3.5, (1, 2))
+
+    # tiered instances can change their exports, so they don't get one
+    tiered = compile_func_to_wasm(fib_python, tiered=True, use_cache=False)
+    assert tiered(10) == 55
+    assert tiered.__code__.co_filename != '<wrapper for fib_python>'
+
+    # results are released once they've been read, on the specialised path and the generic one
+    def add(x: int, y: int):
+        return x + y
+
+    add = compile_func_to_wasm(add)
+    before = main.heap_stats(add)['totals']['live']
+    for i in range(10):
+        assert add(1000, i) == 1000 + i
+        assert add(2 ** 40, i) == 2 ** 40 + i
+    assert main.heap_stats(add)['totals']['live'] == before
+
+
+def test_native_exports():
+    def add(x: int, y: int) -> int:
+        return x + y
+
+    def mix(x: float, y: float) -> float:
+        return x + y
+
+    add, mix = compile_multiple(add, mix)
+    assert 'native' in add.__code__.co_names
+    assert add(3, 4) == 7
+    assert add(2 ** 40, -5) == 2 ** 40 - 5
+    # the result doesn't fit in an i64, so it comes back boxed
+    assert add(2 ** 62, 2 ** 62) == 2 ** 63
+    # and the arguments don't either, so it goes the generic way
+    assert add(2 ** 70, 1) == 2 ** 70 + 1
+    assert mix(1.5, 2.25) == 3.75
+    assert math.isnan(mix(float('nan'), 1.0))
+    # ints where floats were promised go the generic way, and come back as whatever they really are
+    assert mix(1, 2) == 3
+
+    # boxed results are released once they've been read
+    before = main.heap_stats(add)['totals']['live']
+    for _ in range(10):
+        assert add(2 ** 62, 2 ** 62) == 2 ** 63
+    assert main.heap_stats(add)['totals']['live'] == before
+
+    # its arguments are unboxed ints, so the native export works on them directly, without allocating anything
+    before = main.heap_stats(add)['totals']['allocations']
+    for i in range(100):
+        assert add(i, 2 ** 40) == i + 2 ** 40
+    assert main.heap_stats(add)['totals']['allocations'] == before
+
+
+def test_batch_api():
+    def add(x: int, y: int) -> int:
+        return x + y
+
+    def square(x: float) -> float:
+        return x * x
+
+    add, square = compile_multiple(add, square)
+    assert add.batch([1, 2, 3], array.array('q', [10, 20, 30])) == array.array('q', [11, 22, 33])
+    assert square.map(array.array('d', [1.5, 3.0])) == array.array('d', [2.25, 9.0])
+    assert len(square.map([])) == 0
+    # a result too big for the array means it's a list instead
+    assert add.batch([2 ** 62, 1], [2 ** 62, 1]) == [2 ** 63, 2]
+    # and those results are released once they've been read
+    before = main.heap_stats(add)['totals']['live']
+    assert add.batch([2 ** 62] * 10, [2 ** 62] * 10) == [2 ** 63] * 10
+    assert main.heap_stats(add)['totals']['live'] == before
+    with pytest.raises(ValueError):
+        add.batch([1, 2], [1])
+
+    # no native export, so it's a loop in python, but it works the same
+    swap = compile_func_to_wasm(lambda x, y: (y, x), name='swap')
+    assert swap.batch([1, 2], [3, 4]) == [(3, 1), (4, 2)]
+
+
+def test_buffers():
+    def pick(data, i):
+        return data[i] + data[-1]
+
+    resettable_pick = compile_multiple(pick, resettable=True)[0]
+    pick = compile_func_to_wasm(pick)
+    with main.buffer(pick, 4, 'q') as ints:
+        ints.view[:] = array.array('q', [1, 2, 3, 2 ** 40])
+        assert pick(ints, 1) == 2 ** 40 + 2
+        # writes show up without passing it again
+        ints.view[0] = 5
+        assert pick(ints, 0) == 2 ** 40 + 5
+
+    with main.buffer(pick, 2, 'd') as floats:
+        floats.view[:] = array.array('d', [0.5, 1.5])
+        assert pick(floats, 0) == 2.0
+    with pytest.raises(ValueError):
+        floats.view
+
+    with pytest.raises(ValueError):
+        main.buffer(pick, 1, 'x')
+
+    # resetting the instance frees its buffers, including the reset after a trap
+    pick = resettable_pick
+    ints = main.buffer(pick, 2, 'q')
+    ints.view[:] = array.array('q', [1, 2])
+    assert pick(ints, 0) == 3
+    with pytest.raises(RuntimeError):
+        pick(ints, 5)
+    with pytest.raises(ValueError):
+        pick(ints, 0)
+    with pytest.raises(ValueError):
+        ints.view
+    before = main.heap_stats(pick)['totals']['live']
+    # (and releasing it leaves whatever's there now alone)
+    ints.release()
+    assert main.heap_stats(pick)['totals']['live'] == before
+
+
+def test_static_consts():
+    def consts(x):
+        return x, 2.5, (1, (1180591620717411303424, -3)), ()
+
+    for linked in (False, True):
+        f = compile_func_to_wasm(consts, use_cache=False, linked=linked)
+        before = main.heap_stats(f)['types']
+        assert f(0) == f(0) == (0, 2.5, (1, (2 ** 70, -3)), ())
+        after = main.heap_stats(f)['types']
+        # nothing gets built when the constants are loaded (only the tuple being returned)
+        assert after['float'] == before['float']
+        assert after['tuple']['allocations'] == before['tuple']['allocations'] + 2
+
+    def flags(x):
+        return True, (False, x)
+
+    flags = compile_func_to_wasm(flags, use_cache=False)
+    # bools are the real True and False, not the ints 1 and 0
+    assert flags(None)[0] is True
+    assert flags(None)[1][0] is False
+
+
+def test_unboxed_ints():
+    from example_files.fib import sum_of_primes, brute_force_is_prime
+
+    sum_of_primes_wasm, _ = compile_multiple(sum_of_primes, brute_force_is_prime)
+    assert sum_of_primes_wasm(1000) == sum_of_primes(1000)
+
+    def kernel(n: int, x: int):
+        total = 0
+        i = 0
+        while i < n:
+            # overflows part way through for the bigger n, and carries on as a big int
+            total = total * 3 + x % 7 - x // 7
+            i += 1
+        return total, n - i
+
+    kernel_wasm = compile_func_to_wasm(kernel, use_cache=False)
+    for n, x in [(5, 100), (5, -100), (60, 12345), (3, 2 ** 70)]:
+        assert kernel_wasm(n, x) == kernel(n, x)
+
+    # while everything stays small, the loop itself doesn't allocate any ints
+    before = main.heap_stats(kernel_wasm)['types']['int']['allocations']
+    assert kernel_wasm(1000, 0) == (0, 0)
+    assert main.heap_stats(kernel_wasm)['types']['int']['allocations'] - before < 10
+
+    def ops(a: int, b: int):
+        total = a + b
+        difference = a - b
+        product = a * b
+        remainder = a % b
+        quotient = a // b
+        both = a & b
+        either = a | b
+        less = 0
+        if a < b:
+            less = 1
+        same = 0
+        if a == b:
+            same = 1
+        return total, difference, product, remainder, quotient, both, either, less, same
+
+    # either side of where the inline small int cases hand over to the runtime
+    ops_wasm = compile_func_to_wasm(ops, use_cache=False)
+    edges = [1, -1, 2, -2, 7, -7, 2 ** 31 - 1, -2 ** 31, 2 ** 31, 2 ** 61, -2 ** 62, 2 ** 62 - 1, 2 ** 62, -2 ** 70]
+    for a in [0] + edges:
+        for b in edges:
+            assert ops_wasm(a, b) == ops(a, b), (a, b)
+
+
+def test_unboxed_floats():
+    def harmonic(n: int):
+        total = 0.0
+        i = 1
+        while i <= n:
+            total += 1 / i
+            i += 1
+        return total
+
+    def kernel(n: int):
+        x = 0.5
+        y = 0.0
+        i = 0
+        while i < n:
+            # the ints get promoted to floats, the same way python does it
+            y = (y * 0.5 + x * i - i // 3) % 7.0 + y // 2.5
+            if y > 1000:
+                y -= 1000.0
+            i += 1
+        return y, x / 4
+
+    harmonic_wasm, kernel_wasm = compile_multiple(harmonic, kernel, use_cache=False)
+    assert harmonic_wasm(1000) == harmonic(1000)
+    assert kernel_wasm(100) == kernel(100)
+
+    # only the floats being returned get allocated
+    before = main.heap_stats(kernel_wasm)['types']['float']['allocations']
+    kernel_wasm(1000)
+    assert main.heap_stats(kernel_wasm)['types']['float']['allocations'] - before == 2
+
+
 def bench(f, arg, n=10000):
     import time
     t1 = time.time()